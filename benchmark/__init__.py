@@ -0,0 +1,7 @@
+"""
+Benchmarks of the providers and sources against a farm of local fake echo
+servers. They are not part of the test suite; run them with
+python -m benchmark.run from the repository root with src on the PYTHONPATH.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
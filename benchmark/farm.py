@@ -0,0 +1,276 @@
+"""
+A farm of local fake echo servers answering like the plain-text and JSON
+services the builtin sources use. Each server follows a Profile: a latency
+distribution, the share of requests answered with an error and the share
+of requests left hanging, so that scenarios can degrade some sources.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import errno
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+import echoip.sources
+
+TEXT = 'text'
+JSON = 'json'
+JSON_IP_KEY = 'ip'
+
+
+def constant(seconds):
+    """
+    :param seconds: The latency of every request
+    :type seconds: float
+    :return: A latency distribution always returning seconds
+    :rtype: callable
+    """
+    return lambda: seconds
+
+
+def uniform(low, high):
+    """
+    :param low: The lowest latency in seconds
+    :type low: float
+    :param high: The highest latency in seconds
+    :type high: float
+    :return: A latency distribution uniform between low and high
+    :rtype: callable
+    """
+    return lambda: random.uniform(low, high)
+
+
+def lognormal(median, sigma=0.5):
+    """
+    A long-tailed latency distribution, closer to that of real services
+    :param median: The median latency in seconds
+    :type median: float
+    :param sigma: The standard deviation of the latency's natural logarithm
+    :type sigma: float
+    :return: A lognormal latency distribution
+    :rtype: callable
+    """
+    return lambda: median * random.lognormvariate(0, sigma)
+
+
+class Profile(object):
+    """
+    How a fake echo server behaves
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, hang_rate=0.0, hang_seconds=30.0):
+        """
+        Constructor
+
+        :param latency: returns the seconds each request is delayed by, no delay if None
+        :type latency: callable
+        :param error_rate: the share of requests answered with a 500 error
+        :type error_rate: float
+        :param hang_rate: the share of requests left unanswered for hang_seconds
+        :type hang_rate: float
+        :param hang_seconds: the seconds a hanging request waits before the
+        connection is dropped
+        :type hang_seconds: float
+        """
+        self.latency = latency if latency is not None else constant(0)
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+
+    def outcome(self):
+        """
+        :return: 'hang', 'error' or 'ok' for the next request
+        :rtype: str
+        """
+        draw = random.random()
+        if draw < self.hang_rate:
+            return 'hang'
+        if draw < self.hang_rate + self.error_rate:
+            return 'error'
+        return 'ok'
+
+
+class _EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers with the address of the client as the server's profile dictates"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server.echo_server
+        server.count_request()
+        outcome = server.profile.outcome()
+        if outcome == 'hang':
+            time.sleep(server.profile.hang_seconds)
+            self.close_connection = True
+            return
+        time.sleep(max(server.profile.latency(), 0))
+        if outcome == 'error':
+            self._respond(500, 'text/plain', 'Internal Server Error\n')
+        elif server.kind == JSON:
+            self._respond(200, 'application/json', json.dumps({JSON_IP_KEY: self.client_address[0],
+                                                               'country': 'US', 'org': 'Benchmark'}))
+        else:
+            self._respond(200, 'text/plain', '{}\n'.format(self.client_address[0]))
+
+    def _respond(self, status, content_type, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out or got their answer from another source hang up
+        # before the response is written, which degraded scenarios expect
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error) and error.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeEchoServer(object):
+    """
+    A plain-text or JSON echo service on a local port, serving each request
+    from its own thread
+    """
+
+    def __init__(self, kind=TEXT, profile=None, host='127.0.0.1'):
+        """
+        Constructor
+
+        :param kind: TEXT to answer with the bare address, JSON to answer with an
+        object holding it under JSON_IP_KEY
+        :type kind: str
+        :param profile: how the server behaves, answering at once by default
+        :type profile: Profile
+        :param host: the address listened on
+        :type host: str
+        """
+        if kind not in (TEXT, JSON):
+            raise ValueError("kind must be {} or {}".format(TEXT, JSON))
+        self.kind = kind
+        self.profile = profile if profile is not None else Profile()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, 0), _EchoHandler)
+        self._server.echo_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        self.url = 'http://{}:{}/'.format(host, self._server.server_port)
+
+    def count_request(self):
+        with self._lock:
+            self._requests += 1
+
+    @property
+    def requests(self):
+        """
+        :return: The number of requests received
+        :rtype: int
+        """
+        return self._requests
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class EchoServerFarm(object):
+    """
+    A set of fake echo servers and the sources and factories pointing at them
+    """
+
+    def __init__(self):
+        self._servers = []
+
+    def add(self, kind=TEXT, profile=None, count=1):
+        """
+        Starts servers of a kind and profile
+        :param kind: TEXT or JSON
+        :type kind: str
+        :param profile: how the servers behave
+        :type profile: Profile
+        :param count: the number of servers started
+        :type count: int
+        :return: The servers started
+        :rtype: list(FakeEchoServer)
+        """
+        servers = [FakeEchoServer(kind, profile) for _ in range(count)]
+        self._servers.extend(servers)
+        return servers
+
+    @property
+    def servers(self):
+        """
+        :return: Every server in the farm
+        :rtype: list(FakeEchoServer)
+        """
+        return list(self._servers)
+
+    @property
+    def requests(self):
+        """
+        :return: The number of requests received by the whole farm
+        :rtype: int
+        """
+        return sum(server.requests for server in self._servers)
+
+    def factory(self, transport=None, timeout=echoip.sources.DEFAULT_TIMEOUT):
+        """
+        :param transport: the transport shared by the generated sources
+        :type transport: echoip.transport.HTTPTransport
+        :param timeout: the connect and read timeouts of the generated sources
+        :type timeout: tuple(float, float) or float
+        :return: A factory of a source for each server, without the builtin sources
+        :rtype: echoip.sources.IPSourceFactory
+        """
+        factory = echoip.sources.IPSourceFactory(use_builtins=False, transport=transport)
+        for server in self._servers:
+            if server.kind == JSON:
+                factory.add_source(echoip.sources.JSONIPSource, server.url, JSON_IP_KEY, None, timeout,
+                                   info_keys=('country', 'org'))
+            else:
+                factory.add_source(echoip.sources.SimpleIPSource, server.url, None, timeout)
+        return factory
+
+    def sources(self, transport=None, timeout=echoip.sources.DEFAULT_TIMEOUT):
+        """
+        :param transport: the transport shared by the sources
+        :type transport: echoip.transport.HTTPTransport
+        :param timeout: the connect and read timeouts of the sources
+        :type timeout: tuple(float, float) or float
+        :return: A source for each server, in the order the servers were added
+        :rtype: list(IIPSource provider)
+        """
+        factory = self.factory(transport, timeout)
+        by_url = dict((source.source_id, source) for source in factory.get_sources())
+        return [by_url[server.url] for server in self._servers]
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
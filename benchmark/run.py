@@ -0,0 +1,243 @@
+"""
+Runs the benchmark scenarios against a local farm of fake echo servers and
+reports the p50 and p99 latency of the calls and the calls per second:
+
+    PYTHONPATH=src python -m benchmark.run
+    PYTHONPATH=src python -m benchmark.run --scenario degraded --callers 8 --json
+
+Every scenario starts its own farm, so their results do not depend on the
+order they run in. Use --seed to repeat the same latencies and failures.
+"""
+from __future__ import print_function
+
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import argparse
+import collections
+import json
+import random
+import sys
+import threading
+import timeit
+
+import echoip.providers
+
+from . import farm
+
+
+class Stats(collections.namedtuple('Stats', ['scenario', 'calls', 'errors', 'p50', 'p99', 'rate'])):
+    """
+    The result of a scenario: the number of calls and failed calls, the median
+    and 99th percentile seconds a call took and the calls per second
+    """
+    __slots__ = ()
+
+    def as_dict(self):
+        """
+        :return: The stats with the latencies in milliseconds
+        :rtype: dict
+        """
+        return {'scenario': self.scenario, 'calls': self.calls, 'errors': self.errors,
+                'p50_ms': round(self.p50 * 1000, 3), 'p99_ms': round(self.p99 * 1000, 3),
+                'calls_per_second': round(self.rate, 1)}
+
+
+def percentile(latencies, fraction):
+    """
+    :param latencies: The latencies, sorted
+    :type latencies: list(float)
+    :param fraction: The percentile as a fraction, 0.99 for p99
+    :type fraction: float
+    :return: The nearest-rank percentile, 0 without latencies
+    :rtype: float
+    """
+    if not latencies:
+        return 0.0
+    rank = max(int(round(fraction * len(latencies) + 0.5)) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+def measure(name, call, iterations, callers=1):
+    """
+    Calls call iterations times from each of callers threads
+    :param name: The scenario measured
+    :type name: str
+    :param call: The operation measured, a failure raises
+    :type call: callable
+    :param iterations: The number of calls made by each caller
+    :type iterations: int
+    :param callers: The number of threads calling at once
+    :type callers: int
+    :return: The stats of the calls
+    :rtype: Stats
+    """
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def caller():
+        own_latencies, own_errors = [], 0
+        start_gate.wait()
+        for _ in range(iterations):
+            start = timeit.default_timer()
+            try:
+                call()
+            except Exception:
+                own_errors += 1
+            own_latencies.append(timeit.default_timer() - start)
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    start = timeit.default_timer()
+    start_gate.set()
+    for thread in threads:
+        thread.join()
+    elapsed = timeit.default_timer() - start
+
+    latencies.sort()
+    return Stats(name, len(latencies), errors[0], percentile(latencies, 0.5), percentile(latencies, 0.99),
+                 len(latencies) / elapsed if elapsed > 0 else 0.0)
+
+
+def _healthy_farm(options):
+    """
+    :param options: The parsed command line
+    :return: A farm of healthy text and JSON servers with lognormal latency
+    :rtype: benchmark.farm.EchoServerFarm
+    """
+    echo_farm = farm.EchoServerFarm()
+    profile = farm.Profile(latency=farm.lognormal(options.latency_ms / 1000.0))
+    echo_farm.add(farm.TEXT, profile, options.servers)
+    echo_farm.add(farm.JSON, profile, options.servers)
+    return echo_farm
+
+
+def cold_cache(options):
+    """
+    IPProvider and MultisourceIPProvider looking up with an expired cache
+    every call, the cost of going to the sources
+    """
+    with _healthy_farm(options) as echo_farm:
+        provider = echoip.providers.IPProvider(echo_farm.sources())
+        yield measure('ipprovider-cold', provider.refresh, options.iterations)
+        provider = echoip.providers.MultisourceIPProvider(echo_farm.sources(), concurrent=True)
+        yield measure('multisource-cold', provider.refresh, options.iterations)
+
+
+def warm_cache(options):
+    """
+    IPProvider answering from a valid cache, the cost of the library alone
+    """
+    with _healthy_farm(options) as echo_farm:
+        provider = echoip.providers.IPProvider(echo_farm.sources())
+        provider.get_ip()
+        yield measure('ipprovider-warm', provider.get_ip, options.iterations * 100)
+        provider.get_info(['country'])
+        yield measure('ipprovider-warm-info', lambda: provider.get_info(['country']), options.iterations * 100)
+
+
+def concurrent_callers(options):
+    """
+    Several threads sharing one provider, refreshing it or reading its cache
+    """
+    with _healthy_farm(options) as echo_farm:
+        provider = echoip.providers.IPProvider(echo_farm.sources())
+        yield measure('ipprovider-concurrent-cold', provider.refresh, options.iterations, options.callers)
+        provider = echoip.providers.MultisourceIPProvider(echo_farm.sources(), concurrent=True)
+        yield measure('multisource-concurrent-cold', provider.refresh, options.iterations, options.callers)
+        yield measure('multisource-concurrent-warm', provider.get_ip, options.iterations * 100, options.callers)
+
+
+def source_factory(options):
+    """
+    Building a provider from the sources of an IPSourceFactory for every
+    lookup, the sources sharing the factory's pooled transport
+    """
+    with _healthy_farm(options) as echo_farm:
+        factory = echo_farm.factory()
+
+        def lookup():
+            provider = echoip.providers.MultisourceIPProvider(list(factory.get_sources()), concurrent=True)
+            return provider.get_ip()
+        yield measure('factory-multisource', lookup, options.iterations)
+
+
+def degraded(options):
+    """
+    Half of the servers fail some requests and leave others hanging until the
+    source timeouts, provider deadlines and circuit breakers step in
+    """
+    latency = options.latency_ms / 1000.0
+    with farm.EchoServerFarm() as echo_farm:
+        healthy = farm.Profile(latency=farm.lognormal(latency))
+        flaky = farm.Profile(latency=farm.lognormal(latency * 4, 1.0), error_rate=0.3, hang_rate=0.1,
+                             hang_seconds=options.hang_seconds)
+        for kind in (farm.TEXT, farm.JSON):
+            echo_farm.add(kind, flaky, max(options.servers // 2, 1))
+            echo_farm.add(kind, healthy, max(options.servers - options.servers // 2, 1))
+        timeout = (options.timeout, options.timeout)
+
+        provider = echoip.providers.IPProvider(echo_farm.sources(timeout=timeout), deadline=options.deadline)
+        yield measure('ipprovider-degraded', provider.refresh, options.iterations)
+        provider = echoip.providers.MultisourceIPProvider(echo_farm.sources(timeout=timeout), concurrent=True,
+                                                          deadline=options.deadline)
+        yield measure('multisource-degraded', provider.refresh, options.iterations)
+        yield measure('multisource-degraded-concurrent', provider.refresh, options.iterations, options.callers)
+
+
+SCENARIOS = collections.OrderedDict([('cold', cold_cache),
+                                     ('warm', warm_cache),
+                                     ('concurrent', concurrent_callers),
+                                     ('factory', source_factory),
+                                     ('degraded', degraded)])
+
+
+def parse_args(argv=None):
+    """
+    :param argv: The command line arguments, sys.argv by default
+    :type argv: list(str)
+    :return: The parsed options
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Benchmark echoip against a local farm of fake echo servers.')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='a scenario to run, may be repeated (default: all)')
+    parser.add_argument('--servers', type=int, default=3, help='the servers of each kind, text and JSON')
+    parser.add_argument('--iterations', type=int, default=50, help='the calls made by each caller')
+    parser.add_argument('--callers', type=int, default=8, help='the threads of the concurrent scenarios')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='the median latency of the servers')
+    parser.add_argument('--timeout', type=float, default=0.5, help='the source timeouts of the degraded scenario')
+    parser.add_argument('--deadline', type=float, default=1.0, help='the provider deadline of the degraded scenario')
+    parser.add_argument('--hang-seconds', type=float, default=5.0, help='how long hanging requests hang')
+    parser.add_argument('--seed', type=int, default=None, help='seeds the latencies and failures')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.seed is not None:
+        random.seed(options.seed)
+
+    if not options.json:
+        print('{:<32} {:>7} {:>7} {:>10} {:>10} {:>10}'.format('scenario', 'calls', 'errors', 'p50 ms', 'p99 ms',
+                                                              'calls/s'))
+    for name in options.scenario or list(SCENARIOS):
+        for stats in SCENARIOS[name](options):
+            if options.json:
+                print(json.dumps(stats.as_dict(), sort_keys=True))
+            else:
+                print('{:<32} {:>7} {:>7} {:>10.3f} {:>10.3f} {:>10.1f}'.format(
+                    stats.scenario, stats.calls, stats.errors, stats.p50 * 1000, stats.p99 * 1000, stats.rate))
+            sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
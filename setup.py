@@ -7,7 +7,9 @@ setup(
     package_dir={'': 'src'},
     
     include_package_data = True,
-    install_requires=['mock>=1.0.1', 'ipaddress>=1.0', 'requests>=2.5.0', 'zope.interface>=4.1.1'],
+    install_requires=['futures>=3.0.0; python_version < "3.2"', 'mock>=1.0.1', 'ipaddress>=1.0', 'requests>=2.5.0', 'six>=1.8.0',
+                      'zope.interface>=4.1.1'],
+    extras_require={'async': ['aiohttp>=3.0']},
     tests_require=['requests-mock>=0.5.1'],
     test_suite='test',
 
@@ -0,0 +1,716 @@
+"""
+Asynchronous counterparts of the sources and providers for services
+running on an asyncio event loop. Requests are made with aiohttp so
+that a lookup never blocks the loop. Requires Python 3.5+ and aiohttp
+(install the ``async`` extra).
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import asyncio
+import collections
+import time
+
+import aiohttp
+import zope.interface
+from zope.interface.declarations import implementer_only
+
+from . import caches
+from . import policies
+from . import providers
+from . import sources
+from . import tracing
+from . import watchers
+
+# asyncio.current_task() is new in Python 3.7, earlier versions have Task.current_task()
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class IAsyncIPSource(zope.interface.Interface):
+    """
+    The asynchronous IPSource provides the IP address from an outside
+    API through a coroutine. Any other information provided by the API
+    is stored in the info dict.
+    """
+
+    def __init__(self):
+        """
+        Empty Constructor that shouldn't be ran for PyLint
+        """
+
+    def fetch(self, timeout=None):
+        """
+        Coroutine that performs a refresh from source and returns the FetchResult snapshot.
+        When timeout is given the fetch should not take longer than that many seconds.
+        """
+
+    ip_address = zope.interface.Attribute("""The external IP address from the last fetch""")
+    info = zope.interface.Attribute("""A Dict of any other information returned by the API""")
+    source_id = zope.interface.Attribute("""A string identifying the source (usually the URL)""")
+
+
+class AsyncHTTPTransport(object):
+    """
+    The AsyncHTTPTransport holds a pooled aiohttp.ClientSession shared by
+    asynchronous sources. The session is created on first use so that it
+    is bound to the running event loop.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, keepalive_timeout=15):
+        """
+        Constructor
+
+        :param limit: the maximum number of simultaneous connections
+        :type limit: int
+        :param limit_per_host: the maximum number of simultaneous connections per host
+        :type limit_per_host: int
+        :param keepalive_timeout: the seconds an idle connection is kept alive
+        :type keepalive_timeout: float
+        """
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    async def get_text(self, url, reader=None, **kwargs):
+        """
+        Performs a GET and returns the decoded body
+        :param url: The URL to get
+        :type url: str
+        :param reader: collects the body chunk by chunk, as the body readers of the
+        sources do, and ends the read once its feed() returns True; the whole body
+        is read if None
+        :param kwargs: Keyword arguments passed on to aiohttp.ClientSession.get
+        :return: The response body
+        :rtype: str
+        """
+        async with self._get_session().get(url, **kwargs) as response:
+            if reader is None:
+                return await response.text()
+            async for chunk in response.content.iter_chunked(sources._READ_CHUNK_SIZE):
+                if reader.feed(chunk):
+                    # Drops the connection rather than reading the rest of the body
+                    response.close()
+                    break
+            return reader.text(response.charset)
+
+    async def close(self):
+        """
+        Closes the pooled session and its connections
+        """
+        session, self._session = self._session, None
+        if session is not None:
+            await session.close()
+
+    def _get_session(self):
+        """
+        :return: The pooled session, created if needed
+        :rtype: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host,
+                                             keepalive_timeout=self._keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+
+class _AsyncSourceMixin(object):
+    """
+    Replaces the blocking fetch of a source with a coroutine. Parsing is
+    left to the synchronous source class it is mixed into.
+    """
+
+    @property
+    def ip_address(self):
+        """
+        Returns the IP from the last fetch, None until fetch() has been awaited.
+        :return: The IP
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        return self._ip_address
+
+    @property
+    def info(self):
+        """
+        Returns the additional information from the last fetch, None until
+        fetch() has been awaited.
+        :return: any additional information returned by the API
+        :rtype: echoip.sources.FrozenInfo
+        """
+        return self._info
+
+    async def fetch(self, timeout=None):
+        """
+        Performs a refresh from source
+        :param timeout: the seconds this fetch may take, lowering the configured
+        connect and read timeouts
+        :type timeout: float
+        :return: The snapshot of this fetch
+        :rtype: echoip.sources.FetchResult
+        """
+        start = time.time()
+        with tracing.stage(tracing.REQUEST, source_id=self.source_id):
+            text = await self._get(timeout)
+        ip_address, info = self._parse(text)
+        return self._store_result(ip_address, info, start)
+
+    async def _get(self, timeout=None):
+        """
+        Performs the GET against the source URL through the configured transport
+        :param timeout: the seconds the request may take
+        :type timeout: float
+        :return: The response body, read up to the end of the answer
+        :rtype: str
+        """
+        connect, read = self._request_timeout(timeout)
+        kwargs = {'headers': {"User-Agent": sources.USER_AGENT},
+                  'timeout': aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)}
+        if self.transport is not None:
+            return await self.transport.get_text(self._ip_url, self._body_reader(), **kwargs)
+
+        transport = AsyncHTTPTransport()
+        try:
+            return await transport.get_text(self._ip_url, self._body_reader(), **kwargs)
+        finally:
+            await transport.close()
+
+
+@implementer_only(IAsyncIPSource)
+class AsyncSimpleIPSource(_AsyncSourceMixin, sources.SimpleIPSource):
+    """
+    Asynchronous SimpleIPSource for providers like curlmyip.com that return
+    plain-text responses containing only the IP.
+    """
+
+
+@implementer_only(IAsyncIPSource)
+class AsyncJSONIPSource(_AsyncSourceMixin, sources.JSONIPSource):
+    """
+    Asynchronous JSONIPSource for providers that return JSON responses like ip-api.com.
+    """
+
+
+@implementer_only(IAsyncIPSource)
+class AsyncLocalInterfaceIPSource(sources.LocalInterfaceIPSource):
+    """
+    Asynchronous LocalInterfaceIPSource. The lookup does not touch the network
+    and returns at once, so it is run on the loop.
+    """
+
+    async def fetch(self, timeout=None):
+        """
+        Looks up the local address used to reach the internet
+        :param timeout: Unused, the lookup does not touch the network
+        :type timeout: float
+        :return: The snapshot of this fetch
+        :rtype: echoip.sources.FetchResult
+        """
+        return super(AsyncLocalInterfaceIPSource, self).fetch(timeout)
+
+
+class AsyncIPSourceFactory(sources.IPSourceFactory):
+    """
+    A Factory that generates IAsyncIPSource providers. The built-in and any
+    added SimpleIPSource, JSONIPSource or LocalInterfaceIPSource are generated
+    as their asynchronous counterparts and share one AsyncHTTPTransport.
+    """
+    _source_interface = IAsyncIPSource
+    _async_source_classes = {sources.SimpleIPSource: AsyncSimpleIPSource,
+                             sources.JSONIPSource: AsyncJSONIPSource,
+                             sources.LocalInterfaceIPSource: AsyncLocalInterfaceIPSource}
+
+    def add_source(self, source_class, *constructor_args, **options):
+        """
+        Adds a source to the factory provided it's type and constructor arguments
+        :param source_class: The class used to instantiate the source
+        :type source_class: type
+        :param constructor_args: Arguments to be passed into the constructor
+        :type constructor_args: Iterable
+        :param info_keys: keyword only, the info keys the source returns
+        :type info_keys: Iterable
+        """
+        source_class = self._async_source_classes.get(source_class, source_class)
+        super(AsyncIPSourceFactory, self).add_source(source_class, *constructor_args, **options)
+
+    @staticmethod
+    def _build_transport():
+        """
+        :return: The transport shared by generated sources when none is given
+        :rtype: AsyncHTTPTransport
+        """
+        return AsyncHTTPTransport()
+
+
+class AsyncIPProvider(providers.IPProvider):
+    """
+    The asynchronous IPProvider takes one or more IAsyncIPSources and returns the
+    results from them with the same caching as the IPProvider. get_ip and get_info
+    are coroutines. Tasks that find the cache stale at the same time share a single
+    fetch from the sources. With a StaleWhileRevalidate policy a stale answer is
+    served while a background task refreshes it, and with a HedgingPolicy slow
+    sources are hedged by tasks fetching from the next sources.
+    """
+    _source_interface = IAsyncIPSource
+    _source_errors = (ValueError, aiohttp.ClientError, asyncio.TimeoutError, policies.CircuitOpenError,
+                      policies.DeadlineExpiredError)
+    _timeout_errors = (asyncio.TimeoutError,)
+
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the arguments of echoip.providers.IPProvider
+        """
+        super(AsyncIPProvider, self).__init__(*args, **kwargs)
+        self._refreshes = dict()
+
+    async def get_ip(self):
+        """
+        Round robin through the configured providers until one returns an IP, then cache it
+        :return: the current ip
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        with self._cache.lock:
+            if self._cache.lookup() == caches.IPCache.HIT or self._serve_stale(None, self._ip_cache_stale):
+                return self._cache.ip_address
+        return (await self._refresh(None, self._ip_cache_stale))[0]
+
+    async def get_info(self, required_info_keys=None):
+        """
+        Round robin through the configured providers until one returns the keys
+        required, then cache it
+        :param required_info_keys: The keys required for the fetch to be valid
+        :type required_info_keys: list(tuple)
+        :return: The info dictionary, merged from the sources that provided it
+        :rtype: dict
+        """
+        is_stale = lambda: self._info_cache_stale(required_info_keys)
+        with self._cache.lock:
+            if self._cache.lookup(required_info_keys, info=True) == caches.IPCache.HIT:
+                return self._cache.info
+            if self._serve_stale(required_info_keys, is_stale):
+                return self._cache.stale_info
+        return (await self._refresh(required_info_keys, is_stale))[1]
+
+    async def refresh(self, required_info_keys=None):
+        """
+        Fetches from the sources even if the cache is still valid and caches the result
+        :param required_info_keys: The keys required for the fetch to be valid
+        :type required_info_keys: list(tuple)
+        :return: The IP and info now cached
+        :rtype: tuple
+        """
+        return await self._refresh(required_info_keys, lambda: True)
+
+    async def _refresh(self, required_info_keys, is_stale):
+        """
+        Fetches from the sources and caches the result. Concurrent refreshes for the
+        same required keys await one shared fetch.
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        :return: The IP and info now cached
+        :rtype: tuple
+        """
+        key = providers._flight_key(required_info_keys)
+        task = self._refreshes.get(key)
+        if task is None:
+            task = self._refreshes[key] = asyncio.ensure_future(self._fetch_and_store(required_info_keys, is_stale))
+            task.add_done_callback(lambda _: self._refreshes.pop(key, None))
+        # Shielded so that one cancelled caller does not cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    def _start_revalidation(self, required_info_keys, is_stale):
+        """
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        :return: The task refreshing the cache
+        :rtype: asyncio.Task
+        """
+        return asyncio.ensure_future(self._revalidate(required_info_keys, is_stale))
+
+    async def _revalidate(self, required_info_keys, is_stale):
+        """
+        Refreshes the cache in the background; on failure the cached answer is kept
+        and the policy backs off the next refresh
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        """
+        try:
+            await self._refresh(required_info_keys, is_stale)
+        except Exception:
+            self._stale_while_revalidate.record_failure()
+        else:
+            self._stale_while_revalidate.record_success()
+        finally:
+            self._revalidations.pop(providers._flight_key(required_info_keys), None)
+
+    async def _fetch_and_store(self, required_info_keys, is_stale):
+        """
+        Uses the record in the cache backend if it is fresh, else fetches from the
+        sources. The backend is not locked as its lock would block the event loop,
+        so processes sharing it may occasionally refresh at the same time.
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        :return: The IP and info now cached
+        :rtype: tuple
+        """
+        self._cache.load()
+        if is_stale():
+            fetch_keys = self._cache.missing_keys(required_info_keys)
+            if self._cache.store(await self._fetch_from_sources(fetch_keys)) and fetch_keys != required_info_keys:
+                # The IP changed, so the info cached for the previous IP is gone
+                self._cache.store(await self._fetch_from_sources(required_info_keys))
+        return self._cache.ip_address, self._cache.info
+
+    async def _fetch_from_sources(self, required_info_keys=None):
+        """
+        Internal coroutine that fetches from configured sources.
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :return: The first valid response
+        :rtype: echoip.sources.FetchResult
+        """
+        deadline = providers._Deadline(self._deadline)
+        if self._hedging is not None:
+            return await self._fetch_hedged(deadline, required_info_keys)
+
+        srces = self._ordered_sources(required_info_keys)
+        for index, source in enumerate(srces):
+            if deadline.expired:
+                break
+            try:
+                result = await self._fetch_source(source, deadline.share(len(srces) - index), deadline)
+
+                if self._verify_required_keys(result.info, required_info_keys):
+                    return result
+
+            except self._source_errors:
+                continue
+
+        raise providers.NullResponseFromSourcesError("No sources returned a valid response{}."
+                                                     .format(deadline.describe()))
+
+    async def _fetch_hedged(self, deadline, required_info_keys=None):
+        """
+        Fetches from the sources in order, starting the next source when the last
+        one started has not answered within the hedging delay or has failed, and
+        returns the first valid response. The fetches still running are cancelled.
+        :param deadline: The time left for the lookup
+        :type deadline: echoip.providers._Deadline
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :return: The first valid response
+        :rtype: echoip.sources.FetchResult
+        """
+        remaining = collections.deque(self._ordered_sources(required_info_keys))
+        pending = dict()
+
+        def start_next():
+            source = remaining.popleft()
+            task = asyncio.ensure_future(self._fetch_source(source, deadline.remaining(), deadline))
+            task.add_done_callback(lambda t: self._record_hedged_latency(source, t))
+            pending[task] = source
+            return source, time.time()
+
+        try:
+            last_started = start_next() if remaining else None
+            while pending and not deadline.expired:
+                timeout = deadline.remaining()
+                can_hedge = remaining and len(pending) <= self._hedging.max_hedges
+                if can_hedge:
+                    delay = self._hedging.hedge_delay(last_started[0])
+                    if delay is not None:
+                        delay = max(0, delay - (time.time() - last_started[1]))
+                        timeout = delay if timeout is None else min(timeout, delay)
+
+                done, _ = await asyncio.wait(list(pending), timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del pending[task]
+                    try:
+                        result = task.result()
+                    except self._source_errors:
+                        continue
+                    if self._verify_required_keys(result.info, required_info_keys):
+                        return result
+
+                # Hedge a slow source, or move on from failed ones
+                if remaining and (not done or not pending) and not deadline.expired:
+                    last_started = start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        raise providers.NullResponseFromSourcesError("No sources returned a valid response{}."
+                                                     .format(deadline.describe()))
+
+    async def _fetch_source(self, source, timeout=None, deadline=None):
+        """
+        Fetches once from a source, cancelling the fetch if it outlasts the timeout,
+        and records the outcome in the source's statistics
+        :param source: The source to fetch from
+        :type source: IAsyncIPSource provider
+        :param timeout: the seconds the fetch may take, None for the source's own timeouts
+        :type timeout: float
+        :param deadline: the deadline of the lookup the timeout was taken from
+        :type deadline: echoip.providers._Deadline
+        :return: The result of the fetch
+        :rtype: echoip.sources.FetchResult
+        """
+        self._acquire(source, deadline)
+        start = time.time()
+        try:
+            if timeout is None:
+                result = await source.fetch()
+            else:
+                result = await asyncio.wait_for(source.fetch(timeout=timeout), timeout)
+            self._verify_ip_version(source, result)
+        except self._source_errors as error:
+            self._record_failure(source, error, time.time() - start, deadline)
+            raise
+        self._record_success(source, time.time() - start, result)
+        return result
+
+
+class AsyncMultisourceIPProvider(AsyncIPProvider):
+    """
+    The asynchronous MultisourceIPProvider returns the IP once the minimum number
+    of sources agree on it, merging their additional info into one dictionary.
+    """
+
+    def __init__(self, source_list=None, cache_ttl=3600, min_source_agreement=2,
+                 concurrent=False, max_workers=None, deadline=None, scheduler=None,
+                 circuit_breaker=policies.CircuitBreaker, stale_while_revalidate=None, cache_backend=None,
+                 info_ttl=None, clock=None, ip_version=None, metrics=None):
+        """
+        :param source_list: The list of sources to bootstrap the provider with
+        :type source_list: list of IAsyncIPSource providers
+        :param cache_ttl: the seconds the ip cache remains valid
+        :param min_source_agreement: The minimum number of source that must be
+        in agreement for an ip_fetch
+        :type min_source_agreement: int
+        :param concurrent: query the sources at the same time and return as soon
+        as enough of them agree, cancelling the remaining requests
+        :type concurrent: bool
+        :param max_workers: the maximum number of sources queried at once in
+        concurrent mode, defaults to the number of sources
+        :type max_workers: int
+        :param deadline: the seconds a lookup may take across all sources queried
+        :type deadline: float
+        :param scheduler: decides the order the sources are queried in
+        :type scheduler: echoip.policies.WeightedScheduler
+        :param circuit_breaker: a callable creating the circuit breaker of each source
+        :type circuit_breaker: callable
+        :param stale_while_revalidate: serves stale answers while they are refreshed
+        :type stale_while_revalidate: echoip.policies.StaleWhileRevalidate
+        :param cache_backend: where the last lookup is kept, in memory by default
+        :type cache_backend: echoip.caches.ICacheBackend provider
+        :param info_ttl: the seconds each cached info field remains valid, defaults to cache_ttl
+        :type info_ttl: int
+        :param clock: returns the current time in seconds for the cache
+        :type clock: callable
+        :param ip_version: 4 or 6 to only accept answers of that IP version
+        :type ip_version: int
+        :param metrics: records the fetches, cache lookups and agreement rounds
+        :type metrics: echoip.metrics.ProviderMetrics
+        """
+        super(AsyncMultisourceIPProvider, self).__init__(source_list, cache_ttl, deadline=deadline,
+                                                         scheduler=scheduler, circuit_breaker=circuit_breaker,
+                                                         stale_while_revalidate=stale_while_revalidate,
+                                                         cache_backend=cache_backend, info_ttl=info_ttl,
+                                                         clock=clock, ip_version=ip_version, metrics=metrics)
+        self._min_source_agreement = min_source_agreement
+        self._concurrent = concurrent
+        self._max_workers = max_workers
+
+    async def _fetch_from_sources(self, required_info_keys=None):
+        if self.num_sources < self._min_source_agreement:
+            raise providers.InsufficientSourcesForAgreementError(
+                "{} sources are required but only {} configured"
+                .format(self._min_source_agreement, self.num_sources))
+        consensus = providers._Consensus(self._min_source_agreement, required_info_keys)
+        deadline = providers._Deadline(self._deadline)
+        srces = self._ordered_sources()
+
+        # The stage covers the whole round, the fetches as well as the agreement
+        with tracing.stage(tracing.CONSENSUS, min_source_agreement=self._min_source_agreement):
+            if self._concurrent:
+                agreement = await self._fetch_concurrently(srces, consensus, deadline)
+            else:
+                agreement = await self._fetch_sequentially(srces, consensus, deadline)
+
+        self._record_consensus(agreement is not None)
+        if agreement is None:
+            raise providers.InsufficientSourcesForAgreementError(
+                "An insufficient number of sources were able to agree{}.".format(deadline.describe()))
+        return agreement
+
+    async def _fetch_sequentially(self, srces, consensus, deadline):
+        """
+        Fetches from each source in turn until the sources agree
+        :param srces: The sources to fetch from in order
+        :type srces: list of IAsyncIPSource providers
+        :param consensus: The tally of results
+        :type consensus: echoip.providers._Consensus
+        :param deadline: The time left for the lookup
+        :type deadline: echoip.providers._Deadline
+        :return: The agreed result, or None
+        :rtype: echoip.sources.FetchResult or None
+        """
+        for index, source in enumerate(srces):
+            if deadline.expired:
+                break
+            try:
+                result = await self._fetch_source(source, deadline.share(len(srces) - index), deadline)
+            except self._source_errors:
+                continue
+            agreement = consensus.add(result)
+            if agreement is not None:
+                return agreement
+        return None
+
+    async def _fetch_concurrently(self, srces, consensus, deadline):
+        """
+        Fetches from all sources at once, at most max_workers at a time, and
+        cancels the remaining requests as soon as the sources agree
+        :param srces: The sources to fetch from
+        :type srces: list of IAsyncIPSource providers
+        :param consensus: The tally of results
+        :type consensus: echoip.providers._Consensus
+        :param deadline: The time left for the lookup
+        :type deadline: echoip.providers._Deadline
+        :return: The agreed result, or None
+        :rtype: echoip.sources.FetchResult or None
+        """
+        semaphore = asyncio.Semaphore(self._max_workers or len(srces))
+
+        async def bounded_fetch(source):
+            async with semaphore:
+                return await self._fetch_source(source, deadline.remaining(), deadline)
+
+        tasks = [asyncio.ensure_future(bounded_fetch(source)) for source in srces]
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=deadline.remaining()):
+                try:
+                    result = await next_done
+                except self._source_errors:
+                    if deadline.expired:
+                        return None
+                    continue
+                agreement = consensus.add(result)
+                if agreement is not None:
+                    return agreement
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class AsyncIPWatcher(watchers.IPWatcher):
+    """
+    The asynchronous IPWatcher polls an async provider from an asyncio task.
+    Callbacks may be plain functions or coroutine functions, which are awaited.
+    """
+
+    def __init__(self, provider, polling=None, required_info_keys=None):
+        """
+        Constructor
+
+        :param provider: The provider polled for the IP
+        :type provider: AsyncIPProvider
+        :param polling: spaces the polls, AdaptivePolling with its defaults if not given
+        :type polling: echoip.policies.AdaptivePolling
+        :param required_info_keys: The info keys fetched with every poll
+        :type required_info_keys: list(tuple)
+        """
+        super(AsyncIPWatcher, self).__init__(provider, polling, required_info_keys)
+        self._task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    @property
+    def running(self):
+        """
+        :return: True while the watcher task runs
+        :rtype: bool
+        """
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """
+        Starts polling from a task on the running loop, beginning with an immediate poll
+        """
+        if not self.running:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout=None):
+        """
+        Stops polling, cancelling the watcher task unless called from a callback
+        :param timeout: Unused, the task is cancelled rather than waited for
+        :type timeout: float
+        """
+        task, self._task = self._task, None
+        if task is None or task is _current_task():
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def check(self):
+        """
+        Polls the provider once and calls the callbacks if the IP changed
+        :return: The change, or None if the IP did not change
+        :rtype: echoip.watchers.IPChange
+        """
+        try:
+            ip_address, info = await self._provider.refresh(self._required_info_keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._polling.record_failure()
+            raise
+        change = self._observe(ip_address, info)
+        if change is not None:
+            await self._notify(change)
+        return change
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # Any failure, not only a failed lookup, is retried at the next poll
+                self._last_error = error
+            await asyncio.sleep(self._polling.next_delay())
+
+    async def _notify(self, change):
+        """
+        Calls every callback with the change, awaiting coroutine callbacks and
+        keeping the error of a failing one
+        :param change: The change
+        :type change: echoip.watchers.IPChange
+        """
+        for callback in list(self._callbacks):
+            try:
+                result = callback(change)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as error:
+                self._last_error = error
@@ -0,0 +1,590 @@
+"""
+The IPCache holds the last IP looked up by a provider and validates it for
+get_ip and get_info alike, counting hits, misses and expirations. Its
+InfoCache keeps the info of the IP field by field, each with the source it
+came from and when. Records are written through to a cache backend: the
+default keeps them in memory; the FileCacheBackend keeps them in a file so
+that every process on a host shares one lookup per cache_ttl.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import collections
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import ipaddress
+import six
+import zope.interface
+from zope.interface.declarations import implementer
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+# noinspection PyMethodMayBeStatic
+class ICacheBackend(zope.interface.Interface):
+    """
+    Cache backend (zopes) interface specifying what public methods
+    must be provided by a cache backend
+    """
+    def load(self):
+        """Returns the cached CacheRecord, or None if nothing is cached"""
+
+    def store(self, record):
+        """Replaces the cached record"""
+
+    def clear(self):
+        """Removes the cached record"""
+
+    def lock(self):
+        """
+        Returns a context manager held while a lookup refreshes the cache, so that
+        only one of the providers sharing the backend queries the sources at a time
+        """
+
+    def scoped(self, name):
+        """
+        Returns a backend of the same kind keeping a separate record under the
+        name, for providers that look up different IPs, such as those of the
+        egress paths of an EgressIPProvider. The same name gives the same record.
+        """
+
+
+class CacheRecord(collections.namedtuple('CacheRecord',
+                                         ['ip_address', 'info', 'timestamp', 'source_id', 'fields'])):
+    """
+    The cached result of a lookup: the IP, its info, when it was fetched and the
+    id of the source (or comma separated sources) it came from. fields keeps
+    every info field with its own source and fetch time, so that a provider
+    adopting the record keeps the provenance and expiry of each field; None
+    for records written without it, whose fields all take the record's.
+    """
+    __slots__ = ()
+
+    def __new__(cls, ip_address, info, timestamp, source_id, fields=None):
+        return super(CacheRecord, cls).__new__(cls, ip_address, info, timestamp, source_id, fields)
+
+
+class CacheStats(collections.namedtuple('CacheStats', ['hits', 'misses', 'expirations', 'stale_hits'])):
+    """
+    The lookup counters of an IPCache: lookups answered from the cache, lookups
+    finding nothing (or not the required info) cached, lookups finding the cache
+    expired and expired answers served anyway while being revalidated.
+    """
+    __slots__ = ()
+
+
+class IPCache(object):
+    """
+    The IPCache is a provider's cache of its last lookup: the IP, when it was
+    fetched and the info of the IP field by field. get_ip and get_info validate
+    it through the one status method, and their lookups are counted. Stored
+    results are written through to the cache backend and fresher records found
+    there are adopted. The clock can be replaced to test expiry, and an observer
+    is told the outcome of every counted lookup.
+    """
+    HIT = 'hit'
+    MISS = 'miss'
+    EXPIRED = 'expired'
+    STALE = 'stale'
+
+    def __init__(self, ttl=3600, info_ttl=None, backend=None, clock=None, observer=None):
+        """
+        Constructor
+
+        :param ttl: the seconds the cached IP remains valid
+        :type ttl: float
+        :param info_ttl: the seconds each cached info field remains valid, defaults to ttl
+        :type info_ttl: float
+        :param backend: where records are written through to, in memory by default
+        :type backend: ICacheBackend provider
+        :param clock: returns the current time in seconds, time.time by default
+        :type clock: callable
+        :param observer: called with HIT, MISS, EXPIRED or STALE for every counted lookup
+        :type observer: callable
+        """
+        self._ttl = ttl
+        self._info_ttl = info_ttl if info_ttl is not None else ttl
+        self._backend = backend if backend is not None else MemoryCacheBackend()
+        self._clock = clock if clock is not None else time.time
+        self._observer = observer
+
+        self._ip_address = None
+        self._timestamp = 0
+        self._info = InfoCache()
+        self._counters = dict.fromkeys(CacheStats._fields, 0)
+        self.lock = threading.RLock()
+
+    @property
+    def backend(self):
+        """
+        :return: The backend records are written through to
+        :rtype: ICacheBackend provider
+        """
+        return self._backend
+
+    @property
+    def ip_address(self):
+        """
+        :return: The cached IP, valid or not, None if nothing is cached
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        return self._ip_address
+
+    @property
+    def info(self):
+        """
+        :return: The info fields that have not expired
+        :rtype: dict
+        """
+        with self.lock:
+            return self._info.fields(self._info_ttl, self._clock())
+
+    @property
+    def stale_info(self):
+        """
+        :return: Every cached info field, expired or not
+        :rtype: dict
+        """
+        with self.lock:
+            return self._info.fields()
+
+    @property
+    def provenance(self):
+        """
+        :return: Every cached info field with its value, source id and fetch time
+        :rtype: dict(str, InfoField)
+        """
+        with self.lock:
+            return self._info.provenance
+
+    @property
+    def stats(self):
+        """
+        :return: The lookup counters
+        :rtype: CacheStats
+        """
+        with self.lock:
+            return CacheStats(**self._counters)
+
+    def age(self):
+        """
+        :return: The seconds since the cached IP was fetched
+        :rtype: float
+        """
+        return self._clock() - self._timestamp
+
+    def is_valid(self):
+        """
+        :return: True if an IP is cached and younger than the ttl
+        :rtype: bool
+        """
+        with self.lock:
+            return self._ip_address is not None and self.age() < self._ttl
+
+    def status(self, required_info_keys=None, info=False):
+        """
+        Validates the cache for a lookup without counting it
+        :param required_info_keys: The info keys the lookup requires
+        :type required_info_keys: list(str, list(str))
+        :param info: True for an info lookup, which misses when no info (or not the
+        required keys) is cached
+        :type info: bool
+        :return: HIT, MISS or EXPIRED
+        :rtype: str
+        """
+        with self.lock:
+            if self._ip_address is None:
+                return self.MISS
+            if not self.is_valid():
+                return self.EXPIRED
+            if info:
+                now = self._clock()
+                if required_info_keys is None and not self._info.fields(self._info_ttl, now):
+                    return self.MISS
+                if self._info.missing(required_info_keys, self._info_ttl, now):
+                    return self.MISS
+            return self.HIT
+
+    def lookup(self, required_info_keys=None, info=False):
+        """
+        Validates the cache for a lookup and counts the outcome
+        :param required_info_keys: The info keys the lookup requires
+        :type required_info_keys: list(str, list(str))
+        :param info: True for an info lookup
+        :type info: bool
+        :return: HIT, MISS or EXPIRED
+        :rtype: str
+        """
+        with self.lock:
+            status = self.status(required_info_keys, info)
+            self._count(status)
+            return status
+
+    def record_stale_hit(self):
+        """
+        Counts an expired answer served while it is revalidated
+        """
+        with self.lock:
+            self._count(self.STALE)
+
+    def _count(self, status):
+        """
+        :param status: HIT, MISS, EXPIRED or STALE
+        :type status: str
+        """
+        self._counters[{self.HIT: 'hits', self.MISS: 'misses', self.EXPIRED: 'expirations',
+                        self.STALE: 'stale_hits'}[status]] += 1
+        if self._observer is not None:
+            self._observer(status)
+
+    def missing_keys(self, required_info_keys):
+        """
+        :param required_info_keys: The info keys a lookup requires
+        :type required_info_keys: list(str, list(str))
+        :return: The required keys that are not cached, or all of them if the IP is not valid
+        :rtype: list(str, list(str))
+        """
+        with self.lock:
+            if required_info_keys is None or not self.is_valid():
+                return required_info_keys
+            return self._info.missing(required_info_keys, self._info_ttl, self._clock())
+
+    def store(self, result):
+        """
+        Caches the result of a fetch, merging its info into the info cached for
+        the same IP, and writes the record through to the backend
+        :param result: The result to cache
+        :type result: echoip.sources.FetchResult
+        :return: True if the IP changed
+        :rtype: bool
+        """
+        with self.lock:
+            changed = self._update(result.ip_address, result.info, result.source_id, self._clock())
+            record = CacheRecord(self._ip_address, self._info.fields(), self._timestamp, result.source_id,
+                                 self._info.provenance)
+        self._backend.store(record)
+        return changed
+
+    def load(self):
+        """
+        Adopts the record in the backend if it is newer than the cache, field by
+        field when the record keeps the provenance of its fields
+        """
+        record = self._backend.load()
+        with self.lock:
+            if record is None or record.timestamp <= self._timestamp:
+                return
+            if record.fields is None:
+                self._update(record.ip_address, record.info, record.source_id, record.timestamp)
+                return
+            if record.ip_address != self._ip_address:
+                self._info.clear()
+            self._ip_address = record.ip_address
+            self._timestamp = record.timestamp
+            self._info.restore(record.fields)
+
+    def invalidate(self):
+        """
+        Empties the cache and its backend
+        """
+        with self.lock:
+            self._ip_address = None
+            self._timestamp = 0
+            self._info.clear()
+        self._backend.clear()
+
+    def _update(self, ip_address, info, source_id, timestamp):
+        """
+        Caches an IP and merges its info, the caller holds the lock.
+        :param ip_address: The IP to cache
+        :type ip_address: ipaddress.IPv4Address or ipaddress.IPv6Address
+        :param info: The info returned with the IP
+        :type info: dict
+        :param source_id: The id of the source the IP and info came from
+        :type source_id: str
+        :param timestamp: When the IP was fetched
+        :type timestamp: float
+        :return: True if the IP changed, dropping the info cached for the previous IP
+        :rtype: bool
+        """
+        changed = ip_address != self._ip_address
+        if changed:
+            self._info.clear()
+        self._ip_address = ip_address
+        self._timestamp = timestamp
+        self._info.update(info, source_id, timestamp)
+        return changed
+
+
+class InfoField(collections.namedtuple('InfoField', ['value', 'source_id', 'timestamp'])):
+    """
+    A cached info value with its provenance: the id of the source it came from
+    and when it was fetched.
+    """
+    __slots__ = ()
+
+
+class InfoCache(object):
+    """
+    The InfoCache merges the info returned by several sources for one IP field by
+    field. Every field keeps its provenance and expires on its own, so a lookup
+    only needs to fetch the fields that are missing or expired.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._fields = dict()
+
+    def __len__(self):
+        return len(self._fields)
+
+    def update(self, info, source_id, timestamp):
+        """
+        Merges the info returned by a source into the cache
+        :param info: The info returned
+        :type info: dict
+        :param source_id: The id of the source that returned it
+        :type source_id: str
+        :param timestamp: When the info was fetched
+        :type timestamp: float
+        """
+        for key, value in info.items():
+            self._fields[key] = InfoField(value, source_id, timestamp)
+
+    def restore(self, fields):
+        """
+        Merges fields kept with their provenance, such as those of a record stored
+        by another provider, keeping the more recently fetched of two values
+        :param fields: The fields with their value, source id and fetch time
+        :type fields: dict(str, InfoField)
+        """
+        for key, field in fields.items():
+            current = self._fields.get(key)
+            if current is None or field.timestamp >= current.timestamp:
+                self._fields[key] = InfoField(*field)
+
+    def clear(self):
+        """
+        Removes every field, as when the IP changes
+        """
+        self._fields.clear()
+
+    def fields(self, max_age=None, now=None):
+        """
+        :param max_age: the seconds after which a field has expired, None to include every field
+        :type max_age: float
+        :param now: the current time, defaults to time.time()
+        :type now: float
+        :return: The values of the fields that have not expired
+        :rtype: dict
+        """
+        now = time.time() if now is None else now
+        return dict((key, field.value) for key, field in self._fields.items()
+                    if max_age is None or now - field.timestamp < max_age)
+
+    def missing(self, required_info_keys, max_age=None, now=None):
+        """
+        :param required_info_keys: a list of keys that are required. Lists or tuples
+        provided in this list indicate that at least one key in the set must be present.
+        :type required_info_keys: list(str, list(str))
+        :param max_age: the seconds after which a field has expired
+        :type max_age: float
+        :param now: the current time, defaults to time.time()
+        :type now: float
+        :return: The required keys (or sets of keys) that no unexpired field provides
+        :rtype: list
+        """
+        fields = self.fields(max_age, now)
+        return [key for key in required_info_keys or ()
+                if not (any(subkey in fields for subkey in key) if isinstance(key, (tuple, list))
+                        else key in fields)]
+
+    @property
+    def provenance(self):
+        """
+        :return: Every cached field with its value, source id and fetch time
+        :rtype: dict(str, InfoField)
+        """
+        return dict(self._fields)
+
+
+@implementer(ICacheBackend)
+class MemoryCacheBackend(object):
+    """
+    The MemoryCacheBackend keeps the record in memory, shared by the providers of
+    one process that are given the same backend.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._record = None
+        self._lock = threading.Lock()
+        self._scopes = dict()
+
+    def load(self):
+        """
+        :return: The cached record, or None
+        :rtype: CacheRecord
+        """
+        return self._record
+
+    def store(self, record):
+        """
+        :param record: The record to cache
+        :type record: CacheRecord
+        """
+        self._record = record
+
+    def clear(self):
+        """
+        Removes the cached record
+        """
+        self._record = None
+
+    def lock(self):
+        """
+        :return: A lock excluding concurrent refreshes in this process
+        :rtype: threading.Lock
+        """
+        return self._lock
+
+    def scoped(self, name):
+        """
+        :param name: The name of the separate record
+        :type name: str
+        :return: The backend keeping the record of the name, created if needed
+        :rtype: MemoryCacheBackend
+        """
+        with self._lock:
+            return self._scopes.setdefault(name, MemoryCacheBackend())
+
+
+@implementer(ICacheBackend)
+class FileCacheBackend(object):
+    """
+    The FileCacheBackend keeps the record as JSON in a file. Writes go to a
+    temporary file that is renamed over the cache file, so readers never see a
+    partial record, and refreshes hold an exclusive lock (flock) on a lock file
+    beside it, so many processes on a host share one lookup. Locking is skipped
+    on platforms without fcntl.
+    """
+
+    def __init__(self, path, lock_path=None):
+        """
+        Constructor
+
+        :param path: the file holding the cached record
+        :type path: str
+        :param lock_path: the file locked during refreshes, defaults to path + '.lock'
+        :type lock_path: str
+        """
+        self._path = path
+        self._lock_path = lock_path if lock_path is not None else path + '.lock'
+
+    @property
+    def path(self):
+        """
+        :return: The file holding the cached record
+        :rtype: str
+        """
+        return self._path
+
+    def load(self):
+        """
+        :return: The cached record, or None if the file is missing or unreadable
+        :rtype: CacheRecord
+        """
+        try:
+            with open(self._path) as cache_file:
+                data = json.load(cache_file)
+            fields = data.get('fields')
+            if fields is not None:
+                fields = dict((key, InfoField(value, source_id, float(timestamp)))
+                              for key, (value, source_id, timestamp) in fields.items())
+            return CacheRecord(ipaddress.ip_address(six.text_type(data['ip_address'])), data['info'],
+                               float(data['timestamp']), data.get('source_id'), fields)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, record):
+        """
+        Atomically replaces the cache file
+        :param record: The record to cache
+        :type record: CacheRecord
+        """
+        data = {'ip_address': str(record.ip_address), 'info': record.info,
+                'timestamp': record.timestamp, 'source_id': record.source_id}
+        if record.fields is not None:
+            data['fields'] = dict((key, list(field)) for key, field in record.fields.items())
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.echoip-', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.rename(tmp_path, self._path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def clear(self):
+        """
+        Removes the cache file
+        """
+        try:
+            os.unlink(self._path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Holds an exclusive lock on the lock file, blocking until other processes
+        release it
+        """
+        with open(self._lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def scoped(self, name):
+        """
+        :param name: The name of the separate record
+        :type name: str
+        :return: A backend keeping the record of the name in a file beside the cache
+        file, with its own lock file
+        :rtype: FileCacheBackend
+        """
+        return FileCacheBackend('{}.{}'.format(self._path, _scope_suffix(name)))
+
+
+def _scope_suffix(name):
+    """
+    :param name: The name of a scoped record
+    :type name: str
+    :return: A file name suffix unique to the name, readable where the name allows
+    :rtype: str
+    """
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]
+    return '{}-{}'.format(re.sub(r'[^A-Za-z0-9_.-]+', '_', name)[:40], digest)
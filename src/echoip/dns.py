@@ -0,0 +1,198 @@
+"""
+A minimal DNS stub resolver: it sends one query in a single UDP datagram
+to a configured server and returns the A, AAAA or TXT answers. It only
+covers what the DNSIPSource needs to ask a server that echoes the address
+of the client, such as myip.opendns.com on the OpenDNS resolvers.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import random
+import socket
+import struct
+import time
+
+import ipaddress
+
+TYPE_A = 1
+TYPE_TXT = 16
+TYPE_AAAA = 28
+RECORD_TYPES = {'A': TYPE_A, 'TXT': TYPE_TXT, 'AAAA': TYPE_AAAA}
+
+CLASS_IN = 1
+CLASS_CH = 3
+RECORD_CLASSES = {'IN': CLASS_IN, 'CH': CLASS_CH}
+
+_HEADER = struct.Struct('!HHHHHH')
+_QUESTION = struct.Struct('!HH')
+_RECORD = struct.Struct('!HHIH')
+_FLAG_RESPONSE = 0x8000
+_FLAG_RECURSION_DESIRED = 0x0100
+_RCODE_MASK = 0x000F
+_MAX_MESSAGE = 4096
+
+
+def build_query(query_id, name, record_type, record_class=CLASS_IN):
+    """
+    Encodes a query for a single question
+    :param query_id: The 16 bit identifier echoed by the server
+    :type query_id: int
+    :param name: The name queried
+    :type name: str
+    :param record_type: The record type, TYPE_A, TYPE_AAAA or TYPE_TXT
+    :type record_type: int
+    :param record_class: The record class, CLASS_IN or CLASS_CH
+    :type record_class: int
+    :return: The query message
+    :rtype: bytes
+    """
+    labels = [label for label in name.strip('.').split('.') if label]
+    question = bytearray()
+    for label in labels:
+        encoded = label.encode('idna')
+        if len(encoded) > 63:
+            raise ValueError("Label {} is longer than 63 octets".format(label))
+        question.append(len(encoded))
+        question.extend(encoded)
+    question.append(0)
+    return (_HEADER.pack(query_id, _FLAG_RECURSION_DESIRED, 1, 0, 0, 0) + bytes(question) +
+            _QUESTION.pack(record_type, record_class))
+
+
+def parse_response(message, query_id, record_type):
+    """
+    Decodes the answers of the requested type from a response
+    :param message: The response message
+    :type message: bytes
+    :param query_id: The identifier of the query answered
+    :type query_id: int
+    :param record_type: The record type wanted
+    :type record_type: int
+    :return: The TTL and data of each answer of the type, as an ipaddress for A
+    and AAAA records and as the joined text for TXT records
+    :rtype: list(tuple(int, object))
+    """
+    message = bytearray(message)
+    if not _answers(message, query_id):
+        raise DNSResponseError("Message is not a response to query {}".format(query_id))
+    _, flags, questions, answers, _, _ = _HEADER.unpack_from(message, 0)
+    if flags & _RCODE_MASK:
+        raise DNSResponseError("Server answered with rcode {}".format(flags & _RCODE_MASK))
+
+    try:
+        offset = _HEADER.size
+        for _ in range(questions):
+            offset = _skip_name(message, offset) + _QUESTION.size
+        records = []
+        for _ in range(answers):
+            offset = _skip_name(message, offset)
+            answer_type, _, ttl, length = _RECORD.unpack_from(message, offset)
+            offset += _RECORD.size
+            data = bytes(message[offset:offset + length])
+            offset += length
+            if len(data) != length:
+                raise DNSResponseError("Truncated record data")
+            if answer_type == record_type:
+                records.append((ttl, _decode_data(answer_type, data)))
+    except (struct.error, IndexError):
+        raise DNSResponseError("Malformed DNS response")
+    return records
+
+
+def query(server, name, record_type=TYPE_A, record_class=CLASS_IN, port=53, timeout=2.0):
+    """
+    Sends a query to a server in one datagram and waits for its response,
+    ignoring datagrams that do not answer it
+    :param server: The address or host name of the server
+    :type server: str
+    :param name: The name queried
+    :type name: str
+    :param record_type: The record type, TYPE_A, TYPE_AAAA or TYPE_TXT
+    :type record_type: int
+    :param record_class: The record class, CLASS_IN or CLASS_CH
+    :type record_class: int
+    :param port: The port of the server
+    :type port: int
+    :param timeout: The seconds to wait for the response
+    :type timeout: float
+    :return: The TTL and data of each answer of the type
+    :rtype: list(tuple(int, object))
+    """
+    family, _, _, _, address = socket.getaddrinfo(server, port, 0, socket.SOCK_DGRAM)[0]
+    query_id = random.randint(0, 0xFFFF)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        # Connected, so only datagrams from the server are received
+        sock.connect(address)
+        sock.send(build_query(query_id, name, record_type, record_class))
+        give_up = time.time() + timeout
+        while True:
+            sock.settimeout(max(give_up - time.time(), 0.001))
+            message = sock.recv(_MAX_MESSAGE)
+            if _answers(message, query_id):
+                return parse_response(message, query_id, record_type)
+    finally:
+        sock.close()
+
+
+def _answers(message, query_id):
+    """
+    :param message: A message received
+    :type message: bytes or bytearray
+    :param query_id: The identifier of the query
+    :type query_id: int
+    :return: True if the message is a response to the query
+    :rtype: bool
+    """
+    if len(message) < _HEADER.size:
+        return False
+    response_id, flags = struct.unpack_from('!HH', bytearray(message), 0)
+    return response_id == query_id and bool(flags & _FLAG_RESPONSE)
+
+
+def _skip_name(message, offset):
+    """
+    :param message: The message
+    :type message: bytearray
+    :param offset: The offset of an encoded name
+    :type offset: int
+    :return: The offset following the name
+    :rtype: int
+    """
+    while True:
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            # A compression pointer ends the name
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+
+def _decode_data(record_type, data):
+    """
+    :param record_type: The record type
+    :type record_type: int
+    :param data: The record data
+    :type data: bytes
+    :return: The address of an A or AAAA record or the text of a TXT record
+    :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address or str
+    """
+    if record_type == TYPE_A:
+        return ipaddress.IPv4Address(struct.unpack('!I', data)[0])
+    if record_type == TYPE_AAAA:
+        high, low = struct.unpack('!QQ', data)
+        return ipaddress.IPv6Address(high << 64 | low)
+    data = bytearray(data)
+    strings, offset = [], 0
+    while offset < len(data):
+        strings.append(bytes(data[offset + 1:offset + 1 + data[offset]]))
+        offset += data[offset] + 1
+    return b''.join(strings).decode('utf-8', 'replace')
+
+
+class DNSResponseError(ValueError):
+    """
+    Raised when a DNS response is malformed or reports an error
+    """
+    pass
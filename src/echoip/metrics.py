@@ -0,0 +1,372 @@
+"""
+Metrics count what providers and their sources do: the requests made to
+each source, how long they took and how they failed, how lookups were
+answered by the cache and how multisource agreement rounds ended. They are
+kept in a MetricsRegistry that renders them in the OpenMetrics text format
+for Prometheus to scrape. Providers only record metrics when given a
+ProviderMetrics, so they cost nothing otherwise.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import bisect
+import collections
+import math
+import threading
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric(object):
+    """
+    A metric family whose samples are kept per combination of label values
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Constructor
+
+        :param name: The metric name
+        :type name: str
+        :param documentation: The help text of the metric
+        :type documentation: str
+        :param labelnames: The names of the labels each sample is kept by
+        :type labelnames: tuple(str)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        """
+        :param labelvalues: The value of each label, in the order of labelnames
+        :return: The child metric keeping the samples for these label values
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("{} expects the labels {}".format(self.name, self.labelnames))
+        labelvalues = tuple(str(value) for value in labelvalues)
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def render(self):
+        """
+        :return: The lines of the metric family in the OpenMetrics text format
+        :rtype: list(str)
+        """
+        lines = ['# TYPE {} {}'.format(self.name, self.kind),
+                 '# HELP {} {}'.format(self.name, _escape(self.documentation, help_text=True))]
+        for labelvalues, child in list(self._children.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            for suffix, extra_labels, value in child.samples():
+                lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(labels + extra_labels),
+                                                _format_value(value)))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    A Counter only goes up, such as the number of requests made
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        """
+        Increments the counter of a metric without labels
+        :param amount: The amount to add
+        :type amount: float
+        """
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Histogram(_Metric):
+    """
+    A Histogram counts observations, such as latencies, in cumulative buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Constructor
+
+        :param name: The metric name
+        :type name: str
+        :param documentation: The help text of the metric
+        :type documentation: str
+        :param labelnames: The names of the labels each sample is kept by
+        :type labelnames: tuple(str)
+        :param buckets: The upper bounds of the buckets, ascending
+        :type buckets: tuple(float)
+        """
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value):
+        """
+        Observes a value in a metric without labels
+        :param value: The value observed
+        :type value: float
+        """
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        :param amount: The amount to add, not negative
+        :type amount: float
+        """
+        if amount < 0:
+            raise ValueError("Counters can only be incremented")
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        """
+        :return: The count
+        :rtype: float
+        """
+        return self._value
+
+    def samples(self):
+        return [('_total', [], self._value)]
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        :param value: The value observed
+        :type value: float
+        """
+        with self._lock:
+            self._counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._sum += value
+
+    @property
+    def count(self):
+        """
+        :return: The number of observations
+        :rtype: int
+        """
+        return sum(self._counts)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self._buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', [('le', _format_value(float(bound)))], cumulative))
+        samples.append(('_count', [], cumulative))
+        samples.append(('_sum', [], total))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    The MetricsRegistry holds metric families by name and renders them as an
+    OpenMetrics text page. Asking for a metric that exists returns it, so that
+    several providers can record into the same metrics.
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Returns the counter of the name, creating it if needed
+        :param name: The metric name, without the _total suffix
+        :type name: str
+        :param documentation: The help text of the metric
+        :type documentation: str
+        :param labelnames: The names of the labels each sample is kept by
+        :type labelnames: tuple(str)
+        :return: The counter
+        :rtype: Counter
+        """
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Returns the histogram of the name, creating it if needed
+        :param name: The metric name
+        :type name: str
+        :param documentation: The help text of the metric
+        :type documentation: str
+        :param labelnames: The names of the labels each sample is kept by
+        :type labelnames: tuple(str)
+        :param buckets: The upper bounds of the buckets, ascending
+        :type buckets: tuple(float)
+        :return: The histogram
+        :rtype: Histogram
+        """
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        """
+        :param name: The metric name
+        :type name: str
+        :return: The metric of the name, None if there is none
+        :rtype: Counter or Histogram
+        """
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        :return: Every metric in the OpenMetrics text format
+        :rtype: str
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric_class, name, documentation, labelnames, **options):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, documentation, labelnames, **options)
+            elif type(metric) is not metric_class or metric.labelnames != tuple(labelnames):
+                raise ValueError("Metric {} is already registered as a different metric".format(name))
+            return metric
+
+
+REGISTRY = MetricsRegistry()
+
+
+class ProviderMetrics(object):
+    """
+    The hooks providers call to record their metrics into a registry. One
+    ProviderMetrics can be shared by several providers, whose samples are then
+    added up.
+    """
+
+    def __init__(self, registry=None, namespace='echoip'):
+        """
+        Constructor
+
+        :param registry: The registry the metrics are kept in, the module REGISTRY by default
+        :type registry: MetricsRegistry
+        :param namespace: The prefix of the metric names
+        :type namespace: str
+        """
+        self._registry = registry if registry is not None else REGISTRY
+        self._requests = self._registry.counter(
+            namespace + '_source_requests', 'Fetches from each source by outcome.', ('source', 'outcome'))
+        self._latency = self._registry.histogram(
+            namespace + '_source_latency_seconds', 'Seconds taken by the fetches from each source.', ('source',))
+        self._errors = self._registry.counter(
+            namespace + '_source_errors', 'Failed fetches from each source by exception type.', ('source', 'error'))
+        self._cache_lookups = self._registry.counter(
+            namespace + '_cache_lookups', 'Provider lookups by how the cache answered them.', ('result',))
+        self._consensus_rounds = self._registry.counter(
+            namespace + '_consensus_rounds', 'Multisource agreement rounds by outcome.', ('outcome',))
+
+    @property
+    def registry(self):
+        """
+        :return: The registry the metrics are kept in
+        :rtype: MetricsRegistry
+        """
+        return self._registry
+
+    def record_fetch(self, source_id, latency, error=None):
+        """
+        Records a fetch from a source
+        :param source_id: The source fetched from
+        :type source_id: str
+        :param latency: The seconds the fetch took
+        :type latency: float
+        :param error: The exception that failed the fetch, None if it succeeded
+        :type error: Exception
+        """
+        self._requests.labels(source_id, 'success' if error is None else 'failure').inc()
+        if latency is not None:
+            self._latency.labels(source_id).observe(latency)
+        if error is not None:
+            self._errors.labels(source_id, type(error).__name__).inc()
+
+    def record_cache_lookup(self, result):
+        """
+        Records how the cache answered a lookup
+        :param result: echoip.caches.IPCache.HIT, MISS, EXPIRED or STALE
+        :type result: str
+        """
+        self._cache_lookups.labels(result).inc()
+
+    def record_consensus(self, agreed):
+        """
+        Records the end of a multisource agreement round
+        :param agreed: True if enough sources agreed
+        :type agreed: bool
+        """
+        self._consensus_rounds.labels('agreement' if agreed else 'failure').inc()
+
+
+def _escape(value, help_text=False):
+    """
+    :param value: A label value or help text
+    :type value: str
+    :param help_text: True for help text, whose double quotes are not escaped
+    :type help_text: bool
+    :return: The value escaped for the OpenMetrics text format
+    :rtype: str
+    """
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value if help_text else value.replace('"', '\\"')
+
+
+def _format_labels(labels):
+    """
+    :param labels: The label names and values
+    :type labels: list(tuple(str, str))
+    :return: The labels of a sample, empty without labels
+    :rtype: str
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+def _format_value(value):
+    """
+    :param value: A sample value
+    :type value: float
+    :return: The value in the OpenMetrics text format
+    :rtype: str
+    """
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
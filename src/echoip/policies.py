@@ -0,0 +1,607 @@
+"""
+Policies decide how providers spend requests on their sources: which
+source to try first, when a slow request should be hedged with a
+request to another source, when a failing source should be skipped,
+which sources can answer an info lookup, how long a cached answer
+may be served while it is refreshed and how often a watcher polls.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import collections
+import random
+import threading
+import time
+
+
+class HedgingPolicy(object):
+    """
+    The HedgingPolicy decides how long a provider waits on a source before
+    sending the same lookup to another source. The delay is either fixed or
+    the observed percentile of the source's recent latencies, falling back to
+    the fixed delay until enough latencies have been observed.
+    """
+
+    def __init__(self, delay=None, percentile=None, window=50, min_samples=10, max_hedges=1):
+        """
+        Constructor
+
+        :param delay: the seconds to wait before hedging, used until min_samples
+        latencies have been observed when percentile is set
+        :type delay: float
+        :param percentile: the percentile (0-100) of a source's observed latency
+        after which a lookup is hedged
+        :type percentile: float
+        :param window: the number of recent latencies kept per source
+        :type window: int
+        :param min_samples: the number of latencies required before the percentile is used
+        :type min_samples: int
+        :param max_hedges: the maximum number of extra requests per lookup
+        :type max_hedges: int
+        """
+        if delay is None and percentile is None:
+            raise ValueError("HedgingPolicy requires a delay, a percentile or both")
+        if percentile is not None and not 0 < percentile <= 100:
+            raise ValueError("percentile must be in (0, 100], got {}".format(percentile))
+
+        self._delay = delay
+        self._percentile = percentile
+        self._window = window
+        self._min_samples = min_samples
+        self._max_hedges = max_hedges
+
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=self._window))
+        self._lock = threading.Lock()
+
+    @property
+    def max_hedges(self):
+        """
+        :return: The maximum number of extra requests per lookup
+        :rtype: int
+        """
+        return self._max_hedges
+
+    def record(self, source, latency):
+        """
+        Records the latency of a successful fetch from a source
+        :param source: The source fetched from
+        :type source: IIPSource provider
+        :param latency: The seconds the fetch took
+        :type latency: float
+        """
+        if latency is not None:
+            with self._lock:
+                self._latencies[source].append(latency)
+
+    def hedge_delay(self, source):
+        """
+        Returns how long to wait on a source before hedging
+        :param source: The source being waited on
+        :type source: IIPSource provider
+        :return: The seconds to wait, or None to wait without hedging
+        :rtype: float or None
+        """
+        if self._percentile is not None:
+            with self._lock:
+                latencies = sorted(self._latencies.get(source, ()))
+            if len(latencies) >= self._min_samples:
+                index = int(round(self._percentile / 100.0 * (len(latencies) - 1)))
+                return latencies[index]
+        return self._delay
+
+
+class SourceStats(object):
+    """
+    SourceStats keeps the recent behaviour of a single source: an exponentially
+    weighted moving average (EWMA) of its latency and success rate and the
+    types of its most recent errors.
+    """
+
+    def __init__(self, alpha=0.3, error_window=10, failure_penalty=1.0):
+        """
+        Constructor
+
+        :param alpha: the weight of the newest observation in the moving averages
+        :type alpha: float
+        :param error_window: the number of recent error types kept
+        :type error_window: int
+        :param failure_penalty: the minimum seconds a failed fetch adds to the latency
+        average, so that sources failing fast are not mistaken for fast sources
+        :type failure_penalty: float
+        """
+        self._alpha = alpha
+        self._failure_penalty = failure_penalty
+        self.latency = None
+        self.success_rate = 1.0
+        self.successes = 0
+        self.failures = 0
+        self.recent_errors = collections.deque(maxlen=error_window)
+        self._lock = threading.Lock()
+
+    @property
+    def samples(self):
+        """
+        :return: The number of fetches observed
+        :rtype: int
+        """
+        return self.successes + self.failures
+
+    def record_success(self, latency):
+        """
+        Records a successful fetch
+        :param latency: The seconds the fetch took
+        :type latency: float
+        """
+        with self._lock:
+            self.successes += 1
+            self.success_rate += self._alpha * (1.0 - self.success_rate)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self._alpha * (latency - self.latency)
+
+    def record_failure(self, error, latency=None):
+        """
+        Records a failed fetch
+        :param error: The exception raised by the fetch
+        :type error: Exception
+        :param latency: The seconds spent before the fetch failed
+        :type latency: float
+        """
+        # Time lost to a failure counts towards the cost of the source
+        latency = max(latency or 0.0, self._failure_penalty)
+        with self._lock:
+            self.failures += 1
+            self.success_rate -= self._alpha * self.success_rate
+            self.recent_errors.append(type(error).__name__)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self._alpha * (latency - self.latency)
+
+    def expected_cost(self, min_success_rate=0.01):
+        """
+        Returns the expected seconds to get an answer from the source, its average
+        latency divided by its success rate. Sources without observations cost 0 so
+        they are tried early.
+        :param min_success_rate: the floor applied to the success rate
+        :type min_success_rate: float
+        :return: The expected cost in seconds
+        :rtype: float
+        """
+        if self.latency is None:
+            return 0.0
+        return self.latency / max(self.success_rate, min_success_rate)
+
+    def __repr__(self):
+        return '<SourceStats latency={} success_rate={:.2f} successes={} failures={} recent_errors={}>'\
+            .format(self.latency, self.success_rate, self.successes, self.failures, list(self.recent_errors))
+
+
+class RandomScheduler(object):
+    """
+    The RandomScheduler tries the sources in a random order.
+    """
+
+    # noinspection PyMethodMayBeStatic
+    def order(self, source_stats):
+        """
+        :param source_stats: The sources to order and their statistics
+        :type source_stats: dict(IIPSource provider, SourceStats)
+        :return: The sources in the order they should be tried
+        :rtype: list
+        """
+        srces = list(source_stats.keys())
+        random.shuffle(srces)
+        return srces
+
+
+class WeightedScheduler(object):
+    """
+    The WeightedScheduler tries the sources cheapest first by their expected
+    cost (EWMA latency over success rate), so fast and healthy sources serve
+    most lookups. With probability exploration a random source is tried first
+    so that a slow or failing source is noticed when it recovers.
+    """
+
+    def __init__(self, exploration=0.05):
+        """
+        Constructor
+
+        :param exploration: the probability of trying a random source first
+        :type exploration: float
+        """
+        self._exploration = exploration
+
+    def order(self, source_stats):
+        """
+        :param source_stats: The sources to order and their statistics
+        :type source_stats: dict(IIPSource provider, SourceStats)
+        :return: The sources in the order they should be tried
+        :rtype: list
+        """
+        srces = list(source_stats.keys())
+        # Shuffled first so sources of equal cost share the load
+        random.shuffle(srces)
+        srces.sort(key=lambda src: source_stats[src].expected_cost())
+        if len(srces) > 1 and random.random() < self._exploration:
+            srces.insert(0, srces.pop(random.randrange(1, len(srces))))
+        return srces
+
+
+class CircuitBreaker(object):
+    """
+    The CircuitBreaker stops requests to a failing source. It opens after
+    failure_threshold consecutive failures, or when the error rate of the last
+    window fetches reaches error_rate. While open the source is skipped; after
+    cooldown seconds a single half-open probe is let through, which closes the
+    breaker on success and re-opens it on failure.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, cooldown=30, error_rate=None, window=20, min_requests=10):
+        """
+        Constructor
+
+        :param failure_threshold: the consecutive failures that open the breaker
+        :type failure_threshold: int
+        :param cooldown: the seconds the breaker stays open before a probe
+        :type cooldown: float
+        :param error_rate: the error rate (0-1) over the window that opens the
+        breaker, None to only count consecutive failures
+        :type error_rate: float
+        :param window: the number of recent outcomes the error rate is taken over
+        :type window: int
+        :param min_requests: the outcomes required before the error rate is used
+        :type min_requests: int
+        """
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._error_rate = error_rate
+        self._min_requests = min_requests
+
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        :return: The state of the breaker, half-open once the cooldown has passed
+        :rtype: str
+        """
+        with self._lock:
+            if self._state == self.OPEN and self._cooldown_passed(self._opened_at):
+                return self.HALF_OPEN
+            return self._state
+
+    @property
+    def available(self):
+        """
+        Evaluates whether a request would be let through without claiming the
+        half-open probe
+        :rtype: bool
+        """
+        with self._lock:
+            return self._allows()
+
+    def allow_request(self):
+        """
+        Claims permission for a request, in the half-open state only one probe
+        is let through until its outcome is recorded
+        :return: True if the request may be made
+        :rtype: bool
+        """
+        with self._lock:
+            if not self._allows():
+                return False
+            if self._state != self.CLOSED:
+                self._state = self.HALF_OPEN
+                self._probe_started_at = time.time()
+            return True
+
+    def record_success(self):
+        """
+        Records a successful request, closing the breaker
+        """
+        with self._lock:
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+            self._state = self.CLOSED
+            self._opened_at = self._probe_started_at = None
+
+    def record_failure(self):
+        """
+        Records a failed request, opening the breaker if a failed probe or if
+        the failure thresholds are reached
+        """
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            if self._state != self.CLOSED or self._should_open():
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self._probe_started_at = None
+
+    def release(self):
+        """
+        Gives back a claimed request whose outcome says nothing about the source,
+        such as one cut short by the deadline of a lookup, so that a half-open
+        breaker lets the next probe through
+        """
+        with self._lock:
+            self._probe_started_at = None
+
+    def _allows(self):
+        """
+        :return: True if a request may be made, the caller holds the lock
+        :rtype: bool
+        """
+        if self._state == self.CLOSED:
+            return True
+        if self._state == self.OPEN:
+            return self._cooldown_passed(self._opened_at)
+        # A probe whose outcome was never recorded is given up after a cooldown
+        return self._cooldown_passed(self._probe_started_at)
+
+    def _cooldown_passed(self, since):
+        return since is None or time.time() - since >= self._cooldown
+
+    def _should_open(self):
+        """
+        :return: True if the closed breaker should open, the caller holds the lock
+        :rtype: bool
+        """
+        if self._consecutive_failures >= self._failure_threshold:
+            return True
+        if self._error_rate is not None and len(self._outcomes) >= self._min_requests:
+            failures = sum(1 for outcome in self._outcomes if not outcome)
+            return float(failures) / len(self._outcomes) >= self._error_rate
+        return False
+
+
+class CapabilityIndex(object):
+    """
+    The CapabilityIndex maps sources to the info keys they return, as declared
+    by the sources (their info_keys attribute) and as learned from their
+    responses, so that info lookups go straight to the sources able to answer.
+    Nothing is assumed about a source that neither declared nor returned info.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._declared = dict()
+        self._learned = dict()
+        self._lock = threading.Lock()
+
+    def declare(self, source, info_keys):
+        """
+        Declares the info keys a source returns
+        :param source: The source
+        :type source: IIPSource provider
+        :param info_keys: The info keys returned by the source, None if not known
+        :type info_keys: Iterable
+        """
+        with self._lock:
+            if info_keys is None:
+                self._declared.pop(source, None)
+            else:
+                self._declared[source] = frozenset(info_keys)
+
+    def learn(self, source, info_keys):
+        """
+        Records the info keys a source returned
+        :param source: The source
+        :type source: IIPSource provider
+        :param info_keys: The info keys in the source's response
+        :type info_keys: Iterable
+        """
+        with self._lock:
+            self._learned[source] = frozenset(info_keys)
+
+    def known_keys(self, source):
+        """
+        :param source: The source
+        :type source: IIPSource provider
+        :return: The info keys the source is declared or was seen to return, None if unknown
+        :rtype: frozenset
+        """
+        with self._lock:
+            if source not in self._declared and source not in self._learned:
+                return None
+            return self._declared.get(source, frozenset()) | self._learned.get(source, frozenset())
+
+    def provides(self, source, required_info_keys):
+        """
+        :param source: The source
+        :type source: IIPSource provider
+        :param required_info_keys: a list of keys that are required. Lists or tuples
+        provided in this list indicate that at least one key in the set must be present.
+        :type required_info_keys: list(str, list(str))
+        :return: True if the source is known to provide the keys, False if known not
+        to, None if unknown
+        :rtype: bool or None
+        """
+        known = self.known_keys(source)
+        if known is None:
+            return None
+        return all(any(subkey in known for subkey in key) if isinstance(key, (tuple, list)) else key in known
+                   for key in required_info_keys or ())
+
+
+class StaleWhileRevalidate(object):
+    """
+    StaleWhileRevalidate lets a provider keep answering from its cache once the
+    cache_ttl (the soft TTL) has passed while the cache is refreshed in the
+    background, so callers do not wait on the sources. Answers older than the
+    hard_ttl are never served; callers then wait on a refresh. A failed background
+    refresh keeps the last good answer and delays the next one by an exponential
+    backoff.
+    """
+
+    def __init__(self, hard_ttl, backoff=1.0, max_backoff=300):
+        """
+        Constructor
+
+        :param hard_ttl: the seconds after which a cached answer is no longer served
+        :type hard_ttl: float
+        :param backoff: the seconds to wait before retrying after the first failed refresh,
+        doubled after every further failure
+        :type backoff: float
+        :param max_backoff: the maximum seconds between failed refreshes
+        :type max_backoff: float
+        """
+        self._hard_ttl = hard_ttl
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+        self._failures = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def failures(self):
+        """
+        :return: The number of background refreshes that failed in a row
+        :rtype: int
+        """
+        return self._failures
+
+    def serves(self, age):
+        """
+        :param age: The seconds since the cached answer was fetched
+        :type age: float
+        :return: True if the cached answer may still be served
+        :rtype: bool
+        """
+        return age < self._hard_ttl
+
+    def should_refresh(self):
+        """
+        :return: True unless a recent failure is still backing off
+        :rtype: bool
+        """
+        with self._lock:
+            return time.time() >= self._retry_at
+
+    def record_success(self):
+        """
+        Records a successful background refresh, resetting the backoff
+        """
+        with self._lock:
+            self._failures = 0
+            self._retry_at = 0
+
+    def record_failure(self):
+        """
+        Records a failed background refresh, backing off the next one
+        """
+        with self._lock:
+            self._failures += 1
+            delay = min(self._max_backoff, self._backoff * 2 ** (self._failures - 1))
+            self._retry_at = time.time() + delay
+
+
+class AdaptivePolling(object):
+    """
+    AdaptivePolling spaces the lookups of an IP watcher. The interval grows by
+    the backoff factor after every poll that finds the IP unchanged, up to
+    max_interval, and drops back to min_interval after a change, when another
+    change is most likely. A failed poll also drops back once, as outages often
+    come with a new address, and then backs off while the failures last. Every
+    delay is spread by a random jitter so that watchers started together do not
+    poll the sources together.
+    """
+
+    def __init__(self, min_interval=30, max_interval=1800, backoff=1.5, jitter=0.1):
+        """
+        Constructor
+
+        :param min_interval: the seconds between polls after a change
+        :type min_interval: float
+        :param max_interval: the maximum seconds between polls
+        :type max_interval: float
+        :param backoff: the factor the interval grows by after each unchanged poll
+        :type backoff: float
+        :param jitter: the fraction by which each delay is randomly lengthened or shortened
+        :type jitter: float
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("min_interval must be positive and no greater than max_interval")
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._jitter = jitter
+
+        self._interval = min_interval
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        """
+        :return: The seconds until the next poll, before jitter
+        :rtype: float
+        """
+        return self._interval
+
+    def next_delay(self):
+        """
+        :return: The seconds to wait before the next poll, with jitter
+        :rtype: float
+        """
+        with self._lock:
+            return self._interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def record_unchanged(self):
+        """
+        Records a poll that found the IP unchanged, backing off the next one
+        """
+        with self._lock:
+            self._failures = 0
+            self._grow()
+
+    def record_change(self):
+        """
+        Records a poll that found a new IP, tightening the interval
+        """
+        with self._lock:
+            self._failures = 0
+            self._interval = self._min_interval
+
+    def record_failure(self):
+        """
+        Records a failed poll, tightening the interval on the first failure in a
+        row and backing off on the following ones
+        """
+        with self._lock:
+            self._failures += 1
+            if self._failures == 1:
+                self._interval = self._min_interval
+            else:
+                self._grow()
+
+    def _grow(self):
+        self._interval = min(self._max_interval, self._interval * self._backoff)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request to a source is refused by its open circuit breaker
+    """
+    pass
+
+
+class DeadlineExpiredError(Exception):
+    """
+    Raised when a fetch from a source is not started because the deadline of
+    the lookup has passed
+    """
+    pass
@@ -6,15 +6,23 @@ __docformat__ = 'restructuredtext en'
 __author__ = 'Eli Flesher <eli@eflee.us>'
 
 import collections
+import contextlib
+import socket
+import threading
 import time
-import random
+
+from concurrent import futures
 
 import zope.interface
 from zope.interface.declarations import implementer
 
 import requests
 
+from . import caches
+from . import policies
 from . import sources
+from . import tracing
+from . import transport as transport_module
 
 # noinspection PyMethodMayBeStatic
 class _IIPProvider(zope.interface.Interface):
@@ -40,6 +48,9 @@ class _IIPProvider(zope.interface.Interface):
         one returns the keys required, then cache it.
         """
 
+    def refresh(self, required_info_keys=None):
+        """Fetches from the sources even if the cache is valid, then caches it"""
+
     def invalidate_cache(self):
         """Invalidates the cache"""
 
@@ -52,10 +63,23 @@ class IPProvider(object):
     """
     The IPProvider takes one or more IPSources and returns the results from them. If one
     provider does not respond it will move on to the next. It ensures that the age of the
-    response on no older than the cache_ttl.
+    response on no older than the cache_ttl. A provider can be shared between threads;
+    when the cache is stale only one of the concurrent callers fetches from the sources
+    and the others wait for and share its result. With a StaleWhileRevalidate policy
+    a stale answer is served while a background thread refreshes it. The cache is
+    kept in an echoip.caches.IPCache, which writes it through to a cache backend that
+    other providers and processes may share. Info is cached field by field, so a
+    lookup for keys that are not cached only fetches those keys, first from the
+    sources known to provide them and never from those known not to.
     """
+    _source_interface = sources.IIPSource
+    _source_errors = (ValueError, socket.error, requests.ConnectionError, requests.Timeout,
+                      policies.CircuitOpenError, policies.DeadlineExpiredError)
+    _timeout_errors = (requests.Timeout, socket.timeout)
 
-    def __init__(self, source_list=None, cache_ttl=3600):
+    def __init__(self, source_list=None, cache_ttl=3600, hedging=None, deadline=None, scheduler=None,
+                 circuit_breaker=policies.CircuitBreaker, stale_while_revalidate=None, cache_backend=None,
+                 info_ttl=None, clock=None, ip_version=None, metrics=None):
         """
         Constructor
 
@@ -63,18 +87,52 @@ class IPProvider(object):
         :type source_list: list of IIPSource providers
         :param cache_ttl: the seconds the ip cache remains valid
         :type cache_ttl: int
+        :param hedging: when set, a source that has not answered within the policy's
+        delay is hedged with a request to the next source
+        :type hedging: echoip.policies.HedgingPolicy
+        :param deadline: the seconds a lookup may take across all sources tried, the
+        time left is split between the sources still to be tried
+        :type deadline: float
+        :param scheduler: decides the order the sources are tried in from their
+        observed latency and reliability, a WeightedScheduler by default
+        :type scheduler: echoip.policies.WeightedScheduler
+        :param circuit_breaker: a callable creating the circuit breaker of each source,
+        sources with an open breaker are skipped, None disables the breakers
+        :type circuit_breaker: callable
+        :param stale_while_revalidate: when set, answers older than the cache_ttl keep
+        being served up to the policy's hard TTL while they are refreshed in the background
+        :type stale_while_revalidate: echoip.policies.StaleWhileRevalidate
+        :param cache_backend: where the last lookup is kept, in memory by default; a
+        FileCacheBackend shares it between the processes on a host
+        :type cache_backend: echoip.caches.ICacheBackend provider
+        :param info_ttl: the seconds each cached info field remains valid, defaults to cache_ttl
+        :type info_ttl: int
+        :param clock: returns the current time in seconds for the cache, time.time by default
+        :type clock: callable
+        :param ip_version: 4 or 6 to only accept answers of that IP version, answers of the
+        other version count as failed fetches
+        :type ip_version: int
+        :param metrics: records the fetches from each source and the cache lookups
+        :type metrics: echoip.metrics.ProviderMetrics
         """
         self._sources = collections.defaultdict(dict)
+        self._hedging = hedging
+        self._deadline = deadline
+        self._scheduler = scheduler if scheduler is not None else policies.WeightedScheduler()
+        self._circuit_breaker = circuit_breaker
+        self._capabilities = policies.CapabilityIndex()
+        self._ip_version = ip_version
+        self._metrics = metrics
 
         if source_list:
             for source in source_list:
                 self.add_source(source)
 
-        self._cache_ttl = cache_ttl
-
-        self._cache_ip = None
-        self._cache_info = None
-        self._cache_timestamp = 0
+        self._cache = caches.IPCache(cache_ttl, info_ttl, cache_backend, clock,
+                                     metrics.record_cache_lookup if metrics is not None else None)
+        self._single_flight = _SingleFlight()
+        self._stale_while_revalidate = stale_while_revalidate
+        self._revalidations = dict()
 
     def add_source(self, source):
         """
@@ -82,10 +140,14 @@ class IPProvider(object):
         :param source: The IIPSource provider to add to sources
         :type source: IIPSource provider
         """
-        if sources.IIPSource.providedBy(source):
-            self._sources[source]['fail_count'] = 0
+        if self._source_interface.providedBy(source):
+            self._sources[source]['stats'] = policies.SourceStats()
+            self._capabilities.declare(source, getattr(source, 'info_keys', None))
+            if self._circuit_breaker is not None:
+                self._sources[source]['breaker'] = self._circuit_breaker()
         else:
-            raise TypeError('echoip.sources.IIPSource must be provided by source argument.')
+            raise TypeError('echoip.sources.{} must be provided by source argument.'
+                            .format(self._source_interface.__name__))
 
     def get_ip(self):
         """
@@ -93,10 +155,10 @@ class IPProvider(object):
         :return: the current ip
         :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
         """
-        if not self.is_cache_valid() or self._cache_ip is None:
-            self._cache_ip, self._cache_info = self._fetch_from_sources()
-            self._cache_timestamp = time.time()
-        return self._cache_ip
+        with self._cache.lock:
+            if self._cache.lookup() == caches.IPCache.HIT or self._serve_stale(None, self._ip_cache_stale):
+                return self._cache.ip_address
+        return self._refresh(None, self._ip_cache_stale)[0]
 
     def get_info(self, required_info_keys=None):
         """
@@ -104,40 +166,353 @@ class IPProvider(object):
         required, then cache it
         :param required_info_keys: The keys required for the fetch to be valid
         :type required_info_keys: list(tuple)
-        :return: The info dictionary returned by the provider
+        :return: The info dictionary, merged from the sources that provided it
         :rtype: dict
         """
-        if not self.is_cache_valid or not self._cache_info \
-                or not self._verify_required_keys(self._cache_info, required_info_keys):
-            self._cache_ip, self._cache_info = self._fetch_from_sources(required_info_keys)
-            self._cache_timestamp = time.time()
-        return self._cache_info
+        is_stale = lambda: self._info_cache_stale(required_info_keys)
+        with self._cache.lock:
+            if self._cache.lookup(required_info_keys, info=True) == caches.IPCache.HIT:
+                return self._cache.info
+            if self._serve_stale(required_info_keys, is_stale):
+                return self._cache.stale_info
+        return self._refresh(required_info_keys, is_stale)[1]
+
+    def _refresh(self, required_info_keys, is_stale):
+        """
+        Fetches from the sources and caches the result. Concurrent refreshes for the
+        same required keys are coalesced into a single fetch whose result, or error,
+        is shared by every caller. The cache backend is locked during the refresh and
+        a record stored there by another provider is used if it is fresh.
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh, checked
+        again once the refresh starts as another caller may have just finished one
+        :type is_stale: callable
+        :return: The IP and info now cached
+        :rtype: tuple
+        """
+        def refresh():
+            with self._cache.backend.lock():
+                self._cache.load()
+                with self._cache.lock:
+                    if not is_stale():
+                        return self._cache.ip_address, self._cache.info
+                    fetch_keys = self._cache.missing_keys(required_info_keys)
+
+                if self._cache.store(self._fetch_from_sources(fetch_keys)) and fetch_keys != required_info_keys:
+                    # The IP changed, so the info cached for the previous IP is gone
+                    self._cache.store(self._fetch_from_sources(required_info_keys))
+                with self._cache.lock:
+                    return self._cache.ip_address, self._cache.info
+
+        return self._single_flight.do(_flight_key(required_info_keys), refresh)
+
+    def _serve_stale(self, required_info_keys, is_stale):
+        """
+        Decides whether a stale cache may be served under the stale-while-revalidate
+        policy and if so starts its background refresh, unless one is running or a
+        failed one is backing off. The caller holds the cache lock. Served answers are
+        counted as stale hits.
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        :return: True if the cached answer should be served
+        :rtype: bool
+        """
+        policy = self._stale_while_revalidate
+        if policy is None or self._cache.ip_address is None \
+                or not self._verify_required_keys(self._cache.stale_info, required_info_keys) \
+                or not policy.serves(self._cache.age()):
+            return False
+
+        self._cache.record_stale_hit()
+        key = _flight_key(required_info_keys)
+        if key not in self._revalidations and policy.should_refresh():
+            self._revalidations[key] = self._start_revalidation(required_info_keys, is_stale)
+        return True
+
+    def _start_revalidation(self, required_info_keys, is_stale):
+        """
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        :return: The daemon thread refreshing the cache
+        :rtype: threading.Thread
+        """
+        thread = threading.Thread(target=self._revalidate, args=(required_info_keys, is_stale))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _revalidate(self, required_info_keys, is_stale):
+        """
+        Refreshes the cache in the background; on failure the cached answer is kept
+        and the policy backs off the next refresh
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :param is_stale: evaluates whether the cache still needs the refresh
+        :type is_stale: callable
+        """
+        try:
+            self._refresh(required_info_keys, is_stale)
+        except Exception:
+            self._stale_while_revalidate.record_failure()
+        else:
+            self._stale_while_revalidate.record_success()
+        finally:
+            with self._cache.lock:
+                self._revalidations.pop(_flight_key(required_info_keys), None)
+
+    def _ip_cache_stale(self):
+        """
+        :return: True if get_ip must fetch from the sources
+        :rtype: bool
+        """
+        return self._cache.status() != caches.IPCache.HIT
+
+    def _info_cache_stale(self, required_info_keys):
+        """
+        :param required_info_keys: The keys required by the caller
+        :type required_info_keys: list(tuple)
+        :return: True if get_info must fetch from the sources
+        :rtype: bool
+        """
+        return self._cache.status(required_info_keys, info=True) != caches.IPCache.HIT
+
+    def _ordered_sources(self, required_info_keys=None):
+        """
+        Orders the sources by tier, so that local sources are tried before network
+        ones, and within a tier by the scheduler
+        :param required_info_keys: When given, the sources known to provide these keys
+        are tried before those not known to and the sources known to lack them are left out
+        :type required_info_keys: list
+        :return: The configured sources in the order they should be tried
+        :rtype: list of IIPSource providers
+        """
+        available = dict((source, meta['stats']) for source, meta in self._sources.items()
+                         if 'breaker' not in meta or meta['breaker'].available)
+        if not required_info_keys:
+            return sorted(self._scheduler.order(available), key=_source_tier)
+
+        capable, unknown = dict(), dict()
+        for source, stats in available.items():
+            provides = self._capabilities.provides(source, required_info_keys)
+            if provides:
+                capable[source] = stats
+            elif provides is None:
+                unknown[source] = stats
+        return sorted(self._scheduler.order(capable) + self._scheduler.order(unknown), key=_source_tier)
 
     def _fetch_from_sources(self, required_info_keys=None):
         """
         Internal method that fetches from configured sources.
         :param required_info_keys: Keys that are required in the response
         :type required_info_keys: list
-        :return: None
-        :rtype: None
+        :return: The first valid response
+        :rtype: echoip.sources.FetchResult
         """
-        srces = self._sources.keys()
-        random.shuffle(srces)
-        for source in srces:
-            try:
-                # noinspection PyProtectedMember
-                source.fetch()
+        deadline = _Deadline(self._deadline)
+        if self._hedging is not None:
+            return self._fetch_hedged(deadline, required_info_keys)
 
-                ip_address = source.ip_address
-                info = source.info
+        srces = self._ordered_sources(required_info_keys)
+        for index, source in enumerate(srces):
+            if deadline.expired:
+                break
+            try:
+                result = self._fetch_source(source, deadline.share(len(srces) - index), deadline)
 
-                if self._verify_required_keys(info, required_info_keys):
-                    return ip_address, info
+                if self._verify_required_keys(result.info, required_info_keys):
+                    return result
 
-            except (ValueError, requests.ConnectionError):
+            except self._source_errors:
                 continue
 
-        raise NullResponseFromSourcesError("No sources returned a valid response.")
+        raise NullResponseFromSourcesError("No sources returned a valid response{}."
+                                           .format(deadline.describe()))
+
+    def _fetch_hedged(self, deadline, required_info_keys=None):
+        """
+        Fetches from the sources in order, starting the next source when the last
+        one started has not answered within the hedging delay or has failed, and
+        returns the first valid response.
+        :param deadline: The time left for the lookup
+        :type deadline: _Deadline
+        :param required_info_keys: Keys that are required in the response
+        :type required_info_keys: list
+        :return: The first valid response
+        :rtype: echoip.sources.FetchResult
+        """
+        remaining = collections.deque(self._ordered_sources(required_info_keys))
+        executor = futures.ThreadPoolExecutor(max_workers=self._hedging.max_hedges + 1)
+        pending = dict()
+
+        def start_next():
+            source = remaining.popleft()
+            future = executor.submit(self._fetch_source, source, deadline.remaining(), deadline)
+            future.add_done_callback(lambda f: self._record_hedged_latency(source, f))
+            pending[future] = source
+            return source, time.time()
+
+        try:
+            last_started = start_next() if remaining else None
+            while pending and not deadline.expired:
+                timeout = deadline.remaining()
+                can_hedge = remaining and len(pending) <= self._hedging.max_hedges
+                if can_hedge:
+                    delay = self._hedging.hedge_delay(last_started[0])
+                    if delay is not None:
+                        delay = max(0, delay - (time.time() - last_started[1]))
+                        timeout = delay if timeout is None else min(timeout, delay)
+
+                done, _ = futures.wait(list(pending), timeout=timeout,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    try:
+                        result = future.result()
+                    except self._source_errors:
+                        continue
+                    if self._verify_required_keys(result.info, required_info_keys):
+                        return result
+
+                # Hedge a slow source, or move on from failed ones
+                if remaining and (not done or not pending) and not deadline.expired:
+                    last_started = start_next()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        raise NullResponseFromSourcesError("No sources returned a valid response{}."
+                                           .format(deadline.describe()))
+
+    def _record_hedged_latency(self, source, future):
+        """
+        Feeds the latency of a completed hedged fetch back to the hedging policy
+        :param source: The source fetched from
+        :type source: IIPSource provider
+        :param future: The completed fetch
+        :type future: concurrent.futures.Future
+        """
+        if not future.cancelled() and future.exception() is None:
+            self._hedging.record(source, future.result().latency)
+
+    def _fetch_source(self, source, timeout=None, deadline=None):
+        """
+        Fetches once from a source and returns the snapshot of that fetch so the
+        ip and info are read without further requests. The outcome is recorded in
+        the source's statistics.
+
+        :param source: The source to fetch from
+        :type source: IIPSource provider
+        :param timeout: the seconds the fetch may take, None for the source's own timeouts
+        :type timeout: float
+        :param deadline: the deadline of the lookup the timeout was taken from
+        :type deadline: _Deadline
+        :return: The result of the fetch
+        :rtype: echoip.sources.FetchResult
+        """
+        self._acquire(source, deadline)
+        start = time.time()
+        try:
+            result = source.fetch() if timeout is None else source.fetch(timeout=timeout)
+            if result is None:
+                # Sources written before fetch() returned a snapshot
+                result = sources.FetchResult(source.ip_address, source.info, time.time(), None,
+                                             getattr(source, 'source_id', repr(source)))
+            self._verify_ip_version(source, result)
+        except self._source_errors as error:
+            self._record_failure(source, error, time.time() - start, deadline)
+            raise
+        self._record_success(source, time.time() - start, result)
+        return result
+
+    def _verify_ip_version(self, source, result):
+        """
+        :param source: The source fetched from
+        :type source: IIPSource provider
+        :param result: The result of the fetch
+        :type result: echoip.sources.FetchResult
+        :raises IPVersionMismatchError: if the provider only accepts answers of another IP version
+        """
+        if self._ip_version is not None and result.ip_address.version != self._ip_version:
+            raise IPVersionMismatchError("{} answered with IPv{} rather than IPv{}"
+                                         .format(getattr(source, 'source_id', source),
+                                                 result.ip_address.version, self._ip_version))
+
+    def _acquire(self, source, deadline=None):
+        """
+        Asks the source's circuit breaker for permission to fetch
+        :param source: The source about to be fetched from
+        :type source: IIPSource provider
+        :param deadline: the deadline of the lookup
+        :type deadline: _Deadline
+        :raises echoip.policies.DeadlineExpiredError: if the deadline has passed, leaving no time for the fetch
+        :raises echoip.policies.CircuitOpenError: if the breaker is open
+        """
+        if deadline is not None and deadline.expired:
+            raise policies.DeadlineExpiredError("The deadline passed before {} was fetched"
+                                                .format(getattr(source, 'source_id', source)))
+        breaker = self._sources[source].get('breaker')
+        if breaker is not None and not breaker.allow_request():
+            raise policies.CircuitOpenError("The circuit breaker for {} is open"
+                                            .format(getattr(source, 'source_id', source)))
+
+    def _record_success(self, source, latency, result):
+        """
+        Records a successful fetch in the source's statistics and circuit breaker,
+        and the info keys the source provides
+        :param source: The source fetched from
+        :type source: IIPSource provider
+        :param latency: The seconds the fetch took
+        :type latency: float
+        :param result: The result of the fetch
+        :type result: echoip.sources.FetchResult
+        """
+        self._sources[source]['stats'].record_success(latency)
+        self._capabilities.learn(source, result.info)
+        if 'breaker' in self._sources[source]:
+            self._sources[source]['breaker'].record_success()
+        if self._metrics is not None:
+            self._metrics.record_fetch(getattr(source, 'source_id', repr(source)), latency)
+
+    def _record_failure(self, source, error, latency, deadline=None):
+        """
+        Records a failed fetch in the source's statistics and metrics. A fetch that
+        timed out once the deadline of the lookup had passed was cut short by the
+        lookup rather than failed by the source, so it is left out of the source's
+        statistics and gives back the breaker's claim, but still shows in the metrics.
+        :param source: The source fetched from
+        :type source: IIPSource provider
+        :param error: The exception raised by the fetch
+        :type error: Exception
+        :param latency: The seconds spent before the fetch failed
+        :type latency: float
+        :param deadline: the deadline of the lookup
+        :type deadline: _Deadline
+        """
+        breaker = self._sources[source].get('breaker')
+        if deadline is not None and deadline.expired and isinstance(error, self._timeout_errors):
+            if breaker is not None:
+                breaker.release()
+        else:
+            self._sources[source]['stats'].record_failure(error, latency)
+            if breaker is not None:
+                breaker.record_failure()
+        if self._metrics is not None:
+            self._metrics.record_fetch(getattr(source, 'source_id', repr(source)), latency, error)
+
+    def _record_consensus(self, agreed):
+        """
+        Records the end of an agreement round in the metrics
+        :param agreed: True if enough sources agreed
+        :type agreed: bool
+        """
+        if self._metrics is not None:
+            self._metrics.record_consensus(agreed)
 
     @staticmethod
     def _verify_required_keys(info, required_info_keys):
@@ -153,32 +528,49 @@ class IPProvider(object):
         """
         keys_found = True
         if required_info_keys is not None:
-            for key in required_info_keys:
-                if isinstance(key, (tuple, list)):
-                    if not any([subkey in info for subkey in key]):
-                        keys_found = False
-                        break
-                else:
-                    if key not in info:
-                        keys_found = False
-                        break
+            with tracing.stage(tracing.VERIFY_KEYS, key_count=len(required_info_keys)):
+                for key in required_info_keys:
+                    if isinstance(key, (tuple, list)):
+                        if not any([subkey in info for subkey in key]):
+                            keys_found = False
+                            break
+                    else:
+                        if key not in info:
+                            keys_found = False
+                            break
         return keys_found
 
+    def refresh(self, required_info_keys=None):
+        """
+        Fetches from the sources even if the cache is still valid and caches the
+        result, as an IP watcher does to notice a change
+        :param required_info_keys: The keys required for the fetch to be valid
+        :type required_info_keys: list(tuple)
+        :return: The IP and info now cached
+        :rtype: tuple
+        """
+        return self._refresh(required_info_keys, lambda: True)
+
     def invalidate_cache(self):
         """
-        Invalidates the cache
+        Invalidates the cache, including the record in the cache backend
         """
-        self._cache_timestamp = 0
+        self._cache.invalidate()
 
     def is_cache_valid(self):
         """
         Evaluates the validity of the cache
         """
-        is_expired = time.time() - self._cache_timestamp < self._cache_ttl
-        cache_info_set = self._cache_info is not None
-        cache_ip_set = self._cache_ip is not None
+        return self._cache.is_valid()
 
-        return is_expired and cache_info_set and cache_ip_set
+    @property
+    def cache(self):
+        """
+        Returns the provider's cache, whose stats count its hits, misses and expirations
+        :return: The cache
+        :rtype: echoip.caches.IPCache
+        """
+        return self._cache
 
     @property
     def num_sources(self):
@@ -187,6 +579,44 @@ class IPProvider(object):
         """
         return len(self._sources)
 
+    @property
+    def info_provenance(self):
+        """
+        Returns every cached info field with the source it came from and when
+        :return: The cached info fields
+        :rtype: dict(str, echoip.caches.InfoField)
+        """
+        return self._cache.provenance
+
+    @property
+    def capabilities(self):
+        """
+        Returns the index of the info keys each source is known to provide
+        :return: The capability index
+        :rtype: echoip.policies.CapabilityIndex
+        """
+        return self._capabilities
+
+    @property
+    def source_stats(self):
+        """
+        Returns the observed latency, success rate and recent errors of each source
+        :return: The statistics of each configured source
+        :rtype: dict(IIPSource provider, echoip.policies.SourceStats)
+        """
+        return dict((source, meta['stats']) for source, meta in self._sources.items())
+
+    @property
+    def breaker_states(self):
+        """
+        Returns the circuit breaker state of each source, one of
+        echoip.policies.CircuitBreaker.CLOSED, OPEN or HALF_OPEN
+        :return: The breaker state of each configured source
+        :rtype: dict(IIPSource provider, str)
+        """
+        return dict((source, meta['breaker'].state) for source, meta in self._sources.items()
+                    if 'breaker' in meta)
+
 
 @implementer(_IIPProvider)
 class MultisourceIPProvider(IPProvider):
@@ -197,7 +627,10 @@ class MultisourceIPProvider(IPProvider):
     If one provider does not respond it will move on to the next. It ensures
     that the age of the response on no older than the cache_ttl.
     """
-    def __init__(self, source_list=None, cache_ttl=3600, min_source_agreement=2):
+    def __init__(self, source_list=None, cache_ttl=3600, min_source_agreement=2,
+                 concurrent=False, max_workers=None, deadline=None, scheduler=None,
+                 circuit_breaker=policies.CircuitBreaker, stale_while_revalidate=None, cache_backend=None,
+                 info_ttl=None, clock=None, ip_version=None, metrics=None):
         """
         :param source_list: The list of sources to bootstrap the provider with
         :type source_list: list of IIPSource providers
@@ -205,42 +638,545 @@ class MultisourceIPProvider(IPProvider):
         :param min_source_agreement: The minimum number of source that must be
         in agreement for an ip_fetch
         :type min_source_agreement: int
+        :param concurrent: query the sources in parallel and return as soon as
+        enough of them agree, ignoring the remaining responses
+        :type concurrent: bool
+        :param max_workers: the maximum number of sources queried at once in
+        concurrent mode, defaults to the number of sources
+        :type max_workers: int
+        :param deadline: the seconds a lookup may take across all sources queried
+        :type deadline: float
+        :param scheduler: decides the order the sources are queried in
+        :type scheduler: echoip.policies.WeightedScheduler
+        :param circuit_breaker: a callable creating the circuit breaker of each source
+        :type circuit_breaker: callable
+        :param stale_while_revalidate: serves stale answers while they are refreshed
+        :type stale_while_revalidate: echoip.policies.StaleWhileRevalidate
+        :param cache_backend: where the last lookup is kept, in memory by default
+        :type cache_backend: echoip.caches.ICacheBackend provider
+        :param info_ttl: the seconds each cached info field remains valid, defaults to cache_ttl
+        :type info_ttl: int
+        :param clock: returns the current time in seconds for the cache
+        :type clock: callable
+        :param ip_version: 4 or 6 to only accept answers of that IP version
+        :type ip_version: int
+        :param metrics: records the fetches, cache lookups and agreement rounds
+        :type metrics: echoip.metrics.ProviderMetrics
         """
-        super(MultisourceIPProvider, self).__init__(source_list, cache_ttl)
+        super(MultisourceIPProvider, self).__init__(source_list, cache_ttl, deadline=deadline,
+                                                    scheduler=scheduler, circuit_breaker=circuit_breaker,
+                                                    stale_while_revalidate=stale_while_revalidate,
+                                                    cache_backend=cache_backend, info_ttl=info_ttl, clock=clock,
+                                                    ip_version=ip_version, metrics=metrics)
         self._min_source_agreement = min_source_agreement
+        self._concurrent = concurrent
+        self._max_workers = max_workers
 
     def _fetch_from_sources(self, required_info_keys=None):
         if self.num_sources < self._min_source_agreement:
             raise InsufficientSourcesForAgreementError(
                 "{} sources are required but only {} configured"
                 .format(self._min_source_agreement, self.num_sources))
-        infos = dict()
-        ips = collections.defaultdict(list)
-        srces = self._sources.keys()
-        random.shuffle(srces)
-        for source in srces:
+        consensus = _Consensus(self._min_source_agreement, required_info_keys)
+        deadline = _Deadline(self._deadline)
+        srces = self._ordered_sources()
+
+        # The stage covers the whole round, the fetches as well as the agreement
+        with tracing.stage(tracing.CONSENSUS, min_source_agreement=self._min_source_agreement):
+            if self._concurrent:
+                results = self._fetch_concurrently(srces, deadline)
+            else:
+                results = self._fetch_sequentially(srces, deadline)
+            agreement = None
+            with contextlib.closing(results):
+                for result in results:
+                    agreement = consensus.add(result)
+                    if agreement is not None:
+                        break
+
+        self._record_consensus(agreement is not None)
+        if agreement is None:
+            raise InsufficientSourcesForAgreementError(
+                "An insufficient number of sources were able to agree{}.".format(deadline.describe()))
+        return agreement
+
+    def _fetch_sequentially(self, srces, deadline):
+        """
+        Fetches from each source in turn, splitting the time left between the
+        sources still to be tried
+        :param srces: The sources to fetch from in order
+        :type srces: list of IIPSource providers
+        :param deadline: The time left for the lookup
+        :type deadline: _Deadline
+        :return: Yields the result of each source that responded
+        :rtype: generator
+        """
+        for index, source in enumerate(srces):
+            if deadline.expired:
+                return
             try:
-                # noinspection PyProtectedMember
-                source.fetch()
-                ip_address = source.ip_address
-                info = source.info
-
-                if ip_address not in ips.keys():
-                    ips[ip_address].append(source)
-                    infos[source] = info
-                else:
-                    for src in ips[ip_address]:
-                        info.update(infos[src])
-
-                    if self._verify_required_keys(info, required_info_keys):
-                        return ip_address, info
-                    else:
-                        infos[source] = source.info
-            except (ValueError, requests.ConnectionError):
+                yield self._fetch_source(source, deadline.share(len(srces) - index), deadline)
+            except self._source_errors:
                 continue
 
-        raise InsufficientSourcesForAgreementError(
-            "An insufficient number of sources were able to agree.")
+    def _fetch_concurrently(self, srces, deadline):
+        """
+        Fetches from all sources in parallel through a bounded thread pool.
+        Sources that have not started when the generator is closed are cancelled
+        and the responses of those still running are ignored.
+        :param srces: The sources to fetch from
+        :type srces: list of IIPSource providers
+        :param deadline: The time left for the lookup
+        :type deadline: _Deadline
+        :return: Yields the result of each source that responded, fastest first
+        :rtype: generator
+        """
+        if not srces:
+            # Every circuit breaker is open
+            return
+        executor = futures.ThreadPoolExecutor(max_workers=self._max_workers or len(srces))
+        # The timeout is taken when the fetch starts as queued sources start late
+        pending = [executor.submit(lambda src: self._fetch_source(src, deadline.remaining(), deadline), source)
+                   for source in srces]
+        try:
+            for future in futures.as_completed(pending, timeout=deadline.remaining()):
+                try:
+                    yield future.result()
+                except self._source_errors:
+                    continue
+        except futures.TimeoutError:
+            return
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+class BatchResult(collections.namedtuple('BatchResult', ['ips', 'errors'])):
+    """
+    The outcome of a batch lookup: the IP found for each egress path and the
+    exception raised for each egress path whose lookup failed.
+    """
+    __slots__ = ()
+
+
+class EgressIPProvider(object):
+    """
+    The EgressIPProvider looks up the external IP of many egress paths (proxies,
+    local addresses or interfaces) at once. Every egress path has its own
+    transport, shared by all of its sources so their connections are pooled, and
+    its own provider caching its IP; both are kept between lookups. Lookups for
+    different egress paths run concurrently in a bounded thread pool. A
+    cache_backend given in the provider options is scoped to each egress path,
+    so every path keeps its own record.
+    """
+
+    def __init__(self, source_factory=None, provider_class=IPProvider, max_workers=32, **provider_options):
+        """
+        Constructor
+
+        :param source_factory: generates the sources of every egress path, the
+        builtin sources by default
+        :type source_factory: echoip.sources.IPSourceFactory
+        :param provider_class: the provider created for each egress path
+        :type provider_class: type
+        :param max_workers: the maximum number of egress paths looked up at once
+        :type max_workers: int
+        :param provider_options: keyword arguments for every provider, such as
+        cache_ttl or deadline; a cache_backend is given to each provider scoped
+        to its egress path
+        """
+        self._source_factory = source_factory if source_factory is not None else sources.IPSourceFactory()
+        self._provider_class = provider_class
+        self._max_workers = max_workers
+        self._provider_options = provider_options
+
+        self._providers = dict()
+        self._transports = dict()
+        self._lock = threading.Lock()
+
+    def get_ips(self, egress_configs):
+        """
+        Looks up the external IP of every egress path concurrently
+        :param egress_configs: The egress paths, as proxy URLs, local addresses or
+        interface names (see echoip.transport.Egress.parse)
+        :type egress_configs: Iterable
+        :return: The IP of each egress path looked up and the error of each that failed,
+        keyed by the given egress paths
+        :rtype: BatchResult
+        """
+        configs = list(collections.OrderedDict.fromkeys(egress_configs))
+        ips, errors = dict(), dict()
+        if not configs:
+            return BatchResult(ips, errors)
+
+        executor = futures.ThreadPoolExecutor(max_workers=min(self._max_workers, len(configs)))
+        try:
+            pending = dict((executor.submit(self._lookup, config), config) for config in configs)
+            for future in futures.as_completed(pending):
+                try:
+                    ips[pending[future]] = future.result()
+                except Exception as error:
+                    errors[pending[future]] = error
+        finally:
+            executor.shutdown(wait=False)
+        return BatchResult(ips, errors)
+
+    def get_ip(self, egress_config):
+        """
+        Looks up the external IP of a single egress path
+        :param egress_config: The egress path
+        :type egress_config: str or echoip.transport.Egress
+        :return: The IP
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        return self._lookup(egress_config)
+
+    def provider_for(self, egress_config):
+        """
+        Returns the provider of an egress path, creating it and its transport if needed
+        :param egress_config: The egress path
+        :type egress_config: str or echoip.transport.Egress
+        :return: The provider whose sources leave by the egress path
+        :rtype: IPProvider
+        """
+        egress = transport_module.Egress.parse(egress_config)
+        with self._lock:
+            provider = self._providers.get(egress)
+            if provider is None:
+                transport = self._build_transport(egress)
+                provider = self._provider_class(list(self._source_factory.get_sources(transport=transport)),
+                                                **_scoped_options(self._provider_options, _egress_name(egress)))
+                self._providers[egress], self._transports[egress] = provider, transport
+        return provider
+
+    def close(self):
+        """
+        Closes the transports of every egress path
+        """
+        with self._lock:
+            transports, self._transports, self._providers = self._transports, dict(), dict()
+        for transport in transports.values():
+            transport.close()
+
+    @property
+    def num_egresses(self):
+        """
+        :return: The number of egress paths with a provider
+        :rtype: int
+        """
+        return len(self._providers)
+
+    def _lookup(self, egress_config):
+        return self.provider_for(egress_config).get_ip()
+
+    @staticmethod
+    def _build_transport(egress):
+        """
+        :param egress: The egress path
+        :type egress: echoip.transport.Egress
+        :return: The transport shared by the sources of the egress path
+        :rtype: echoip.transport.HTTPTransport
+        """
+        return transport_module.HTTPTransport(egress=egress)
+
+
+class DualStackResult(collections.namedtuple('DualStackResult', ['ipv4', 'ipv6', 'errors'])):
+    """
+    The IPv4 and IPv6 address of a dual-stack lookup, None for a family whose
+    lookup failed, and the exception raised for each failed family keyed by
+    its IP version.
+    """
+    __slots__ = ()
+
+
+class DualStackIPProvider(object):
+    """
+    The DualStackIPProvider looks up the IPv4 and the IPv6 address at the same
+    time. Each family has its own provider, with its own cache and TTL, whose
+    HTTP sources connect over that family only; answers of the other family
+    from sources that cannot be pinned, such as DNS or STUN sources, count as
+    failed fetches. A cache_backend given in the provider options is scoped to
+    each family, so the families never share a record.
+    """
+    _families = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+    def __init__(self, source_factory=None, provider_class=IPProvider, cache_ttl=3600, **provider_options):
+        """
+        Constructor
+
+        :param source_factory: generates the sources of both families, the builtin
+        sources by default
+        :type source_factory: echoip.sources.IPSourceFactory
+        :param provider_class: the provider created for each family
+        :type provider_class: type
+        :param cache_ttl: the seconds the cache of each family remains valid, or a
+        dict of them keyed by IP version
+        :type cache_ttl: int or dict
+        :param provider_options: keyword arguments for both providers, such as deadline;
+        a cache_backend is given to each provider scoped to its family
+        """
+        source_factory = source_factory if source_factory is not None else sources.IPSourceFactory()
+        self._providers = dict()
+        self._transports = dict()
+        for version, family in self._families.items():
+            ttl = cache_ttl.get(version, 3600) if isinstance(cache_ttl, dict) else cache_ttl
+            self._transports[version] = transport_module.HTTPTransport(family=family)
+            self._providers[version] = provider_class(
+                list(source_factory.get_sources(transport=self._transports[version])), ttl,
+                ip_version=version, **_scoped_options(provider_options, 'ipv{}'.format(version)))
+
+    def get_ips(self):
+        """
+        Looks up the IPv4 and IPv6 address, in parallel when neither is cached
+        :return: Both addresses and the errors of the families whose lookup failed
+        :rtype: DualStackResult
+        """
+        ips, errors = dict(), dict()
+        stale = [version for version, provider in self._providers.items() if not provider.is_cache_valid()]
+        if len(stale) < 2:
+            for version in self._providers:
+                self._lookup(version, ips, errors)
+            return DualStackResult(ips.get(4), ips.get(6), errors)
+
+        executor = futures.ThreadPoolExecutor(max_workers=2)
+        try:
+            for future in [executor.submit(self._lookup, version, ips, errors) for version in stale]:
+                future.result()
+        finally:
+            executor.shutdown(wait=False)
+        return DualStackResult(ips.get(4), ips.get(6), errors)
+
+    def provider_for(self, version):
+        """
+        :param version: The IP version, 4 or 6
+        :type version: int
+        :return: The provider of the family
+        :rtype: IPProvider
+        """
+        return self._providers[version]
+
+    def invalidate_cache(self):
+        """
+        Invalidates the cache of both families
+        """
+        for provider in self._providers.values():
+            provider.invalidate_cache()
+
+    def close(self):
+        """
+        Closes the transports of both families
+        """
+        for transport in self._transports.values():
+            transport.close()
+
+    def _lookup(self, version, ips, errors):
+        """
+        :param version: The IP version looked up
+        :type version: int
+        :param ips: Collects the address found
+        :type ips: dict
+        :param errors: Collects any error raised
+        :type errors: dict
+        """
+        try:
+            ips[version] = self._providers[version].get_ip()
+        except Exception as error:
+            # Whatever fails one family, the other family's address is still returned
+            errors[version] = error
+
+
+def _scoped_options(provider_options, name):
+    """
+    :param provider_options: The keyword arguments shared by several providers
+    :type provider_options: dict
+    :param name: The name of the record of one of the providers
+    :type name: str
+    :return: The keyword arguments of that provider, with the cache_backend, if
+    any, scoped to the name so that the providers do not share one record
+    :rtype: dict
+    """
+    backend = provider_options.get('cache_backend')
+    if backend is None:
+        return provider_options
+    return dict(provider_options, cache_backend=backend.scoped(name))
+
+
+def _egress_name(egress):
+    """
+    :param egress: An egress path
+    :type egress: echoip.transport.Egress
+    :return: The name of the cached record of the egress path
+    :rtype: str
+    """
+    return 'egress-' + ','.join('{}={}'.format(field, value) for field, value in zip(egress._fields, egress)
+                                if value is not None)
+
+
+def _source_tier(source):
+    """
+    :param source: A source
+    :type source: IIPSource provider
+    :return: The tier the source is tried in, NETWORK_TIER unless it declares one
+    :rtype: int
+    """
+    return getattr(source, 'tier', sources.NETWORK_TIER)
+
+
+def _flight_key(required_info_keys):
+    """
+    :param required_info_keys: Keys that are required in the response
+    :type required_info_keys: list(str, list(str))
+    :return: A hashable key identifying the refresh for the required keys
+    :rtype: tuple or None
+    """
+    if required_info_keys is None:
+        return None
+    return tuple(tuple(key) if isinstance(key, (tuple, list)) else key for key in required_info_keys)
+
+
+class _SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key into one call; the callers that
+    arrive while it runs wait for it and share its result or exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, func):
+        """
+        :param key: Identifies calls that may share a result
+        :type key: hashable
+        :param func: The call to make if none with the key is in flight
+        :type func: callable
+        :return: The result of the call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call(object):
+    """
+    A call in flight in a _SingleFlight
+    """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Deadline(object):
+    """
+    Tracks the time left for a lookup. A deadline of None never expires.
+    """
+    def __init__(self, seconds):
+        """
+        :param seconds: the seconds the lookup may take, or None
+        :type seconds: float
+        """
+        self._seconds = seconds
+        self._expires_at = None if seconds is None else time.time() + seconds
+
+    @property
+    def expired(self):
+        """
+        :return: True once the deadline has passed
+        :rtype: bool
+        """
+        return self._expires_at is not None and time.time() >= self._expires_at
+
+    def remaining(self):
+        """
+        :return: The seconds left, or None without a deadline
+        :rtype: float
+        """
+        if self._expires_at is None:
+            return None
+        return max(0.0, self._expires_at - time.time())
+
+    def share(self, sources_left):
+        """
+        :param sources_left: The number of sources still to be tried
+        :type sources_left: int
+        :return: The seconds each remaining source may take, or None without a deadline
+        :rtype: float
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        return remaining / max(1, sources_left)
+
+    def describe(self):
+        """
+        :return: A note for error messages when the deadline has passed
+        :rtype: str
+        """
+        if self.expired:
+            return " within the {}s deadline".format(self._seconds)
+        return ""
+
+
+class _Consensus(object):
+    """
+    Tallies fetch results by IP until enough sources agree on one and their
+    merged info provides the required keys.
+    """
+    def __init__(self, min_source_agreement, required_info_keys=None):
+        """
+        :param min_source_agreement: The minimum number of sources that must agree
+        :type min_source_agreement: int
+        :param required_info_keys: Keys that are required in the merged info
+        :type required_info_keys: list
+        """
+        self._min_source_agreement = min_source_agreement
+        self._required_info_keys = required_info_keys
+        self._results = collections.defaultdict(list)
+
+    def add(self, result):
+        """
+        Adds a result to the tally
+        :param result: The result of a fetch
+        :type result: echoip.sources.FetchResult
+        :return: The agreed result, with the merged info of the agreeing sources and
+        their comma separated ids, once there is agreement, else None
+        :rtype: echoip.sources.FetchResult or None
+        """
+        ip_results = self._results[result.ip_address]
+        ip_results.append(result)
+        if len(ip_results) < self._min_source_agreement:
+            return None
+
+        # The earliest response wins for duplicate keys; a single source with info
+        # is shared as it is
+        info = sources.FrozenInfo.merge(src_result.info for src_result in ip_results)
+
+        if IPProvider._verify_required_keys(info, self._required_info_keys):
+            return sources.FetchResult(result.ip_address, info, time.time(), None,
+                                       ','.join(str(src_result.source_id) for src_result in ip_results))
+        return None
 
 
 class InsufficientSourcesForAgreementError(Exception):
@@ -257,3 +1193,11 @@ class NullResponseFromSourcesError(Exception):
     Exception raised when no sources return a valid response
     """
     pass
+
+
+class IPVersionMismatchError(ValueError):
+    """
+    Exception raised when a source answers with an IP of another version than
+    the provider accepts
+    """
+    pass
@@ -7,15 +7,56 @@ source.
 __docformat__ = 'restructuredtext en'
 __author__ = 'Eli Flesher <eli@eflee.us>'
 
-import copy
+import collections
+import json
 import random
+import socket
+import struct
 import sys
+import time
 
+import six
 import zope.interface
 from zope.interface.declarations import implementer
 import requests
 import ipaddress
 
+from . import dns
+from . import stun
+from . import tracing
+from . import transport as transport_module
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover - Python 2
+    from collections import Mapping
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+USER_AGENT = "Python Automation using PyEchoIP Library"
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_DATAGRAM_TIMEOUT = 2.0
+# The most bytes of a response body read before the source gives up on it
+DEFAULT_MAX_BYTES = 64 * 1024
+
+# Providers try the sources of a lower tier before those of a higher one: local
+# lookups, then single datagram exchanges, then HTTP requests
+LOCAL_TIER = 0
+DATAGRAM_TIER = 1
+NETWORK_TIER = 2
+
+_IF_INET6_PATH = '/proc/net/if_inet6'
+_SIOCGIFADDR = 0x8915
+# IFA_F_DADFAILED | IFA_F_DEPRECATED | IFA_F_TENTATIVE
+_IFA_F_UNUSABLE = 0x08 | 0x20 | 0x40
+
+_READ_CHUNK_SIZE = 1024
+_JSON_QUOTE, _JSON_ESCAPE = ord('"'), ord('\\')
+_JSON_OPENERS, _JSON_CLOSERS = frozenset(bytearray(b'{[')), frozenset(bytearray(b'}]'))
+
 
 class IIPSource(zope.interface.Interface):
     """
@@ -29,13 +70,137 @@ class IIPSource(zope.interface.Interface):
         Empty Constructor that shouldn't be ran for PyLint
         """
 
-    def fetch(self):
+    def fetch(self, timeout=None):
         """
-        Performs a refresh from source
+        Performs a refresh from source and returns the FetchResult snapshot. When
+        timeout is given the fetch should not take longer than that many seconds.
         """
 
-    ip_address = zope.interface.Attribute("""The current external IP address""")
+    ip_address = zope.interface.Attribute("""The external IP address from the last fetch""")
     info = zope.interface.Attribute("""A Dict of any other information returned by the API""")
+    source_id = zope.interface.Attribute("""A string identifying the source (usually the URL)""")
+    info_keys = zope.interface.Attribute("""The info keys the source returns, or None if not known (optional)""")
+    tier = zope.interface.Attribute("""The tier the source is tried in, lowest first (optional, NETWORK_TIER)""")
+
+
+class FrozenInfo(Mapping):
+    """
+    An immutable mapping holding the info returned by a source. Results are
+    shared between sources, providers and their callers without copying, as
+    none of them can change it; dict(info) gives a mutable copy. The values are
+    kept as returned, so nested JSON objects and lists are not frozen. String
+    keys are interned, as every fetch from a source returns the same keys.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, items=()):
+        """
+        Constructor
+
+        :param items: The info, as a mapping or (key, value) pairs
+        :type items: dict or Iterable
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        self._data = dict((_intern_key(key), value) for key, value in items)
+
+    @classmethod
+    def of(cls, info):
+        """
+        :param info: The info, None for none
+        :type info: dict or FrozenInfo
+        :return: The info as a FrozenInfo, itself if it already is one
+        :rtype: FrozenInfo
+        """
+        if isinstance(info, cls):
+            return info
+        return cls(info) if info else EMPTY_INFO
+
+    @classmethod
+    def merge(cls, infos):
+        """
+        Merges the info of several results, the first one given winning for
+        duplicate keys. An info merged with empty ones is returned as it is.
+        :param infos: The info to merge, earliest first
+        :type infos: Iterable(FrozenInfo)
+        :return: The merged info
+        :rtype: FrozenInfo
+        """
+        non_empty = [info for info in infos if info]
+        if not non_empty:
+            return EMPTY_INFO
+        if len(non_empty) == 1:
+            return cls.of(non_empty[0])
+        data = dict()
+        for info in reversed(non_empty):
+            data.update(info)
+        merged = cls.__new__(cls)
+        merged._data = data
+        return merged
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenInfo):
+            return self._data == other._data
+        if isinstance(other, Mapping):
+            return self._data == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FrozenInfo({!r})'.format(self._data)
+
+    def __reduce__(self):
+        return FrozenInfo, (self._data,)
+
+
+EMPTY_INFO = FrozenInfo()
+
+
+def _intern_key(key):
+    """
+    :param key: An info key
+    :return: The key, interned if it is a str
+    """
+    return six.moves.intern(key) if type(key) is str else key
+
+
+class FetchResult(collections.namedtuple('FetchResult',
+                                         ['ip_address', 'info', 'timestamp', 'latency', 'source_id'])):
+    """
+    An immutable snapshot of a single fetch from an IIPSource.
+
+    :ivar ip_address: The IP returned by the source
+    :ivar info: A FrozenInfo of any additional information returned by the source,
+    a dict given for it is frozen
+    :ivar timestamp: The time.time() at which the fetch completed
+    :ivar latency: The seconds the fetch took, or None if unknown
+    :ivar source_id: The source_id of the source that produced the result
+    """
+    __slots__ = ()
+
+    def __new__(cls, ip_address, info, timestamp, latency, source_id):
+        return super(FetchResult, cls).__new__(cls, ip_address, FrozenInfo.of(info), timestamp, latency,
+                                               source_id)
 
 
 @implementer(IIPSource)
@@ -46,46 +211,178 @@ class SimpleIPSource(object):
     only the IP. The only mutation performed on this response is
     str.strip() to remove white space.
     """
+    info_keys = frozenset()
+    tier = NETWORK_TIER
 
-    def __init__(self, ip_url):
+    def __init__(self, ip_url, transport=None, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES):
         """
         Constructor
         :param ip_url: The URL used to get the IP
         :type ip_url: str
+        :param transport: The pooled transport used for requests, if None each
+        fetch uses a new connection through requests.get
+        :type transport: echoip.transport.HTTPTransport
+        :param timeout: the seconds to wait for the connection and for each read,
+        as a (connect, read) tuple or a single value for both
+        :type timeout: tuple(float, float) or float
+        :param max_bytes: the most bytes of the response read, a longer response
+        fails the fetch with ResponseTooLargeError
+        :type max_bytes: int
         """
         self._ip_url = ip_url
+        self.transport = transport
+        self._timeout = timeout
+        self._max_bytes = max_bytes
         self._ip_address = None
         self._info = None
+        self._last_result = None
+
+    @property
+    def source_id(self):
+        """
+        :return: The URL used to get the IP
+        :rtype: str
+        """
+        return self._ip_url
+
+    @property
+    def last_result(self):
+        """
+        Returns the snapshot from the last fetch, fetching only if the source
+        has never been fetched.
+        :return: The last fetch result
+        :rtype: FetchResult
+        """
+        if self._last_result is None:
+            self.fetch()
+        return self._last_result
 
     @property
     def ip_address(self):
         """
-        Returns the IP from source.
+        Returns the IP from the last fetch. IP addresses are immutable, so it is
+        shared rather than copied.
         :return: The IP
         :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
         """
-        self.fetch()
-        return copy.deepcopy(self._ip_address)
+        return self.last_result.ip_address
 
     @property
     def info(self):
         """
-        Returns a dictionary containing any additional information returned by the API
+        Returns an immutable mapping containing any additional information returned by the API
+        on the last fetch.
         :return: any additional information returned by the API
-        :rtype: dict
+        :rtype: FrozenInfo
         """
-        self.fetch()
-        return self._info
+        return self.last_result.info
 
-    def fetch(self):
+    def fetch(self, timeout=None):
         """
         Performs a refresh from source
-        :return: None
-        :rtype: None
+        :param timeout: the seconds this fetch may take, lowering the configured
+        connect and read timeouts
+        :type timeout: float
+        :return: The snapshot of this fetch
+        :rtype: FetchResult
         """
-        response = requests.get(self._ip_url, headers = {"User-Agent": "Python Automation using PyEchoIP Library"})
-        self._ip_address = ipaddress.ip_address(unicode(response.content.strip()))
-        self._info = dict()
+        start = time.time()
+        with tracing.stage(tracing.REQUEST, source_id=self.source_id):
+            response = self._get(timeout)
+            try:
+                text = self._read(response, None if timeout is None else start + timeout)
+            finally:
+                # Drops the connection if the rest of the body was left unread
+                response.close()
+        ip_address, info = self._parse(text)
+        return self._store_result(ip_address, info, start)
+
+    def _read(self, response, expires_at=None):
+        """
+        Streams the body of a response until it holds a complete answer. The read
+        timeout only bounds each read from the socket, so a body trickling in is
+        also stopped once the fetch is out of time, checked between chunks.
+        :param response: The streamed response
+        :type response: requests.Response
+        :param expires_at: the time.time() the fetch must end by, None for no limit
+        :type expires_at: float
+        :return: The body read
+        :rtype: str
+        :raises requests.Timeout: if the body is still incomplete at expires_at
+        """
+        reader = self._body_reader()
+        for chunk in response.iter_content(chunk_size=_READ_CHUNK_SIZE):
+            if reader.feed(chunk):
+                break
+            if expires_at is not None and time.time() >= expires_at:
+                raise requests.Timeout("{} did not finish answering in time".format(self._ip_url))
+        return reader.text(response.encoding)
+
+    def _body_reader(self):
+        """
+        :return: The reader collecting the response body up to its first line
+        :rtype: _LineReader
+        """
+        return _LineReader(self._max_bytes, self._ip_url)
+
+    def _parse(self, text):
+        """
+        Parses the body returned by the source
+        :param text: The response body
+        :type text: str
+        :return: The IP and any additional information in the response
+        :rtype: tuple(ipaddress.IPv4Address or ipaddress.IPv6Address, FrozenInfo)
+        """
+        with tracing.stage(tracing.IP_PARSE, source_id=self.source_id):
+            return ipaddress.ip_address(six.text_type(text.strip())), EMPTY_INFO
+
+    def _get(self, timeout=None):
+        """
+        Performs the GET against the source URL through the configured transport
+        :param timeout: the seconds the request may take
+        :type timeout: float
+        :return: The streamed response, its body not read yet
+        :rtype: requests.Response
+        """
+        kwargs = {'headers': {"User-Agent": USER_AGENT}, 'timeout': self._request_timeout(timeout), 'stream': True}
+        if self.transport is not None:
+            return self.transport.get(self._ip_url, **kwargs)
+        return requests.get(self._ip_url, **kwargs)
+
+    def _request_timeout(self, timeout=None):
+        """
+        Combines the configured timeout with the time allowed for a single fetch
+        :param timeout: the seconds the fetch may take
+        :type timeout: float
+        :return: The (connect, read) timeout for the request
+        :rtype: tuple(float, float)
+        """
+        if isinstance(self._timeout, (tuple, list)):
+            connect, read = self._timeout
+        else:
+            connect = read = self._timeout
+        if timeout is not None:
+            connect = timeout if connect is None else min(connect, timeout)
+            read = timeout if read is None else min(read, timeout)
+        return connect, read
+
+    def _store_result(self, ip_address, info, start):
+        """
+        Records a successful fetch as the source's snapshot
+        :param ip_address: The parsed IP
+        :type ip_address: ipaddress.IPv4Address or ipaddress.IPv6Address
+        :param info: any additional information returned by the API
+        :type info: dict or FrozenInfo
+        :param start: the time.time() the fetch began
+        :type start: float
+        :return: The snapshot of this fetch
+        :rtype: FetchResult
+        """
+        now = time.time()
+        self._last_result = FetchResult(ip_address, info, now, now - start, self.source_id)
+        self._ip_address = ip_address
+        self._info = self._last_result.info
+        return self._last_result
 
 
 @implementer(IIPSource)
@@ -94,24 +391,36 @@ class JSONIPSource(SimpleIPSource):
     JSON Based IP Sources support providers that return JSON responses like ip-api.com.
     """
 
-    def __init__(self, ip_url, ip_key):
+    def __init__(self, ip_url, ip_key, transport=None, timeout=DEFAULT_TIMEOUT, info_keys=None,
+                 max_bytes=DEFAULT_MAX_BYTES):
         """
         :param ip_url: The URL used to get the IP
         :type ip_url: str
         :param ip_key: The key in the json response used to encapsulate the IP
         :type ip_key: str
+        :param transport: The pooled transport used for requests
+        :type transport: echoip.transport.HTTPTransport
+        :param timeout: the (connect, read) seconds to wait for the source
+        :type timeout: tuple(float, float) or float
+        :param info_keys: the info keys the source returns, None if not known
+        :type info_keys: Iterable
+        :param max_bytes: the most bytes of the response read
+        :type max_bytes: int
         """
-        super(JSONIPSource, self).__init__(ip_url)
+        super(JSONIPSource, self).__init__(ip_url, transport, timeout, max_bytes)
         self._ip_key = ip_key
+        self.info_keys = frozenset(info_keys) if info_keys is not None else None
 
-    def fetch(self):
+    def _parse(self, text):
         """
-        Performs a refresh from source
-        :return: None
-        :rtype: None
+        Parses the JSON body returned by the source
+        :param text: The response body
+        :type text: str
+        :return: The IP and the remainder of the response
+        :rtype: tuple(ipaddress.IPv4Address or ipaddress.IPv6Address, FrozenInfo)
         """
-        response = requests.get(self._ip_url, headers = {"User-Agent": "Python Automation using PyEchoIP Library"})
-        raw_response = response.json()
+        with tracing.stage(tracing.JSON_DECODE, source_id=self.source_id):
+            raw_response = json.loads(text)
         try:
             raw_ip = raw_response[self._ip_key]
             if isinstance(raw_ip, (tuple, list)):
@@ -122,16 +431,395 @@ class JSONIPSource(SimpleIPSource):
         except IndexError:
             raise InvalidJSONSourceIPValue("The Value returned for the IP key was an empty list")
 
-        self._ip_address = ipaddress.ip_address(unicode(raw_ip))
+        with tracing.stage(tracing.IP_PARSE, source_id=self.source_id):
+            ip_address = ipaddress.ip_address(six.text_type(raw_ip))
+
+        return ip_address, FrozenInfo((key, value) for key, value in raw_response.items() if key != self._ip_key)
+
+    def _body_reader(self):
+        """
+        :return: The reader collecting the response body up to the end of its JSON value
+        :rtype: _JSONReader
+        """
+        return _JSONReader(self._max_bytes, self._ip_url)
+
+
+class _LineReader(object):
+    """
+    Collects a streamed response body until its first non-blank line ends,
+    failing once the body outgrows the byte limit
+    """
+
+    def __init__(self, max_bytes, url):
+        """
+        Constructor
+
+        :param max_bytes: the most bytes collected
+        :type max_bytes: int
+        :param url: the URL read, for error messages
+        :type url: str
+        """
+        self._max_bytes = max_bytes
+        self._url = url
+        self._body = bytearray()
+        self._content_start = None
+
+    def feed(self, chunk):
+        """
+        Adds the next chunk of the body
+        :param chunk: The bytes received
+        :type chunk: bytes
+        :return: True once the answer is complete and the rest of the body can be left unread
+        :rtype: bool
+        """
+        offset = len(self._body)
+        self._body.extend(chunk)
+        end = self._scan(offset)
+        if (len(self._body) if end is None else end) > self._max_bytes:
+            raise ResponseTooLargeError("Response from {} is larger than {} bytes".format(self._url, self._max_bytes))
+        if end is None:
+            return False
+        del self._body[end:]
+        return True
+
+    def text(self, encoding=None):
+        """
+        :param encoding: The charset of the response, utf-8 if None
+        :type encoding: str
+        :return: The body collected
+        :rtype: str
+        """
+        return self._body.decode(encoding or 'utf-8', 'replace')
+
+    def _scan(self, offset):
+        """
+        :param offset: The index the chunk just added starts at
+        :type offset: int
+        :return: The index the answer ends at, None if it has not ended yet
+        :rtype: int
+        """
+        if self._content_start is None:
+            content = self._body[offset:].lstrip()
+            if not content:
+                return None
+            self._content_start = offset = len(self._body) - len(content)
+        end = self._body.find(b'\n', offset)
+        return None if end == -1 else end
+
+
+class _JSONReader(_LineReader):
+    """
+    Collects a streamed response body until its top-level JSON object or
+    array closes, tracking the nesting outside of strings as chunks arrive
+    """
+
+    def __init__(self, max_bytes, url):
+        super(_JSONReader, self).__init__(max_bytes, url)
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def _scan(self, offset):
+        body = self._body
+        for index in range(offset, len(body)):
+            byte = body[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif byte == _JSON_ESCAPE:
+                    self._escaped = True
+                elif byte == _JSON_QUOTE:
+                    self._in_string = False
+            elif byte == _JSON_QUOTE:
+                self._in_string = True
+            elif byte in _JSON_OPENERS:
+                self._depth += 1
+            elif byte in _JSON_CLOSERS:
+                self._depth -= 1
+                if self._depth == 0:
+                    return index + 1
+        return None
+
+
+class _SnapshotSource(object):
+    """
+    Base of the sources that are not fetched over HTTP, keeping the snapshot
+    of their last fetch.
+    """
+    _last_result = None
+
+    @property
+    def last_result(self):
+        """
+        Returns the snapshot from the last fetch, fetching only if the source
+        has never been fetched.
+        :return: The last fetch result
+        :rtype: FetchResult
+        """
+        if self._last_result is None:
+            self.fetch()
+        return self._last_result
+
+    @property
+    def ip_address(self):
+        """
+        :return: The IP from the last fetch
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        return self.last_result.ip_address
+
+    @property
+    def info(self):
+        """
+        :return: any additional information from the last fetch
+        :rtype: FrozenInfo
+        """
+        return self.last_result.info
+
+    def _snapshot(self, ip_address, info, start):
+        """
+        Records a successful fetch as the source's snapshot
+        :param ip_address: The IP found
+        :type ip_address: ipaddress.IPv4Address or ipaddress.IPv6Address
+        :param info: any additional information found
+        :type info: dict or FrozenInfo
+        :param start: the time.time() the fetch began
+        :type start: float
+        :return: The snapshot of this fetch
+        :rtype: FetchResult
+        """
+        now = time.time()
+        self._last_result = FetchResult(ip_address, info, now, now - start, self.source_id)
+        return self._last_result
+
+
+@implementer(IIPSource)
+class LocalInterfaceIPSource(_SnapshotSource):
+    """
+    The LocalInterfaceIPSource answers without a request when the host holds a
+    global address on one of its interfaces. It asks the OS which local address
+    it would send from to reach the internet (connecting a UDP socket sends no
+    packet) and returns it if it is in a global range. Behind a NAT the address
+    is private and the fetch fails with NoGlobalAddressError, so providers move
+    on to their network sources. It is in the LOCAL_TIER, tried before them.
+    """
+    info_keys = frozenset(['interface'])
+    tier = LOCAL_TIER
+
+    # Any internet address will do, the route is looked up without sending to it
+    _probe_addresses = {4: '8.8.8.8', 6: '2001:4860:4860::8888'}
+
+    def __init__(self, versions=(4, 6)):
+        """
+        Constructor
+        :param versions: the IP versions looked up, in order of preference
+        :type versions: tuple(int)
+        """
+        self._versions = tuple(versions)
+
+    @property
+    def source_id(self):
+        """
+        :return: An identifier for the local source
+        :rtype: str
+        """
+        return 'local:' + ','.join('ipv{}'.format(version) for version in self._versions)
 
-        self._info = raw_response
-        del self._info[self._ip_key]
+    def fetch(self, timeout=None):
+        """
+        Looks up the local address used to reach the internet
+        :param timeout: Unused, the lookup does not touch the network
+        :type timeout: float
+        :return: The snapshot of this fetch
+        :rtype: FetchResult
+        """
+        start = time.time()
+        for version in self._versions:
+            ip_address = self._route_address(version)
+            if ip_address is not None and ip_address.is_global and not ip_address.is_multicast:
+                interface = self._interface_addresses().get(ip_address)
+                info = {'interface': interface} if interface is not None else EMPTY_INFO
+                return self._snapshot(ip_address, info, start)
+        raise NoGlobalAddressError("No local interface holds a global address")
+
+    def _route_address(self, version):
+        """
+        :param version: The IP version
+        :type version: int
+        :return: The local address the OS routes internet traffic from, None without a route
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        family = socket.AF_INET if version == 4 else socket.AF_INET6
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+        except (IOError, OSError):
+            return None
+        try:
+            sock.connect((self._probe_addresses[version], 53))
+            return ipaddress.ip_address(six.text_type(sock.getsockname()[0].split('%')[0]))
+        except (IOError, OSError):
+            return None
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _interface_addresses():
+        """
+        Reads the addresses held by the local interfaces, the IPv6 ones from
+        /proc/net/if_inet6 and the primary IPv4 one of each interface through
+        ioctl (both Linux only)
+        :return: The name of the interface holding each address
+        :rtype: dict
+        """
+        addresses = dict()
+        try:
+            with open(_IF_INET6_PATH) as if_inet6:
+                for line in if_inet6:
+                    fields = line.split()
+                    if len(fields) == 6 and not int(fields[4], 16) & _IFA_F_UNUSABLE:
+                        addresses[ipaddress.IPv6Address(int(fields[0], 16))] = fields[5]
+        except (IOError, OSError, ValueError):
+            pass
+
+        if fcntl is None or not hasattr(socket, 'if_nameindex'):
+            return addresses
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for _, name in socket.if_nameindex():
+                try:
+                    request = struct.pack('256s', name[:15].encode('utf-8'))
+                    packed = fcntl.ioctl(sock.fileno(), _SIOCGIFADDR, request)
+                except (IOError, OSError):
+                    continue
+                addresses[ipaddress.IPv4Address(struct.unpack('!I', packed[20:24])[0])] = name
+        finally:
+            sock.close()
+        return addresses
+
+
+@implementer(IIPSource)
+class DNSIPSource(_SnapshotSource):
+    """
+    DNS Based IP Sources ask a DNS server that answers a query with the address
+    of the client, like myip.opendns.com (A or AAAA) on the OpenDNS resolvers or
+    o-o.myaddr.l.google.com (TXT) on ns1.google.com. A lookup is a single UDP
+    datagram exchange, so the source is in the DATAGRAM_TIER.
+    """
+    info_keys = frozenset()
+    tier = DATAGRAM_TIER
+
+    def __init__(self, resolver, query_name, record_type='A', record_class='IN', port=53,
+                 timeout=DEFAULT_DATAGRAM_TIMEOUT):
+        """
+        Constructor
+        :param resolver: The address or host name of the DNS server asked
+        :type resolver: str
+        :param query_name: The name whose answer is the address of the client
+        :type query_name: str
+        :param record_type: 'A', 'AAAA' or 'TXT'
+        :type record_type: str
+        :param record_class: 'IN', or 'CH' for servers answering chaos queries
+        :type record_class: str
+        :param port: The port of the DNS server
+        :type port: int
+        :param timeout: the seconds to wait for the answer
+        :type timeout: float
+        """
+        try:
+            self._record_type = dns.RECORD_TYPES[record_type.upper()]
+            self._record_class = dns.RECORD_CLASSES[record_class.upper()]
+        except KeyError:
+            raise ValueError("Unsupported DNS record type or class {} {}".format(record_class, record_type))
+        self._resolver = resolver
+        self._query_name = query_name
+        self._port = port
+        self._timeout = timeout
+        self._source_id = 'dns://{}:{}/{}?type={}'.format(resolver, port, query_name, record_type.upper())
+
+    @property
+    def source_id(self):
+        """
+        :return: The server, name and record type queried
+        :rtype: str
+        """
+        return self._source_id
+
+    def fetch(self, timeout=None):
+        """
+        Queries the DNS server
+        :param timeout: the seconds this fetch may take, lowering the configured timeout
+        :type timeout: float
+        :return: The snapshot of this fetch
+        :rtype: FetchResult
+        """
+        start = time.time()
+        with tracing.stage(tracing.REQUEST, source_id=self.source_id):
+            answers = dns.query(self._resolver, self._query_name, self._record_type, self._record_class,
+                                self._port, self._timeout if timeout is None else min(self._timeout, timeout))
+        for _, data in answers:
+            try:
+                return self._snapshot(ipaddress.ip_address(six.text_type(data).strip().strip('"')), EMPTY_INFO, start)
+            except ValueError:
+                # TXT answers may carry other text, such as the EDNS client subnet
+                continue
+        raise dns.DNSResponseError("No address in the answer from {}".format(self._resolver))
+
+
+@implementer(IIPSource)
+class STUNIPSource(_SnapshotSource):
+    """
+    STUN Based IP Sources send a Binding Request (RFC 5389) to a STUN server,
+    like stun.l.google.com:19302, which answers with the address and port it
+    saw the request come from. The mapped port is returned in info as
+    'mapped_port'. A lookup is a single UDP datagram exchange, so the source is
+    in the DATAGRAM_TIER.
+    """
+    info_keys = frozenset(['mapped_port'])
+    tier = DATAGRAM_TIER
+
+    def __init__(self, server, port=3478, timeout=DEFAULT_DATAGRAM_TIMEOUT):
+        """
+        Constructor
+        :param server: The address or host name of the STUN server
+        :type server: str
+        :param port: The port of the STUN server
+        :type port: int
+        :param timeout: the seconds to wait for the answer
+        :type timeout: float
+        """
+        self._server = server
+        self._port = port
+        self._timeout = timeout
+
+    @property
+    def source_id(self):
+        """
+        :return: The STUN server asked
+        :rtype: str
+        """
+        return 'stun:{}:{}'.format(self._server, self._port)
+
+    def fetch(self, timeout=None):
+        """
+        Sends a Binding Request to the STUN server
+        :param timeout: the seconds this fetch may take, lowering the configured timeout
+        :type timeout: float
+        :return: The snapshot of this fetch
+        :rtype: FetchResult
+        """
+        start = time.time()
+        with tracing.stage(tracing.REQUEST, source_id=self.source_id):
+            ip_address, mapped_port = stun.binding(self._server, self._port,
+                                                   self._timeout if timeout is None else min(self._timeout, timeout))
+        return self._snapshot(ip_address, {'mapped_port': mapped_port}, start)
 
 
 class IPSourceFactory(object):
     """
     A Factory that can be used to generate IIPSource providers
     """
+    _source_interface = IIPSource
+
     # noinspection PyPep8
     _builtin_sources = {'ip-api.com': (JSONIPSource, 'http://ip-api.com/json', 'query'),
                         'ipinfo.io': (JSONIPSource, 'http://ipinfo.io/json', 'ip'),
@@ -142,39 +830,63 @@ class IPSourceFactory(object):
                         'l2.io': (SimpleIPSource, 'http://l2.io/ip'),
                         'curlmyip.com': (SimpleIPSource, 'http://curlmyip.com/')}
 
-    def __init__(self, use_builtins=True):
+    # The info keys returned by the builtin JSON sources, declared on the sources
+    # so that providers only ask sources that can answer an info lookup
+    _builtin_info_keys = {'ip-api.com': ('status', 'country', 'countryCode', 'region', 'regionName',
+                                         'city', 'zip', 'lat', 'lon', 'timezone', 'isp', 'org', 'as'),
+                          'ipinfo.io': ('hostname', 'city', 'region', 'country', 'loc', 'org',
+                                        'postal', 'timezone'),
+                          'httpbin.org': ('args', 'headers', 'url'),
+                          'wtfismyip.com': ('YourFuckingLocation', 'YourFuckingHostname', 'YourFuckingISP',
+                                            'YourFuckingTorExit', 'YourFuckingCountryCode')}
+
+    def __init__(self, use_builtins=True, transport=None):
         """
         A Factory that can be used to generate IIPSource providers
         :param use_builtins: there are a number of built-in sources
         available in this library, this option includes them by
         default in the factory.
         :type use_builtins: bool
+        :param transport: The transport shared by all generated sources that
+        accept one, a pooled HTTPTransport is created if None
+        :type transport: echoip.transport.HTTPTransport
         """
         self._sources = set()
+        self._info_keys = dict()
+        self._transport = transport if transport is not None else self._build_transport()
         if use_builtins:
-            for args in self._builtin_sources.values():
-                self.add_source(*args)
+            for name, args in self._builtin_sources.items():
+                self.add_source(*args, info_keys=self._builtin_info_keys.get(name))
 
-    def add_source(self, source_class, *constructor_args):
+    def add_source(self, source_class, *constructor_args, **options):
         """
         Adds a source to the factory provided it's type and constructor arguments
         :param source_class: The class used to instantiate the source
         :type source_class: type
         :param constructor_args: Arguments to be passed into the constructor
         :type constructor_args: Iterable
+        :param info_keys: keyword only, the info keys the source returns, declared on
+        the generated sources
+        :type info_keys: Iterable
         """
-        if not IIPSource.implementedBy(source_class):
-            raise TypeError("source_class {} must implement IIPSource".format(source_class))
+        if not self._source_interface.implementedBy(source_class):
+            raise TypeError("source_class {} must implement {}"
+                            .format(source_class, self._source_interface.__name__))
         else:
             self._sources.add((source_class, constructor_args))
+            if options.get('info_keys') is not None:
+                self._info_keys[(source_class, constructor_args)] = frozenset(options['info_keys'])
 
-    def get_sources(self, limit=sys.maxsize, types_list=None):
+    def get_sources(self, limit=sys.maxsize, types_list=None, transport=None):
         """
         Generates instantiated sources from the factory
         :param limit: the max number of sources to yield
         :type limit: int
         :param types_list: filter by types so the constructor can be used to accomidate many types
         :type types_list: class or list of classes
+        :param transport: the transport given to the sources instead of the factory's,
+        for example one pinned to an egress path
+        :type transport: echoip.transport.HTTPTransport
         :return: Yields types added by add_source
         :rtype: generator
         """
@@ -187,11 +899,57 @@ class IPSourceFactory(object):
         for source in sources:
             if not types_list or source[0] in types_list:
                 limit -= 1
-                yield source[0](*source[1])
+                yield self._declare_info_keys(self._inject_transport(source[0](*source[1]), transport),
+                                              self._info_keys.get(source))
 
             if limit <= 0:
                 break
 
+    @staticmethod
+    def _build_transport():
+        """
+        :return: The transport shared by generated sources when none is given
+        :rtype: echoip.transport.HTTPTransport
+        """
+        return transport_module.HTTPTransport()
+
+    def _inject_transport(self, source, transport=None):
+        """
+        Shares the factory transport with a generated source unless the source
+        was configured with its own
+        :param source: A newly generated source
+        :type source: IIPSource provider
+        :param transport: the transport to share instead of the factory's
+        :type transport: echoip.transport.HTTPTransport
+        :return: The source
+        :rtype: IIPSource provider
+        """
+        if hasattr(source, 'transport') and source.transport is None:
+            source.transport = transport if transport is not None else self._transport
+        return source
+
+    @staticmethod
+    def _declare_info_keys(source, info_keys):
+        """
+        :param source: A newly generated source
+        :type source: IIPSource provider
+        :param info_keys: The info keys added with the source, if any
+        :type info_keys: frozenset
+        :return: The source
+        :rtype: IIPSource provider
+        """
+        if info_keys is not None:
+            source.info_keys = info_keys
+        return source
+
+    @property
+    def transport(self):
+        """
+        :return: The transport shared by generated sources
+        :rtype: echoip.transport.HTTPTransport
+        """
+        return self._transport
+
     @property
     def num_sources(self):
         """
@@ -201,12 +959,27 @@ class IPSourceFactory(object):
         return len(self._sources)
 
 
-class InvalidJSONSourceIPKey(Exception):
+class InvalidJSONSourceIPKey(ValueError):
     """
     Thrown when the key configured for the JSONIPSource is not in the returned dict
     """
 
-class InvalidJSONSourceIPValue(Exception):
+
+class InvalidJSONSourceIPValue(ValueError):
     """
     Thrown when the key configured for the JSONIPSource is not in the returned dict
-    """
\ No newline at end of file
+    """
+
+
+class ResponseTooLargeError(ValueError):
+    """
+    Raised when the response of a source is longer than its byte limit
+    """
+    pass
+
+
+class NoGlobalAddressError(ValueError):
+    """
+    Raised by the LocalInterfaceIPSource when the host holds no global address
+    """
+    pass
@@ -0,0 +1,169 @@
+"""
+A minimal STUN client (RFC 5389): it sends one Binding Request in a
+single UDP datagram and returns the address and port the server saw the
+request come from, which is the address a NAT mapped the client to.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import os
+import socket
+import struct
+import time
+
+import ipaddress
+
+MAGIC_COOKIE = 0x2112A442
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+BINDING_ERROR = 0x0111
+
+ATTRIBUTE_MAPPED_ADDRESS = 0x0001
+ATTRIBUTE_ERROR_CODE = 0x0009
+ATTRIBUTE_XOR_MAPPED_ADDRESS = 0x0020
+
+_HEADER = struct.Struct('!HHI12s')
+_ATTRIBUTE = struct.Struct('!HH')
+_FAMILY_IPV4 = 0x01
+_FAMILY_IPV6 = 0x02
+_MAX_MESSAGE = 2048
+
+
+def build_binding_request(transaction_id):
+    """
+    Encodes a Binding Request without attributes
+    :param transaction_id: The 12 byte transaction identifier
+    :type transaction_id: bytes
+    :return: The request message
+    :rtype: bytes
+    """
+    return _HEADER.pack(BINDING_REQUEST, 0, MAGIC_COOKIE, transaction_id)
+
+
+def parse_binding_response(message, transaction_id):
+    """
+    Decodes the mapped address from a Binding Response, preferring the
+    XOR-MAPPED-ADDRESS and falling back to the MAPPED-ADDRESS of servers
+    implementing RFC 3489
+    :param message: The response message
+    :type message: bytes
+    :param transaction_id: The transaction identifier of the request
+    :type transaction_id: bytes
+    :return: The mapped address and port
+    :rtype: tuple(ipaddress.IPv4Address or ipaddress.IPv6Address, int)
+    """
+    message = bytes(message)
+    if not _answers(message, transaction_id):
+        raise STUNResponseError("Message is not a response to the Binding Request")
+    message_type, length, _, _ = _HEADER.unpack_from(message, 0)
+
+    attributes, offset = dict(), _HEADER.size
+    end = min(len(message), _HEADER.size + length)
+    while offset + _ATTRIBUTE.size <= end:
+        attribute_type, attribute_length = _ATTRIBUTE.unpack_from(message, offset)
+        offset += _ATTRIBUTE.size
+        attributes.setdefault(attribute_type, message[offset:offset + attribute_length])
+        # Attribute values are padded to a multiple of four bytes
+        offset += (attribute_length + 3) & ~3
+
+    if message_type == BINDING_ERROR:
+        raise STUNResponseError("Server answered with error {}".format(_error_code(attributes)))
+    if ATTRIBUTE_XOR_MAPPED_ADDRESS in attributes:
+        mask = struct.pack('!I', MAGIC_COOKIE) + transaction_id
+        return _decode_address(attributes[ATTRIBUTE_XOR_MAPPED_ADDRESS], mask)
+    if ATTRIBUTE_MAPPED_ADDRESS in attributes:
+        return _decode_address(attributes[ATTRIBUTE_MAPPED_ADDRESS], None)
+    raise STUNResponseError("Binding Response without a mapped address")
+
+
+def binding(server, port=3478, timeout=2.0):
+    """
+    Sends a Binding Request to a server in one datagram and waits for its
+    response, ignoring datagrams that do not answer it
+    :param server: The address or host name of the server
+    :type server: str
+    :param port: The port of the server
+    :type port: int
+    :param timeout: The seconds to wait for the response
+    :type timeout: float
+    :return: The mapped address and port
+    :rtype: tuple(ipaddress.IPv4Address or ipaddress.IPv6Address, int)
+    """
+    family, _, _, _, address = socket.getaddrinfo(server, port, 0, socket.SOCK_DGRAM)[0]
+    transaction_id = os.urandom(12)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        # Connected, so only datagrams from the server are received
+        sock.connect(address)
+        sock.send(build_binding_request(transaction_id))
+        give_up = time.time() + timeout
+        while True:
+            sock.settimeout(max(give_up - time.time(), 0.001))
+            message = sock.recv(_MAX_MESSAGE)
+            if _answers(message, transaction_id):
+                return parse_binding_response(message, transaction_id)
+    finally:
+        sock.close()
+
+
+def _answers(message, transaction_id):
+    """
+    :param message: A message received
+    :type message: bytes
+    :param transaction_id: The transaction identifier of the request
+    :type transaction_id: bytes
+    :return: True if the message is a response to the request
+    :rtype: bool
+    """
+    if len(message) < _HEADER.size:
+        return False
+    message_type, _, cookie, response_id = _HEADER.unpack_from(message, 0)
+    return (message_type in (BINDING_SUCCESS, BINDING_ERROR) and cookie == MAGIC_COOKIE and
+            response_id == transaction_id)
+
+
+def _decode_address(value, mask):
+    """
+    :param value: The value of a (XOR-)MAPPED-ADDRESS attribute
+    :type value: bytes
+    :param mask: The magic cookie and transaction id the address is XORed
+    with, None if it is not
+    :type mask: bytes
+    :return: The address and port
+    :rtype: tuple(ipaddress.IPv4Address or ipaddress.IPv6Address, int)
+    """
+    value = bytearray(value)
+    sizes = {_FAMILY_IPV4: 4, _FAMILY_IPV6: 16}
+    if len(value) < 4 or value[1] not in sizes or len(value) < 4 + sizes[value[1]]:
+        raise STUNResponseError("Malformed mapped address")
+    family, port = value[1], struct.unpack_from('!H', value, 2)[0]
+    packed = value[4:4 + sizes[family]]
+    if mask is not None:
+        mask = bytearray(mask)
+        port ^= MAGIC_COOKIE >> 16
+        packed = bytearray(byte ^ mask[index] for index, byte in enumerate(packed))
+    number = 0
+    for byte in packed:
+        number = number << 8 | byte
+    address = ipaddress.IPv4Address(number) if family == _FAMILY_IPV4 else ipaddress.IPv6Address(number)
+    return address, port
+
+
+def _error_code(attributes):
+    """
+    :param attributes: The attributes of an error response
+    :type attributes: dict
+    :return: The error code and reason, or 'unknown'
+    :rtype: str
+    """
+    value = bytearray(attributes.get(ATTRIBUTE_ERROR_CODE, b''))
+    if len(value) < 4:
+        return 'unknown'
+    return '{} {}'.format((value[2] & 0x07) * 100 + value[3], bytes(value[4:]).decode('utf-8', 'replace'))
+
+
+class STUNResponseError(ValueError):
+    """
+    Raised when a STUN response is malformed or reports an error
+    """
+    pass
@@ -0,0 +1,147 @@
+"""
+Tracing hooks time each stage of a lookup: the request to a source, the
+decoding of its response, the parsing of the IP, the check of the required
+info keys and the multisource agreement round, which spans the fetches of the
+round as well as the agreement of their results. Hooks are set for the whole
+process with set_hooks; until then stages cost a function call returning a
+shared no-op context manager. OpenTelemetryHooks reports the stages as spans
+of an OpenTelemetry tracer.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+from timeit import default_timer
+
+REQUEST = 'echoip.request'
+JSON_DECODE = 'echoip.json_decode'
+IP_PARSE = 'echoip.ip_parse'
+VERIFY_KEYS = 'echoip.verify_keys'
+CONSENSUS = 'echoip.consensus'
+
+_hooks = None
+
+
+class StageHooks(object):
+    """
+    Base class of tracing hooks. on_start is called when a stage starts and its
+    return value is handed back to on_end when the stage ends.
+    """
+
+    def on_start(self, stage, context):
+        """
+        :param stage: The stage starting, such as REQUEST
+        :type stage: str
+        :param context: Describes the stage, such as the source_id of the source
+        :type context: dict
+        :return: Any state the hooks need when the stage ends
+        """
+        return None
+
+    def on_end(self, stage, context, state, duration, error=None):
+        """
+        :param stage: The stage ending
+        :type stage: str
+        :param context: Describes the stage
+        :type context: dict
+        :param state: The value returned by on_start
+        :param duration: The seconds the stage took
+        :type duration: float
+        :param error: The exception that ended the stage, None if it completed
+        :type error: Exception
+        """
+
+
+class OpenTelemetryHooks(StageHooks):
+    """
+    Reports every stage as a span of an OpenTelemetry tracer (or any tracer with
+    a start_as_current_span context manager), made current while the stage runs
+    so that nested stages become its children. Failed stages record their
+    exception on the span.
+    """
+
+    def __init__(self, tracer):
+        """
+        Constructor
+
+        :param tracer: The tracer, such as opentelemetry.trace.get_tracer('echoip')
+        """
+        self._tracer = tracer
+
+    def on_start(self, stage, context):
+        span_manager = self._tracer.start_as_current_span(stage, attributes=dict(context))
+        span_manager.__enter__()
+        return span_manager
+
+    def on_end(self, stage, context, state, duration, error=None):
+        if error is None:
+            state.__exit__(None, None, None)
+        else:
+            state.__exit__(type(error), error, getattr(error, '__traceback__', None))
+
+
+def set_hooks(hooks):
+    """
+    Sets the hooks called around every stage in the process
+    :param hooks: The hooks, None to disable tracing
+    :type hooks: StageHooks
+    """
+    global _hooks
+    _hooks = hooks
+
+
+def get_hooks():
+    """
+    :return: The hooks called around every stage, None when tracing is disabled
+    :rtype: StageHooks
+    """
+    return _hooks
+
+
+def stage(name, **context):
+    """
+    Times a stage of a lookup as a context manager
+    :param name: The stage, such as REQUEST
+    :type name: str
+    :param context: Describes the stage to the hooks
+    :return: The context manager reporting the stage to the hooks
+    """
+    if _hooks is None:
+        return _NULL_STAGE
+    return _Stage(_hooks, name, context)
+
+
+class _NullStage(object):
+    """
+    The context manager used while tracing is disabled
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """
+    Reports a stage to the hooks when it starts and ends
+    """
+    __slots__ = ('_hooks', '_name', '_context', '_state', '_start')
+
+    def __init__(self, hooks, name, context):
+        self._hooks = hooks
+        self._name = name
+        self._context = context
+
+    def __enter__(self):
+        self._state = self._hooks.on_start(self._name, self._context)
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._hooks.on_end(self._name, self._context, self._state, default_timer() - self._start, exc_value)
+        return False
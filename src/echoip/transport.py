@@ -0,0 +1,255 @@
+"""
+Transports hold the pooled HTTP sessions used by sources so that
+repeated fetches reuse keep-alive connections instead of opening a
+new connection (and TLS session) for every request. A transport can
+be pinned to an egress path: a proxy, a local address or an interface,
+and to an address family.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import collections
+import socket
+import threading
+
+import ipaddress
+import requests
+import six
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.util.retry import Retry
+from six.moves.urllib.parse import urlsplit
+
+# Binding to the wildcard address of a family fails for the addresses of the
+# other family, so connections are only made to addresses of that family
+_WILDCARD_ADDRESSES = {socket.AF_INET: '0.0.0.0', socket.AF_INET6: '::'}
+
+
+class Egress(collections.namedtuple('Egress', ['proxy', 'source_address', 'interface'])):
+    """
+    An egress path requests leave the host by: a proxy URL, a local address
+    to bind to or the name of an interface to bind to (Linux only).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, config):
+        """
+        Parses an egress path from a proxy URL ('http://proxy:3128',
+        'socks5://127.0.0.1:1080'), a local IP address ('192.0.2.10') or an
+        interface name ('eth1')
+        :param config: The egress path
+        :type config: str or Egress
+        :return: The egress path
+        :rtype: Egress
+        """
+        if isinstance(config, cls):
+            return config
+        if '://' in config:
+            return cls(config, None, None)
+        try:
+            return cls(None, str(ipaddress.ip_address(six.text_type(config))), None)
+        except ValueError:
+            return cls(None, None, config)
+
+
+class HTTPTransport(object):
+    """
+    The HTTPTransport holds one pooled requests.Session per host. It is
+    intended to be shared by many sources (the IPSourceFactory injects
+    one into every source it generates) and is safe to use from
+    multiple threads.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True,
+                 max_retries=0, backoff_factor=0, retry_statuses=(502, 503, 504), egress=None, family=None):
+        """
+        Constructor
+
+        :param pool_connections: the number of connection pools to cache per session
+        :type pool_connections: int
+        :param pool_maxsize: the maximum number of connections kept alive per pool
+        :type pool_maxsize: int
+        :param keep_alive: reuse connections between requests, when False every
+        request is sent with "Connection: close"
+        :type keep_alive: bool
+        :param max_retries: the number of times a failed request is retried
+        :type max_retries: int
+        :param backoff_factor: the urllib3 backoff factor applied between retries
+        :type backoff_factor: float
+        :param retry_statuses: HTTP statuses that are retried
+        :type retry_statuses: tuple(int)
+        :param egress: the egress path every request leaves by, see Egress.parse
+        :type egress: Egress or str
+        :param family: socket.AF_INET or socket.AF_INET6 to only connect over that
+        address family, None for either
+        :type family: int
+        """
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._keep_alive = keep_alive
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._retry_statuses = retry_statuses
+        self._egress = Egress.parse(egress) if egress is not None else None
+        self._family = family
+        self._connection_kwargs = self._egress_connection_kwargs(self._egress, family)
+
+        self._sessions = dict()
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        """
+        Performs a GET using the pooled session for the URL's host
+        :param url: The URL to get
+        :type url: str
+        :param kwargs: Keyword arguments passed on to requests.Session.get
+        :return: The response
+        :rtype: requests.Response
+        """
+        return self.session_for(url).get(url, **kwargs)
+
+    def session_for(self, url):
+        """
+        Returns the pooled session for the URL's host, creating it if needed
+        :param url: The URL the session will be used for
+        :type url: str
+        :return: The session for the host
+        :rtype: requests.Session
+        """
+        host = self._host_key(url)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = self._sessions[host] = self._build_session()
+        return session
+
+    def close(self):
+        """
+        Closes all pooled sessions and their connections
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, dict()
+        for session in sessions.values():
+            session.close()
+
+    @property
+    def egress(self):
+        """
+        :return: The egress path requests leave by, None for the default route
+        :rtype: Egress
+        """
+        return self._egress
+
+    @property
+    def family(self):
+        """
+        :return: The address family connections are made over, None for either
+        :rtype: int
+        """
+        return self._family
+
+    @property
+    def num_sessions(self):
+        """
+        :return: The number of hosts with a pooled session
+        :rtype: int
+        """
+        return len(self._sessions)
+
+    def _build_session(self):
+        """
+        Creates a session with the configured pooling and retry adapters mounted
+        :return: The new session
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        adapter = self._build_adapter()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self._keep_alive:
+            session.headers['Connection'] = 'close'
+        if self._egress is not None and self._egress.proxy is not None:
+            session.proxies = {'http': self._egress.proxy, 'https': self._egress.proxy}
+            # Proxies from the environment would otherwise take precedence
+            session.trust_env = False
+        return session
+
+    def _build_adapter(self):
+        """
+        :return: The transport adapter mounted on each session
+        :rtype: requests.adapters.HTTPAdapter
+        """
+        retries = Retry(total=self._max_retries, backoff_factor=self._backoff_factor,
+                        status_forcelist=self._retry_statuses, raise_on_status=False)
+        if self._connection_kwargs:
+            return _BoundHTTPAdapter(self._connection_kwargs, pool_connections=self._pool_connections,
+                                     pool_maxsize=self._pool_maxsize, max_retries=retries)
+        return HTTPAdapter(pool_connections=self._pool_connections,
+                           pool_maxsize=self._pool_maxsize,
+                           max_retries=retries)
+
+    @staticmethod
+    def _egress_connection_kwargs(egress, family=None):
+        """
+        :param egress: The egress path
+        :type egress: Egress
+        :param family: The address family connections are pinned to
+        :type family: int
+        :return: The urllib3 connection arguments binding connections to the egress
+        path and address family
+        :rtype: dict
+        """
+        kwargs = dict()
+        if egress is not None and egress.source_address is not None:
+            kwargs['source_address'] = (egress.source_address, 0)
+        elif egress is not None and egress.interface is not None:
+            if not hasattr(socket, 'SO_BINDTODEVICE'):
+                raise ValueError("Binding to interface {} is not supported on this platform"
+                                 .format(egress.interface))
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + \
+                [(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, egress.interface.encode('utf-8'))]
+        if family is not None and 'source_address' not in kwargs:
+            try:
+                kwargs['source_address'] = (_WILDCARD_ADDRESSES[family], 0)
+            except KeyError:
+                raise ValueError("Unsupported address family {}".format(family))
+        return kwargs
+
+    @staticmethod
+    def _host_key(url):
+        """
+        :param url: A URL
+        :type url: str
+        :return: The scheme and host:port the URL connects to
+        :rtype: tuple(str, str)
+        """
+        parts = urlsplit(url)
+        return parts.scheme.lower(), parts.netloc.lower()
+
+
+class _BoundHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose connections, direct or to a proxy, are created with
+    extra urllib3 connection arguments such as a source address.
+    """
+    __attrs__ = HTTPAdapter.__attrs__ + ['_connection_kwargs']
+
+    def __init__(self, connection_kwargs, **kwargs):
+        """
+        :param connection_kwargs: Arguments passed to every urllib3 connection
+        :type connection_kwargs: dict
+        :param kwargs: Arguments passed on to HTTPAdapter
+        """
+        self._connection_kwargs = connection_kwargs
+        super(_BoundHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.update(self._connection_kwargs)
+        return super(_BoundHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs.update(self._connection_kwargs)
+        return super(_BoundHTTPAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
@@ -0,0 +1,201 @@
+"""
+Watchers poll a provider in the background and call back when the
+external IP changes, spacing their polls with an AdaptivePolling policy
+so that a stable address costs few requests to the sources.
+"""
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import collections
+import threading
+
+from . import policies
+
+
+class IPChange(collections.namedtuple('IPChange', ['old_ip', 'new_ip', 'old_info', 'new_info'])):
+    """
+    A change of the external IP seen by a watcher, with the info cached for
+    the previous and the new IP.
+    """
+    __slots__ = ()
+
+
+class IPWatcher(object):
+    """
+    The IPWatcher polls a provider from a background thread and calls its
+    callbacks with an IPChange whenever the IP differs from the one seen by the
+    previous poll. The first poll only records the IP. Each poll refreshes the
+    provider from its sources, so the watcher keeps the provider's cache fresh
+    as well. Failed polls, whatever they raise, and exceptions raised by
+    callbacks do not stop the watcher; the last of them is kept in last_error.
+    """
+
+    def __init__(self, provider, polling=None, required_info_keys=None):
+        """
+        Constructor
+
+        :param provider: The provider polled for the IP
+        :type provider: echoip.providers.IPProvider
+        :param polling: spaces the polls, AdaptivePolling with its defaults if not given
+        :type polling: echoip.policies.AdaptivePolling
+        :param required_info_keys: The info keys fetched with every poll
+        :type required_info_keys: list(tuple)
+        """
+        self._provider = provider
+        self._polling = polling if polling is not None else policies.AdaptivePolling()
+        self._required_info_keys = required_info_keys
+
+        self._callbacks = []
+        self._ip_address = None
+        self._info = None
+        self._last_error = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_callback(self, callback):
+        """
+        Adds a callback, called with an IPChange from the watcher thread
+        :param callback: The callback
+        :type callback: callable
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """
+        Removes a callback
+        :param callback: The callback
+        :type callback: callable
+        """
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    @property
+    def ip_address(self):
+        """
+        :return: The IP seen by the last successful poll, None before the first
+        :rtype: ipaddress.IPv4Address or ipaddress.IPv6Address
+        """
+        return self._ip_address
+
+    @property
+    def info(self):
+        """
+        :return: The info cached with the IP at the last successful poll
+        :rtype: dict
+        """
+        return self._info
+
+    @property
+    def last_error(self):
+        """
+        :return: The last error raised by a poll or a callback
+        :rtype: Exception
+        """
+        return self._last_error
+
+    @property
+    def polling(self):
+        """
+        :return: The policy spacing the polls
+        :rtype: echoip.policies.AdaptivePolling
+        """
+        return self._polling
+
+    @property
+    def running(self):
+        """
+        :return: True while the watcher thread runs
+        :rtype: bool
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts polling from a daemon thread, beginning with an immediate poll
+        """
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='echoip-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops polling and waits for the watcher thread unless called from a callback
+        :param timeout: The maximum seconds to wait for the thread
+        :type timeout: float
+        """
+        self._stopping.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def check(self):
+        """
+        Polls the provider once and calls the callbacks if the IP changed
+        :return: The change, or None if the IP did not change
+        :rtype: IPChange
+        """
+        try:
+            ip_address, info = self._provider.refresh(self._required_info_keys)
+        except Exception:
+            self._polling.record_failure()
+            raise
+        change = self._observe(ip_address, info)
+        if change is not None:
+            self._notify(change)
+        return change
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.check()
+            except Exception as error:
+                # Any failure, not only a failed lookup, is retried at the next poll
+                self._last_error = error
+            self._stopping.wait(self._polling.next_delay())
+
+    def _observe(self, ip_address, info):
+        """
+        Records the IP and info of a poll, adapting the polling interval
+        :param ip_address: The IP polled
+        :type ip_address: ipaddress.IPv4Address or ipaddress.IPv6Address
+        :param info: The info polled
+        :type info: dict
+        :return: The change, or None if the IP did not change
+        :rtype: IPChange
+        """
+        with self._lock:
+            change = None
+            if self._ip_address is not None and ip_address != self._ip_address:
+                change = IPChange(self._ip_address, ip_address, self._info, info)
+            self._ip_address, self._info = ip_address, info
+
+        if change is None:
+            self._polling.record_unchanged()
+        else:
+            self._polling.record_change()
+        return change
+
+    def _notify(self, change):
+        """
+        Calls every callback with the change, keeping the error of a failing one
+        :param change: The change
+        :type change: IPChange
+        """
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(change)
+            except Exception as error:
+                self._last_error = error
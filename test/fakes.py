@@ -0,0 +1,85 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import socket
+import threading
+import time
+
+import requests
+from ipaddress import ip_address
+from six.moves import BaseHTTPServer
+from zope.interface.declarations import implementer
+
+import echoip.sources
+
+
+@implementer(echoip.sources.IIPSource)
+class DelayedIPSource(object):
+    """A source that answers with a fixed IP after a delay, or raises error if set"""
+    def __init__(self, ip, delay=0, info=None, error=None):
+        self.source_id = 'delayed-{}-{}'.format(ip, delay)
+        self.ip_address = ip_address(ip)
+        self.info = info or dict()
+        self.delay = delay
+        self.error = error
+        self.fetch_count = 0
+        self.last_timeout = None
+
+    def fetch(self, timeout=None):
+        self.fetch_count += 1
+        self.last_timeout = timeout
+        if timeout is not None and timeout < self.delay:
+            time.sleep(timeout)
+            raise requests.Timeout('Timed out after {}s'.format(timeout))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return echoip.sources.FetchResult(self.ip_address, self.info, time.time(), self.delay, self.source_id)
+
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers any request, proxied or not, with the address of the client"""
+    def do_GET(self):
+        body = '{}\n'.format(self.client_address[0]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EchoHTTPServer(object):
+    """An HTTP echo service on a local port, served from a thread"""
+    def __init__(self, host='127.0.0.1', handler=EchoHandler):
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        server_class = type('EchoServer', (BaseHTTPServer.HTTPServer,), {'address_family': family})
+        self.server = server_class((host, 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://{}:{}/'.format('[{}]'.format(host) if ':' in host else host, self.server.server_port)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class EndlessBody(object):
+    """A response body that never ends, each read taking delay seconds"""
+    def __init__(self, filler, delay=0):
+        self.filler = filler
+        self.delay = delay
+        self.bytes_read = 0
+        self.closed = False
+
+    def read(self, size=1024, *args):
+        time.sleep(self.delay)
+        size = 1024 if size is None or size < 0 else size
+        self.bytes_read += size
+        return self.filler * size
+
+    def close(self):
+        self.closed = True
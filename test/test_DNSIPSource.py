@@ -0,0 +1,113 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import socket
+import struct
+import threading
+import unittest
+
+import ipaddress
+
+import echoip.dns
+import echoip.providers
+import echoip.sources
+
+from .fakes import DelayedIPSource
+
+
+class FakeDNSServer(object):
+    """Answers every query on a local UDP port with the configured records"""
+    def __init__(self):
+        self.records = []
+        self.rcode = 0
+        self.decoy = False
+        self.silent = False
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                message, client = self.sock.recvfrom(512)
+            except (IOError, OSError):
+                return
+            query_id, = struct.unpack('!H', message[:2])
+            question = message[12:]
+            self.queries.append(question)
+            if self.silent:
+                continue
+            if self.decoy:
+                self.sock.sendto(struct.pack('!HHHHHH', query_id ^ 1, 0x8180, 0, 0, 0, 0), client)
+            answers = b''.join(struct.pack('!HHHIH', 0xC00C, record_type, 1, 60, len(data)) + data
+                               for record_type, data in self.records)
+            header = struct.pack('!HHHHHH', query_id, 0x8180 | self.rcode, 1, len(self.records), 0, 0)
+            self.sock.sendto(header + question + answers, client)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestDNSIPSource(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDNSServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def source(self, record_type='A', timeout=1):
+        return echoip.sources.DNSIPSource('127.0.0.1', 'myip.opendns.com', record_type, port=self.server.port,
+                                          timeout=timeout)
+
+    def test_a_record(self):
+        """Tests that an A answer yields the IP and that unrelated datagrams are ignored"""
+        self.server.decoy = True
+        self.server.records = [(echoip.dns.TYPE_A, socket.inet_aton('127.0.0.1'))]
+        result = self.source().fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(result.info, {})
+        self.assertEqual(self.server.queries[0], b'\x04myip\x07opendns\x03com\x00\x00\x01\x00\x01')
+
+    def test_aaaa_record(self):
+        """Tests that an AAAA answer yields an IPv6 address"""
+        self.server.records = [(echoip.dns.TYPE_AAAA, socket.inet_pton(socket.AF_INET6, '2001:db8::1'))]
+        self.assertEqual(self.source('AAAA').ip_address, ipaddress.IPv6Address(u'2001:db8::1'))
+
+    def test_txt_record(self):
+        """Tests that TXT answers that are not addresses are skipped"""
+        self.server.records = [(echoip.dns.TYPE_TXT, b'\x16edns0-client-subnet /0'),
+                               (echoip.dns.TYPE_TXT, b'\x09127.0.0.1')]
+        self.assertEqual(self.source('TXT').ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+
+    def test_errors(self):
+        """Tests that error codes, empty answers and timeouts fail the fetch"""
+        self.server.rcode = 3
+        with self.assertRaises(echoip.dns.DNSResponseError):
+            self.source().fetch()
+        self.server.rcode = 0
+        with self.assertRaises(echoip.dns.DNSResponseError):
+            self.source().fetch()
+        self.server.silent = True
+        with self.assertRaises(socket.timeout):
+            self.source(timeout=0.05).fetch()
+        with self.assertRaises(ValueError):
+            echoip.sources.DNSIPSource('127.0.0.1', 'myip.opendns.com', 'MX')
+
+    def test_factory_and_provider(self):
+        """Tests that the source registers in the factory and is tried before HTTP sources"""
+        self.server.records = [(echoip.dns.TYPE_A, socket.inet_aton('127.0.0.1'))]
+        fac = echoip.sources.IPSourceFactory(use_builtins=False)
+        fac.add_source(echoip.sources.DNSIPSource, '127.0.0.1', 'myip.opendns.com', 'A', 'IN', self.server.port)
+        network = DelayedIPSource(u'127.0.0.2')
+        ipp = echoip.providers.IPProvider([network] + list(fac.get_sources()))
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(network.fetch_count, 0)
+
+        self.server.silent = True
+        ipp = echoip.providers.IPProvider([network, echoip.sources.DNSIPSource(
+            '127.0.0.1', 'myip.opendns.com', port=self.server.port, timeout=0.05)])
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
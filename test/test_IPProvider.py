@@ -2,6 +2,7 @@ __docformat__ = 'restructuredtext en'
 __author__ = 'Eli Flesher <eli@eflee.us>'
 
 import unittest
+import threading
 import time
 
 import requests_mock
@@ -9,8 +10,12 @@ import ipaddress
 import mock
 import requests
 
+import echoip.caches
 import echoip.sources
 import echoip.providers
+import echoip.policies
+
+from .fakes import DelayedIPSource
 
 
 class TestIPProvider(unittest.TestCase):
@@ -48,7 +53,16 @@ class TestIPProvider(unittest.TestCase):
             ipp.add_source(source)
         self.assertEquals(ipp.get_info(), {'countryCode': 'US'})
 
-    @mock.patch('requests.get')
+    @requests_mock.Mocker()
+    def test_get_info_single_request(self, m):
+        """Tests that a provider lookup costs a single request to the source"""
+        m.register_uri('GET', 'https://fake-ip-json-url.com/', text='{"countryCode": "US", "query": "127.0.0.1"}')
+        ipp = echoip.providers.IPProvider([echoip.sources.JSONIPSource('https://fake-ip-json-url.com/', 'query')])
+        self.assertEqual(ipp.get_info(), {'countryCode': 'US'})
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(m.call_count, 1)
+
+    @mock.patch('requests.Session.request')
     def test_no_response(self, m):
         """Tests proper failure if a connection error occurs"""
         m.side_effect = requests.ConnectionError('ConnectionError')
@@ -128,3 +142,252 @@ class TestIPProvider(unittest.TestCase):
         self.assertFalse(ipp.is_cache_valid())
 
         self.assertEquals(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+
+    def test_hedged_request(self):
+        """Tests that a slow source is hedged and the first valid response wins"""
+        slow = DelayedIPSource(u'127.0.0.1', 2)
+        fast = DelayedIPSource(u'127.0.0.2', 0.01)
+        ipp = echoip.providers.IPProvider(hedging=echoip.policies.HedgingPolicy(delay=0.05))
+        ipp.add_source(slow)
+        ipp.add_source(fast)
+        ipp._ordered_sources = lambda *args: [slow, fast]
+        timestamp = time.time()
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertLess(time.time() - timestamp, 1)
+
+    def test_hedged_request_fast_source(self):
+        """Tests that a source answering within the delay is not hedged"""
+        first = DelayedIPSource(u'127.0.0.1', 0.01)
+        second = DelayedIPSource(u'127.0.0.2')
+        ipp = echoip.providers.IPProvider([first, second], hedging=echoip.policies.HedgingPolicy(delay=1))
+        ipp._ordered_sources = lambda *args: [first, second]
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(second.fetch_count, 0)
+
+    def test_hedged_request_failure(self):
+        """Tests that a failed source is followed by the next one without waiting for the delay"""
+        failing = DelayedIPSource(u'127.0.0.1', error=ValueError('bad data'))
+        second = DelayedIPSource(u'127.0.0.2')
+        ipp = echoip.providers.IPProvider([failing, second], hedging=echoip.policies.HedgingPolicy(delay=5))
+        ipp._ordered_sources = lambda *args: [failing, second]
+        timestamp = time.time()
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertLess(time.time() - timestamp, 1)
+
+    def test_hedged_request_no_response(self):
+        """Tests proper failure if no hedged source responds"""
+        ipp = echoip.providers.IPProvider([DelayedIPSource(u'127.0.0.1', error=ValueError('bad data'))],
+                                          hedging=echoip.policies.HedgingPolicy(delay=0))
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            ipp.get_ip()
+
+    def test_hedging_policy_percentile(self):
+        """Tests that the hedge delay follows the observed latency percentile once enough samples exist"""
+        policy = echoip.policies.HedgingPolicy(delay=1, percentile=90, min_samples=10)
+        source = DelayedIPSource(u'127.0.0.1')
+        for latency in range(9):
+            policy.record(source, latency / 100.0)
+        self.assertEqual(policy.hedge_delay(source), 1)
+        policy.record(source, 0.5)
+        self.assertEqual(policy.hedge_delay(source), 0.08)
+        with self.assertRaises(ValueError):
+            echoip.policies.HedgingPolicy()
+
+    def test_deadline(self):
+        """Tests that the deadline caps the time spent across all sources tried"""
+        srcs = [DelayedIPSource(u'127.0.0.1', 1), DelayedIPSource(u'127.0.0.2', 1)]
+        ipp = echoip.providers.IPProvider(srcs, deadline=0.2)
+        timestamp = time.time()
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            ipp.get_ip()
+        self.assertLess(time.time() - timestamp, 0.5)
+        self.assertTrue(all(0 < src.last_timeout <= 0.2 for src in srcs))
+
+    def test_deadline_not_held_against_source(self):
+        """Tests that running out of time is not recorded as a failure of the source"""
+        source = DelayedIPSource(u'127.0.0.1', 1)
+        ipp = echoip.providers.IPProvider(
+            [source], deadline=0.1, circuit_breaker=lambda: echoip.policies.CircuitBreaker(failure_threshold=1))
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            ipp.get_ip()
+        self.assertEqual(ipp.source_stats[source].failures, 0)
+        self.assertEqual(ipp.breaker_states[source], echoip.policies.CircuitBreaker.CLOSED)
+
+        with self.assertRaises(echoip.policies.DeadlineExpiredError):
+            ipp._fetch_source(source, 0.0, echoip.providers._Deadline(0))
+        self.assertEqual(source.fetch_count, 1)
+        self.assertEqual(ipp.source_stats[source].samples, 0)
+
+    def test_deadline_budget_split(self):
+        """Tests that the time left is split between the sources still to be tried"""
+        failing = DelayedIPSource(u'127.0.0.1', error=ValueError('bad data'))
+        second = DelayedIPSource(u'127.0.0.2', 0.05)
+        ipp = echoip.providers.IPProvider([failing, second], deadline=1)
+        ipp._ordered_sources = lambda *args: [failing, second]
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertAlmostEqual(failing.last_timeout, 0.5, places=1)
+        self.assertAlmostEqual(second.last_timeout, 1, places=1)
+
+    def test_deadline_hedged(self):
+        """Tests that a hedged lookup stops waiting once the deadline passes"""
+        srcs = [DelayedIPSource(u'127.0.0.1', 2), DelayedIPSource(u'127.0.0.2', 2)]
+        ipp = echoip.providers.IPProvider(srcs, hedging=echoip.policies.HedgingPolicy(delay=0.05), deadline=0.2)
+        timestamp = time.time()
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            ipp.get_ip()
+        self.assertLess(time.time() - timestamp, 0.5)
+
+    def _call_concurrently(self, func, count=10):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(func())
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_single_flight_refresh(self):
+        """Tests that concurrent callers of a stale cache share a single fetch"""
+        source = DelayedIPSource(u'127.0.0.1', 0.1)
+        ipp = echoip.providers.IPProvider([source])
+        results, errors = self._call_concurrently(ipp.get_ip)
+        self.assertEqual(results, [ipaddress.IPv4Address(u'127.0.0.1')] * 10)
+        self.assertEqual(errors, [])
+        self.assertEqual(source.fetch_count, 1)
+
+        ipp.invalidate_cache()
+        results, errors = self._call_concurrently(lambda: ipp.get_info(['countryCode']))
+        self.assertEqual(len(errors), 10)
+        # The source is known not to provide the key so it is not asked again
+        self.assertEqual(source.fetch_count, 1)
+
+    def test_single_flight_shares_errors(self):
+        """Tests that a failed refresh is reported to every waiting caller"""
+        source = DelayedIPSource(u'127.0.0.1', 0.1, error=ValueError('bad data'))
+        ipp = echoip.providers.IPProvider([source])
+        results, errors = self._call_concurrently(ipp.get_ip)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 10)
+        self.assertTrue(all(isinstance(error, echoip.providers.NullResponseFromSourcesError) for error in errors))
+        self.assertEqual(source.fetch_count, 1)
+
+    def test_stale_while_revalidate(self):
+        """Tests that a stale IP is served while it is refreshed in the background"""
+        now = [1000.0]
+        gate = threading.Event()
+        gate.set()
+        source = DelayedIPSource(u'127.0.0.1')
+        fetch = source.fetch
+        source.fetch = lambda timeout=None: gate.wait(5) and fetch(timeout)
+        ipp = echoip.providers.IPProvider([source], cache_ttl=30, clock=lambda: now[0],
+                                          stale_while_revalidate=echoip.policies.StaleWhileRevalidate(hard_ttl=300))
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        gate.clear()
+        now[0] += 60
+        source.ip_address = ipaddress.IPv4Address(u'127.0.0.2')
+        start = time.time()
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertLess(time.time() - start, 1)
+        revalidations = list(ipp._revalidations.values())
+        self.assertEqual(len(revalidations), 1)
+        gate.set()
+        revalidations[0].join(5)
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(source.fetch_count, 2)
+        self.assertEqual(ipp.cache.stats.stale_hits, 2)
+
+    def test_stale_while_revalidate_failure(self):
+        """Tests that a failed background refresh keeps the last good IP and backs off"""
+        source = DelayedIPSource(u'127.0.0.1')
+        policy = echoip.policies.StaleWhileRevalidate(hard_ttl=10, backoff=60)
+        ipp = echoip.providers.IPProvider([source], cache_ttl=0.01, stale_while_revalidate=policy,
+                                          circuit_breaker=None)
+        ipp.get_ip()
+        time.sleep(0.02)
+        source.error = ValueError('bad data')
+        for _ in range(3):
+            self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+            time.sleep(0.02)
+        self.assertEqual(source.fetch_count, 2)
+        self.assertEqual(policy.failures, 1)
+
+    def test_stale_while_revalidate_hard_ttl(self):
+        """Tests that an IP older than the hard TTL is not served"""
+        source = DelayedIPSource(u'127.0.0.1')
+        ipp = echoip.providers.IPProvider(
+            [source], cache_ttl=0.01, stale_while_revalidate=echoip.policies.StaleWhileRevalidate(hard_ttl=0.02))
+        ipp.get_ip()
+        time.sleep(0.03)
+        source.error = ValueError('bad data')
+        self.assertRaises(echoip.providers.NullResponseFromSourcesError, ipp.get_ip)
+
+    def test_info_fields_cached_per_key(self):
+        """Tests that get_info only fetches the missing keys from sources that may provide them"""
+        city = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        org = DelayedIPSource(u'127.0.0.1', info={'org': 'AS64496'})
+        ipp = echoip.providers.IPProvider([city, org])
+        ipp._ordered_sources = lambda keys=None: [src for src in (city, org)
+                                                  if ipp.capabilities.provides(src, keys) is not False]
+        self.assertEqual(ipp.get_info(['city']), {'city': 'Keb'})
+        self.assertEqual(ipp.get_info(['org']), {'city': 'Keb', 'org': 'AS64496'})
+        for _ in range(3):
+            self.assertEqual(ipp.get_info(['city']), {'city': 'Keb', 'org': 'AS64496'})
+            self.assertEqual(ipp.get_info(['org']), {'city': 'Keb', 'org': 'AS64496'})
+        self.assertEqual((city.fetch_count, org.fetch_count), (1, 1))
+        self.assertEqual(ipp.info_provenance['org'].source_id, org.source_id)
+
+    def test_info_fields_expire(self):
+        """Tests that info fields expire on their own TTL while the IP is still valid"""
+        source = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        ipp = echoip.providers.IPProvider([source], info_ttl=0.05)
+        ipp.get_info(['city'])
+        self.assertEqual(ipp.get_info(['city']), {'city': 'Keb'})
+        time.sleep(0.06)
+        self.assertEqual(ipp.get_info(['city']), {'city': 'Keb'})
+        self.assertEqual(source.fetch_count, 2)
+
+    def test_info_dropped_when_ip_changes(self):
+        """Tests that info cached for a previous IP is not merged into the new IP's info"""
+        first = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        ipp = echoip.providers.IPProvider([first])
+        ipp.get_info(['city'])
+        first.ip_address = ipaddress.IPv4Address(u'127.0.0.2')
+        first.info = {'org': 'AS64496'}
+        ipp.invalidate_cache()
+        ipp.get_ip()
+        self.assertEqual(ipp.info_provenance.keys(), {'org'})
+
+    def test_capable_sources_first(self):
+        """Tests that info lookups go to sources declaring the keys and skip those that cannot provide them"""
+        plain = DelayedIPSource(u'127.0.0.1')
+        plain.info_keys = frozenset()
+        unknown = DelayedIPSource(u'127.0.0.1', info={'org': 'AS64496'})
+        capable = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        capable.info_keys = frozenset(['city', 'country'])
+        ipp = echoip.providers.IPProvider([plain, unknown, capable])
+        self.assertEqual(ipp._ordered_sources(['city']), [capable, unknown])
+        self.assertEqual(ipp.get_info(['city']), {'city': 'Keb'})
+        self.assertEqual((plain.fetch_count, unknown.fetch_count, capable.fetch_count), (0, 0, 1))
+        self.assertEqual(len(ipp._ordered_sources()), 3)
+
+    def test_get_info_honors_ttl(self):
+        """Tests that get_info refetches once the cache_ttl has passed, like get_ip"""
+        now = [1000.0]
+        source = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        ipp = echoip.providers.IPProvider([source], cache_ttl=60, clock=lambda: now[0])
+        ipp.get_info()
+        ipp.get_info()
+        self.assertEqual(source.fetch_count, 1)
+        now[0] += 61
+        self.assertFalse(ipp.is_cache_valid())
+        ipp.get_info()
+        self.assertEqual(source.fetch_count, 2)
+        self.assertEqual(ipp.cache.stats, echoip.caches.CacheStats(hits=1, misses=1, expirations=1, stale_hits=0))
@@ -33,7 +33,7 @@ class TestJSONBasedIPSource(unittest.TestCase):
     def test_info_success(self, m):
         """Tests that a proper response from the URL yields no additional info (for this class)"""
         m.register_uri('GET', 'https://fake-ip-url.com/', text='{"countryCode": "US", "query": "127.0.0.1"}')
-        self.assertIsInstance(self.source.info, dict, "Additional info should be a dict")
+        self.assertIsInstance(self.source.info, echoip.sources.FrozenInfo, "Additional info should be a FrozenInfo")
         self.assertEquals({'countryCode': 'US'}, self.source.info)
 
     @requests_mock.Mocker()
@@ -88,3 +88,19 @@ class TestJSONBasedIPSource(unittest.TestCase):
         self.assertIsNone(self.source._info)
         self.assertIsNotNone(self.source.info)
 
+    @requests_mock.Mocker()
+    def test_reads_one_object(self, m):
+        """Tests that the body is read up to the end of its JSON object, braces in strings included"""
+        m.register_uri('GET', 'https://fake-ip-url.com/',
+                       text='{"query": "127.0.0.1", "org": "A \\"}{\\" B", "as": [1, {"c": 2}]}{"query": "x"')
+        result = self.source.fetch()
+        self.assertEqual(ipaddress.IPv4Address(u'127.0.0.1'), result.ip_address)
+        self.assertEqual({'org': 'A "}{" B', 'as': [1, {'c': 2}]}, result.info)
+
+    @requests_mock.Mocker()
+    def test_max_bytes(self, m):
+        """Tests that a JSON body longer than the byte limit fails the fetch"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='{"query": "127.0.0.1", "pad": "' + 'x' * 4096 + '"}')
+        source = echoip.sources.JSONIPSource('https://fake-ip-url.com/', 'query', max_bytes=1024)
+        with self.assertRaises(echoip.sources.ResponseTooLargeError):
+            source.fetch()
@@ -0,0 +1,116 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import socket
+import struct
+import threading
+import unittest
+
+import ipaddress
+
+import echoip.providers
+import echoip.sources
+import echoip.stun
+
+
+class FakeSTUNServer(object):
+    """Answers every Binding Request on a local UDP port with the address it came from"""
+    def __init__(self, family=socket.AF_INET, host='127.0.0.1'):
+        self.mode = 'xor'
+        self.decoy = False
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                message, client = self.sock.recvfrom(512)
+            except (IOError, OSError):
+                return
+            _, _, cookie, transaction_id = struct.unpack('!HHI12s', message[:20])
+            if self.decoy:
+                self.sock.sendto(struct.pack('!HHI12s', 0x0101, 0, cookie, b'\0' * 12), client)
+            self.sock.sendto(self.response(transaction_id, client), client)
+
+    def response(self, transaction_id, client):
+        address = ipaddress.ip_address(client[0])
+        packed, family = address.packed, 1 if address.version == 4 else 2
+        if self.mode == 'error':
+            reason = b'Bad Request'
+            value = struct.pack('!HBB', 0, 4, 0) + reason
+            attributes = struct.pack('!HH', 0x0009, len(value)) + value + b'\0' * (-len(value) % 4)
+            return struct.pack('!HHI12s', 0x0111, len(attributes), echoip.stun.MAGIC_COOKIE, transaction_id) \
+                + attributes
+        if self.mode == 'xor':
+            mask = struct.pack('!I', echoip.stun.MAGIC_COOKIE) + transaction_id
+            packed = bytes(bytearray(a ^ b for a, b in zip(bytearray(packed), bytearray(mask))))
+            value = struct.pack('!BBH', 0, family, client[1] ^ 0x2112) + packed
+            attribute_type = 0x0020
+        else:
+            value = struct.pack('!BBH', 0, family, client[1]) + packed
+            attribute_type = 0x0001
+        # An unknown attribute with padding comes first to exercise the parser
+        attributes = struct.pack('!HH', 0x8022, 3) + b'abc\0' + struct.pack('!HH', attribute_type, len(value)) + value
+        return struct.pack('!HHI12s', 0x0101, len(attributes), echoip.stun.MAGIC_COOKIE, transaction_id) + attributes
+
+    def close(self):
+        self.sock.close()
+
+
+class TestSTUNIPSource(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSTUNServer()
+        self.source = echoip.sources.STUNIPSource('127.0.0.1', self.server.port, timeout=1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_xor_mapped_address(self):
+        """Tests that the XOR-MAPPED-ADDRESS yields the IP and the mapped port"""
+        self.server.decoy = True
+        result = self.source.fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertGreater(result.info['mapped_port'], 0)
+        self.assertEqual(result.source_id, 'stun:127.0.0.1:{}'.format(self.server.port))
+
+    def test_mapped_address(self):
+        """Tests that the MAPPED-ADDRESS of RFC 3489 servers is understood"""
+        self.server.mode = 'plain'
+        self.assertEqual(self.source.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+
+    @unittest.skipUnless(socket.has_ipv6, "IPv6 is not available")
+    def test_ipv6(self):
+        """Tests that IPv6 mapped addresses are unmasked with the transaction id"""
+        try:
+            server = FakeSTUNServer(socket.AF_INET6, '::1')
+        except (IOError, OSError):
+            self.skipTest("IPv6 loopback is not available")
+        try:
+            source = echoip.sources.STUNIPSource('::1', server.port, timeout=1)
+            self.assertEqual(source.ip_address, ipaddress.IPv6Address(u'::1'))
+        finally:
+            server.close()
+
+    def test_errors(self):
+        """Tests that error responses and silence fail the fetch"""
+        self.server.mode = 'error'
+        with self.assertRaisesRegex(echoip.stun.STUNResponseError, '400 Bad Request'):
+            self.source.fetch()
+        with self.assertRaises(echoip.stun.STUNResponseError):
+            echoip.stun.parse_binding_response(b'\0' * 20, b'\0' * 12)
+        self.server.close()
+        # Silence times out, or the port unreachable reply refuses the connection
+        with self.assertRaises(socket.error):
+            echoip.sources.STUNIPSource('127.0.0.1', self.server.port, timeout=0.05).fetch()
+
+    def test_factory_and_provider(self):
+        """Tests that the source registers in the factory and answers info lookups for the mapped port"""
+        fac = echoip.sources.IPSourceFactory(use_builtins=False)
+        fac.add_source(echoip.sources.STUNIPSource, '127.0.0.1', self.server.port)
+        ipp = echoip.providers.IPProvider(list(fac.get_sources()))
+        self.assertIn('mapped_port', ipp.get_info(['mapped_port']))
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
@@ -0,0 +1,218 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import asyncio
+import unittest
+
+import ipaddress
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import echoip.aio
+import echoip.policies
+import echoip.providers
+import echoip.sources
+
+
+class TestAsyncSourcesAndProviders(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.responses = {'/text': '127.0.0.1\n',
+                          '/json': '{"countryCode": "US", "query": "127.0.0.1"}',
+                          '/json2': '{"city": "Keb", "query": "127.0.0.1"}',
+                          '/other': '127.0.0.2\n'}
+        self.delays = dict()
+        self.hits = []
+
+        async def handler(request):
+            self.hits.append(request.path)
+            await asyncio.sleep(self.delays.get(request.path, 0))
+            return web.Response(text=self.responses[request.path])
+
+        app = web.Application()
+        app.router.add_get('/{name}', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.transport = echoip.aio.AsyncHTTPTransport()
+
+    async def asyncTearDown(self):
+        await self.transport.close()
+        await self.server.close()
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+    async def test_simple_source(self):
+        """Tests that the async simple source parses a plain-text response"""
+        source = echoip.aio.AsyncSimpleIPSource(self.url('/text'))
+        self.assertIsNone(source.ip_address)
+        result = await source.fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(source.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(source.info, {})
+
+    async def test_json_source(self):
+        """Tests that the async JSON source parses the IP and info"""
+        source = echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport)
+        result = await source.fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(result.info, {'countryCode': 'US'})
+
+    async def test_streamed_reads(self):
+        """Tests that async sources stop reading at the end of the answer and cap the body size"""
+        self.responses['/lines'] = '127.0.0.1\nnot an address\n'
+        self.responses['/trailing'] = '{"query": "127.0.0.1"} trailing'
+        self.responses['/large'] = '1' * 4096
+        result = await echoip.aio.AsyncSimpleIPSource(self.url('/lines'), self.transport).fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        result = await echoip.aio.AsyncJSONIPSource(self.url('/trailing'), 'query', self.transport).fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        with self.assertRaises(echoip.sources.ResponseTooLargeError):
+            await echoip.aio.AsyncSimpleIPSource(self.url('/large'), self.transport, max_bytes=1024).fetch()
+
+    async def test_provider_rejects_sync_sources(self):
+        """Tests that async providers only accept async sources and vice versa"""
+        with self.assertRaises(TypeError):
+            echoip.aio.AsyncIPProvider([echoip.sources.SimpleIPSource(self.url('/text'))])
+        with self.assertRaises(TypeError):
+            echoip.providers.IPProvider([echoip.aio.AsyncSimpleIPSource(self.url('/text'))])
+
+    async def test_provider_cache(self):
+        """Tests that get_ip and get_info are served from the cache"""
+        ipp = echoip.aio.AsyncIPProvider(
+            [echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport)])
+        self.assertEqual(await ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(await ipp.get_info(), {'countryCode': 'US'})
+        self.assertEqual(len(self.hits), 1)
+
+    async def test_provider_coalesces_refreshes(self):
+        """Tests that concurrent tasks share one fetch when the cache is stale"""
+        self.delays['/json'] = 0.05
+        ipp = echoip.aio.AsyncIPProvider(
+            [echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport)])
+        results = await asyncio.gather(*[ipp.get_ip() for _ in range(10)])
+        self.assertEqual(set(results), {ipaddress.IPv4Address(u'127.0.0.1')})
+        self.assertEqual(len(self.hits), 1)
+
+    async def test_provider_stale_while_revalidate(self):
+        """Tests that a stale IP is served while a background task refreshes it"""
+        ipp = echoip.aio.AsyncIPProvider(
+            [echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport)], cache_ttl=0.05,
+            stale_while_revalidate=echoip.policies.StaleWhileRevalidate(hard_ttl=10))
+        await ipp.get_ip()
+        await asyncio.sleep(0.06)
+        self.responses['/text'] = '127.0.0.2\n'
+        self.assertEqual(await ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        await asyncio.sleep(0.1)
+        self.assertEqual(await ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(len(self.hits), 2)
+
+    async def test_watcher(self):
+        """Tests that the async watcher task awaits coroutine callbacks on a change"""
+        changes = []
+
+        async def record(change):
+            changes.append(change)
+
+        ipp = echoip.aio.AsyncIPProvider([echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport)])
+        polling = echoip.policies.AdaptivePolling(min_interval=0.01, max_interval=0.02)
+        watcher = echoip.aio.AsyncIPWatcher(ipp, polling)
+        watcher.add_callback(record)
+        async with watcher:
+            await asyncio.sleep(0.05)
+            self.responses['/text'] = '127.0.0.2\n'
+            await asyncio.sleep(0.1)
+        self.assertFalse(watcher.running)
+        self.assertEqual([(change.old_ip, change.new_ip) for change in changes],
+                         [(ipaddress.IPv4Address(u'127.0.0.1'), ipaddress.IPv4Address(u'127.0.0.2'))])
+
+    async def test_watcher_unexpected_errors(self):
+        """Tests that the async watcher task keeps polling when the provider raises other than a failed lookup"""
+        source = echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport)
+
+        def parse(text):
+            raise RuntimeError('unexpected')
+        source._parse = parse
+        ipp = echoip.aio.AsyncIPProvider([source])
+        watcher = echoip.aio.AsyncIPWatcher(ipp, echoip.policies.AdaptivePolling(min_interval=0.01, max_interval=0.02))
+        async with watcher:
+            await asyncio.sleep(0.1)
+            self.assertTrue(watcher.running)
+        self.assertGreaterEqual(self.hits.count('/json'), 2)
+        self.assertIsInstance(watcher.last_error, RuntimeError)
+
+    async def test_provider_required_keys(self):
+        """Tests that the provider moves on until a source provides the required keys"""
+        ipp = echoip.aio.AsyncIPProvider(
+            [echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport),
+             echoip.aio.AsyncJSONIPSource(self.url('/json2'), 'query', self.transport)])
+        self.assertEqual(await ipp.get_info(['city']), {'city': 'Keb'})
+
+    async def test_provider_no_response(self):
+        """Tests proper failure if no source responds"""
+        url = self.url('/text')
+        await self.server.close()
+        ipp = echoip.aio.AsyncIPProvider([echoip.aio.AsyncSimpleIPSource(url)])
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            await ipp.get_ip()
+
+    async def test_multisource_agreement(self):
+        """Tests that the multisource provider merges info from agreeing sources"""
+        ipp = echoip.aio.AsyncMultisourceIPProvider(
+            [echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport),
+             echoip.aio.AsyncJSONIPSource(self.url('/json2'), 'query', self.transport)])
+        self.assertEqual(await ipp.get_info(), {'countryCode': 'US', 'city': 'Keb'})
+
+    async def test_multisource_non_agreement(self):
+        """Tests that the multisource provider fails when the sources disagree"""
+        ipp = echoip.aio.AsyncMultisourceIPProvider(
+            [echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport),
+             echoip.aio.AsyncSimpleIPSource(self.url('/other'), self.transport)], concurrent=True)
+        with self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError):
+            await ipp.get_ip()
+
+    async def test_multisource_concurrent_cancels_stragglers(self):
+        """Tests that concurrent mode returns on agreement without waiting on slow sources"""
+        self.delays['/other'] = 5
+        ipp = echoip.aio.AsyncMultisourceIPProvider(
+            [echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport),
+             echoip.aio.AsyncJSONIPSource(self.url('/json'), 'query', self.transport),
+             echoip.aio.AsyncSimpleIPSource(self.url('/other'), self.transport)], concurrent=True)
+        self.assertEqual(await asyncio.wait_for(ipp.get_ip(), 1), ipaddress.IPv4Address(u'127.0.0.1'))
+
+    async def test_deadline(self):
+        """Tests that the deadline bounds async lookups"""
+        self.delays['/text'] = self.delays['/other'] = 2
+        ipp = echoip.aio.AsyncMultisourceIPProvider(
+            [echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport),
+             echoip.aio.AsyncSimpleIPSource(self.url('/other'), self.transport)], concurrent=True, deadline=0.2)
+        with self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError):
+            await asyncio.wait_for(ipp.get_ip(), 1)
+        source = echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport)
+        ipp = echoip.aio.AsyncIPProvider(
+            [source], deadline=0.2, circuit_breaker=lambda: echoip.policies.CircuitBreaker(failure_threshold=1))
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            await asyncio.wait_for(ipp.get_ip(), 1)
+        # Running out of time is not held against the source
+        self.assertEqual(ipp.source_stats[source].failures, 0)
+        self.assertEqual(ipp.breaker_states[source], echoip.policies.CircuitBreaker.CLOSED)
+
+    async def test_hedging(self):
+        """Tests that a slow source is hedged by the next one and its request cancelled"""
+        self.delays['/text'] = 5
+        slow = echoip.aio.AsyncSimpleIPSource(self.url('/text'), self.transport)
+        fast = echoip.aio.AsyncSimpleIPSource(self.url('/other'), self.transport)
+        ipp = echoip.aio.AsyncIPProvider([slow, fast], hedging=echoip.policies.HedgingPolicy(delay=0.05))
+        ipp._ordered_sources = lambda *args: [slow, fast]
+        self.assertEqual(await asyncio.wait_for(ipp.get_ip(), 1), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(self.hits, ['/text', '/other'])
+        self.assertEqual(ipp.source_stats[slow].samples, 0)
+
+    async def test_factory(self):
+        """Tests that the async factory generates async sources sharing one transport"""
+        fac = echoip.aio.AsyncIPSourceFactory(transport=self.transport)
+        srcs = list(fac.get_sources())
+        self.assertEqual(len(srcs), fac.num_sources)
+        for source in srcs:
+            self.assertTrue(echoip.aio.IAsyncIPSource.providedBy(source))
+            self.assertIs(source.transport, self.transport)
+        self.assertEqual(len(list(fac.get_sources(types_list=echoip.aio.AsyncJSONIPSource))), 4)
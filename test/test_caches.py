@@ -0,0 +1,214 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import ipaddress
+
+import echoip.caches
+import echoip.providers
+import echoip.sources
+
+from .fakes import DelayedIPSource
+
+
+def _lookup(path, fetches):
+    """Looks up the IP in a new provider sharing the file cache, counting fetches"""
+    source = DelayedIPSource(u'127.0.0.1', 0.1)
+    ipp = echoip.providers.IPProvider([source], cache_backend=echoip.caches.FileCacheBackend(path))
+    ipp.get_ip()
+    with fetches.get_lock():
+        fetches.value += source.fetch_count
+
+
+class FakeClock(object):
+    """A clock that only moves when told to"""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestIPCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = echoip.caches.IPCache(ttl=60, info_ttl=30, clock=self.clock)
+
+    def store(self, ip, info):
+        return self.cache.store(echoip.sources.FetchResult(ipaddress.ip_address(ip), info, self.clock.now, 0, 'src'))
+
+    def test_validation_and_counters(self):
+        """Tests that get_ip and get_info lookups share one validation path and are counted"""
+        self.assertEqual(self.cache.lookup(), echoip.caches.IPCache.MISS)
+        self.store(u'127.0.0.1', {'city': 'Keb'})
+        self.assertEqual(self.cache.lookup(), echoip.caches.IPCache.HIT)
+        self.assertEqual(self.cache.lookup(['city'], info=True), echoip.caches.IPCache.HIT)
+        self.assertEqual(self.cache.lookup(['org'], info=True), echoip.caches.IPCache.MISS)
+        self.clock.now += 31
+        self.assertEqual(self.cache.lookup(['city'], info=True), echoip.caches.IPCache.MISS)
+        self.assertEqual(self.cache.missing_keys(['city']), ['city'])
+        self.clock.now += 30
+        self.assertEqual(self.cache.lookup(), echoip.caches.IPCache.EXPIRED)
+        self.assertEqual(self.cache.lookup(None, info=True), echoip.caches.IPCache.EXPIRED)
+        self.assertFalse(self.cache.is_valid())
+        self.assertEqual(self.cache.stats, echoip.caches.CacheStats(hits=2, misses=3, expirations=2, stale_hits=0))
+
+    def test_ip_change(self):
+        """Tests that info cached for a previous IP is dropped when the IP changes"""
+        self.assertTrue(self.store(u'127.0.0.1', {'city': 'Keb'}))
+        self.assertFalse(self.store(u'127.0.0.1', {'org': 'AS64496'}))
+        self.assertEqual(self.cache.info, {'city': 'Keb', 'org': 'AS64496'})
+        self.assertTrue(self.store(u'127.0.0.2', {}))
+        self.assertEqual(self.cache.stale_info, {})
+
+    def test_invalidate(self):
+        """Tests that invalidation empties the cache and its backend"""
+        self.store(u'127.0.0.1', {})
+        self.assertIsNotNone(self.cache.backend.load())
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.ip_address)
+        self.assertIsNone(self.cache.backend.load())
+        self.assertEqual(self.cache.status(), echoip.caches.IPCache.MISS)
+
+
+class TestInfoCache(unittest.TestCase):
+    def test_fields_and_missing(self):
+        """Tests that fields merge with provenance and expire individually"""
+        cache = echoip.caches.InfoCache()
+        cache.update({'city': 'Keb', 'loc': '27.6,-22.3'}, 'a', 100)
+        cache.update({'city': 'Keb', 'org': 'AS64496'}, 'b', 110)
+        self.assertEqual(cache.provenance['city'], echoip.caches.InfoField('Keb', 'b', 110))
+        self.assertEqual(cache.fields(15, now=120), {'city': 'Keb', 'org': 'AS64496'})
+        self.assertEqual(cache.missing(['city', 'loc', ('country', 'org')], 15, now=120), ['loc'])
+        self.assertEqual(cache.missing(['city', 'loc'], now=120), [])
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestFileCacheBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'echoip.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_and_load(self):
+        """Tests that records round trip through the file without leaving temporary files"""
+        backend = echoip.caches.FileCacheBackend(self.path)
+        self.assertIsNone(backend.load())
+        record = echoip.caches.CacheRecord(ipaddress.IPv6Address(u'2001:db8::1'), {'city': 'Keb'},
+                                           1234.5, 'http://ip-api.com/json')
+        backend.store(record)
+        self.assertEqual(echoip.caches.FileCacheBackend(self.path).load(), record)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['echoip.json'])
+        backend.clear()
+        self.assertIsNone(backend.load())
+        backend.clear()
+
+    def test_scoped(self):
+        """Tests that scoped backends keep separate records in their own files"""
+        backend = echoip.caches.FileCacheBackend(self.path)
+        first, second = backend.scoped('egress-proxy=http://a:3128'), backend.scoped('ipv6')
+        first.store(echoip.caches.CacheRecord(ipaddress.IPv4Address(u'127.0.0.2'), {}, 1.0, 'a'))
+        second.store(echoip.caches.CacheRecord(ipaddress.IPv6Address(u'::1'), {}, 2.0, 'b'))
+        self.assertIsNone(backend.load())
+        self.assertEqual(backend.scoped('egress-proxy=http://a:3128').load().ip_address,
+                         ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(second.load().ip_address, ipaddress.IPv6Address(u'::1'))
+        self.assertNotEqual(first.path, second.path)
+        self.assertEqual(os.path.dirname(first.path), self.directory)
+
+        memory = echoip.caches.MemoryCacheBackend()
+        self.assertIs(memory.scoped('a'), memory.scoped('a'))
+        self.assertIsNot(memory.scoped('a'), memory.scoped('b'))
+
+    def test_corrupt_file(self):
+        """Tests that an unreadable cache file is treated as empty"""
+        with open(self.path, 'w') as cache_file:
+            cache_file.write('{"ip_address": ')
+        self.assertIsNone(echoip.caches.FileCacheBackend(self.path).load())
+
+    def test_provider_uses_shared_record(self):
+        """Tests that a new provider uses the fresh record stored by another"""
+        first = DelayedIPSource(u'127.0.0.1')
+        echoip.providers.IPProvider([first], cache_backend=echoip.caches.FileCacheBackend(self.path)).get_ip()
+        second = DelayedIPSource(u'127.0.0.2')
+        ipp = echoip.providers.IPProvider([second], cache_backend=echoip.caches.FileCacheBackend(self.path))
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(second.fetch_count, 0)
+
+        ipp.invalidate_cache()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+
+    def test_shared_field_provenance(self):
+        """Tests that every field keeps its own source and fetch time through a shared file"""
+        now = [1000.0]
+        clock = lambda: now[0]
+        city = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        org = DelayedIPSource(u'127.0.0.1', info={'org': 'AS64496'})
+        city.source_id, org.source_id = 'city', 'org'
+        echoip.providers.IPProvider([city], cache_backend=echoip.caches.FileCacheBackend(self.path),
+                                    cache_ttl=100, info_ttl=60, clock=clock).get_info(['city'])
+        now[0] = 1050.0
+        echoip.providers.IPProvider([org], cache_backend=echoip.caches.FileCacheBackend(self.path),
+                                    cache_ttl=100, info_ttl=60, clock=clock).get_info(['org'])
+
+        now[0] = 1070.0
+        ipp = echoip.providers.IPProvider([city, org], cache_backend=echoip.caches.FileCacheBackend(self.path),
+                                          cache_ttl=100, info_ttl=60, clock=clock)
+        self.assertEqual(ipp.get_info(['org']), {'org': 'AS64496'})
+        self.assertEqual((city.fetch_count, org.fetch_count), (1, 1))
+        self.assertEqual(ipp.info_provenance['city'], echoip.caches.InfoField('Keb', 'city', 1000.0))
+        self.assertEqual(ipp.info_provenance['org'], echoip.caches.InfoField('AS64496', 'org', 1050.0))
+        self.assertEqual(ipp.get_info(['city']), {'city': 'Keb', 'org': 'AS64496'})
+        self.assertEqual(city.fetch_count, 2)
+
+    def test_record_without_fields(self):
+        """Tests that a record stored without field provenance gives every field the record's"""
+        backend = echoip.caches.FileCacheBackend(self.path)
+        backend.store(echoip.caches.CacheRecord(ipaddress.IPv4Address(u'127.0.0.1'), {'city': 'Keb'}, 10.0, 'old'))
+        self.assertIsNone(backend.load().fields)
+        cache = echoip.caches.IPCache(100, backend=backend, clock=lambda: 20.0)
+        cache.load()
+        self.assertEqual(cache.provenance, {'city': echoip.caches.InfoField('Keb', 'old', 10.0)})
+
+    def test_expired_shared_record(self):
+        """Tests that a record older than the cache_ttl is refreshed"""
+        backend = echoip.caches.FileCacheBackend(self.path)
+        backend.store(echoip.caches.CacheRecord(ipaddress.IPv4Address(u'127.0.0.1'), {}, time.time() - 60, 'old'))
+        source = DelayedIPSource(u'127.0.0.2')
+        ipp = echoip.providers.IPProvider([source], cache_ttl=30, cache_backend=backend)
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(backend.load().source_id, source.source_id)
+
+    def test_single_lookup_across_threads(self):
+        """Tests that providers sharing the file in one process make a single lookup"""
+        srcs = [DelayedIPSource(u'127.0.0.1', 0.1) for _ in range(5)]
+        threads = [threading.Thread(target=echoip.providers.IPProvider(
+            [source], cache_backend=echoip.caches.FileCacheBackend(self.path)).get_ip) for source in srcs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(source.fetch_count for source in srcs), 1)
+
+    @unittest.skipIf(echoip.caches.fcntl is None, "file locking requires fcntl")
+    def test_single_lookup_across_processes(self):
+        """Tests that processes sharing the file make a single lookup"""
+        context = multiprocessing.get_context('fork')
+        fetches = context.Value('i', 0)
+        processes = [context.Process(target=_lookup, args=(self.path, fetches)) for _ in range(5)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(fetches.value, 1)
@@ -0,0 +1,105 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import ipaddress
+import requests
+
+import echoip.caches
+import echoip.providers
+import echoip.sources
+import echoip.transport
+
+from .fakes import DelayedIPSource, EchoHTTPServer
+
+
+class TestDualStackIPProvider(unittest.TestCase):
+    def setUp(self):
+        self.server4 = EchoHTTPServer('127.0.0.1')
+        try:
+            self.server6 = EchoHTTPServer('::1')
+        except (IOError, OSError):
+            self.server4.close()
+            self.skipTest("IPv6 loopback is not available")
+        self.factory = echoip.sources.IPSourceFactory(use_builtins=False)
+        self.factory.add_source(echoip.sources.SimpleIPSource, self.server4.url)
+        self.factory.add_source(echoip.sources.SimpleIPSource, self.server6.url)
+
+    def tearDown(self):
+        self.server4.close()
+        self.server6.close()
+
+    def test_get_ips(self):
+        """Tests that each family is looked up over its own address family"""
+        dsp = echoip.providers.DualStackIPProvider(self.factory, cache_ttl={4: 60, 6: 30})
+        result = dsp.get_ips()
+        self.assertEqual(result, echoip.providers.DualStackResult(ipaddress.IPv4Address(u'127.0.0.1'),
+                                                                  ipaddress.IPv6Address(u'::1'), {}))
+        self.assertEqual(dsp.get_ips(), result)
+        dsp.invalidate_cache()
+        self.assertFalse(dsp.provider_for(4).is_cache_valid())
+        dsp.close()
+
+    def test_shared_file_backend(self):
+        """Tests that the families sharing a file backend each keep their own record and TTL"""
+        directory = tempfile.mkdtemp()
+        try:
+            backend = echoip.caches.FileCacheBackend(os.path.join(directory, 'echoip.json'))
+            dsp = echoip.providers.DualStackIPProvider(self.factory, cache_ttl={4: 60, 6: 30},
+                                                       cache_backend=backend)
+            expected = echoip.providers.DualStackResult(ipaddress.IPv4Address(u'127.0.0.1'),
+                                                        ipaddress.IPv6Address(u'::1'), {})
+            self.assertEqual(dsp.get_ips(), expected)
+            dsp.close()
+            dsp = echoip.providers.DualStackIPProvider(self.factory, cache_ttl={4: 60, 6: 30},
+                                                       cache_backend=backend)
+            self.assertEqual(dsp.get_ips(), expected)
+            self.assertEqual(dsp.provider_for(6).cache.backend.load().ip_address, ipaddress.IPv6Address(u'::1'))
+            self.assertIsNone(backend.load())
+            dsp.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_missing_family(self):
+        """Tests that a family without a reachable source is reported as an error"""
+        factory = echoip.sources.IPSourceFactory(use_builtins=False)
+        factory.add_source(echoip.sources.SimpleIPSource, self.server4.url)
+        result = echoip.providers.DualStackIPProvider(factory, deadline=2).get_ips()
+        self.assertEqual(result.ipv4, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertIsNone(result.ipv6)
+        self.assertIsInstance(result.errors[6], echoip.providers.NullResponseFromSourcesError)
+
+    def test_family_error(self):
+        """Tests that any error of one family is reported without losing the other family's address"""
+        dsp = echoip.providers.DualStackIPProvider(self.factory)
+
+        def get_ip():
+            raise RuntimeError('unexpected')
+        dsp.provider_for(6).get_ip = get_ip
+        result = dsp.get_ips()
+        self.assertEqual(result.ipv4, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertIsNone(result.ipv6)
+        self.assertIsInstance(result.errors[6], RuntimeError)
+        dsp.close()
+
+    def test_pinned_transport(self):
+        """Tests that a transport pinned to a family does not connect over the other"""
+        transport = echoip.transport.HTTPTransport(family=socket.AF_INET6)
+        self.assertEqual(transport.family, socket.AF_INET6)
+        source = echoip.sources.SimpleIPSource(self.server4.url, transport)
+        with self.assertRaises(requests.ConnectionError):
+            source.fetch()
+        self.assertEqual(echoip.sources.SimpleIPSource(self.server6.url, transport).fetch().ip_address,
+                         ipaddress.IPv6Address(u'::1'))
+
+    def test_ip_version(self):
+        """Tests that providers restricted to an IP version skip answers of the other"""
+        ipp = echoip.providers.IPProvider([DelayedIPSource(u'127.0.0.1'), DelayedIPSource(u'::1')], ip_version=6)
+        for _ in range(3):
+            ipp.invalidate_cache()
+            self.assertEqual(ipp.get_ip(), ipaddress.IPv6Address(u'::1'))
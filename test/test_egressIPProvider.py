@@ -0,0 +1,75 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import ipaddress
+
+import echoip.caches
+import echoip.providers
+import echoip.sources
+
+from .fakes import EchoHTTPServer
+
+
+class TestEgressIPProvider(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoHTTPServer()
+        self.url = self.server.url
+
+    def tearDown(self):
+        self.server.close()
+
+    def provider(self, url=None, **provider_options):
+        fac = echoip.sources.IPSourceFactory(use_builtins=False)
+        fac.add_source(echoip.sources.SimpleIPSource, url or self.url)
+        return echoip.providers.EgressIPProvider(fac, **provider_options)
+
+    def test_source_addresses(self):
+        """Tests that each local address is looked up through its own bound transport"""
+        epp = self.provider()
+        results = epp.get_ips(['127.0.0.2', '127.0.0.3', '127.0.0.2'])
+        self.assertEqual(results.ips, {'127.0.0.2': ipaddress.IPv4Address(u'127.0.0.2'),
+                                       '127.0.0.3': ipaddress.IPv4Address(u'127.0.0.3')})
+        self.assertEqual(results.errors, {})
+        self.assertEqual(epp.num_egresses, 2)
+        self.assertIs(epp.provider_for('127.0.0.2'), epp.provider_for('127.0.0.2'))
+        epp.close()
+        self.assertEqual(epp.num_egresses, 0)
+
+    def test_proxy_and_errors(self):
+        """Tests that proxies are used and failed egress paths are reported without failing the batch"""
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        dead_proxy = 'http://127.0.0.1:{}'.format(closed.getsockname()[1])
+        closed.close()
+
+        epp = self.provider('http://echoip.invalid/')
+        results = epp.get_ips([self.url, dead_proxy])
+        self.assertEqual(results.ips, {self.url: ipaddress.IPv4Address(u'127.0.0.1')})
+        self.assertIsInstance(results.errors[dead_proxy], echoip.providers.NullResponseFromSourcesError)
+        self.assertEqual(epp.get_ip(self.url), ipaddress.IPv4Address(u'127.0.0.1'))
+
+    def test_shared_file_backend(self):
+        """Tests that egress paths sharing a file backend each keep their own record"""
+        directory = tempfile.mkdtemp()
+        try:
+            backend = echoip.caches.FileCacheBackend(os.path.join(directory, 'echoip.json'))
+            results = self.provider(cache_backend=backend).get_ips(['127.0.0.2', '127.0.0.3'])
+            self.assertEqual(results.ips, {'127.0.0.2': ipaddress.IPv4Address(u'127.0.0.2'),
+                                           '127.0.0.3': ipaddress.IPv4Address(u'127.0.0.3')})
+            epp = self.provider(cache_backend=backend)
+            self.assertEqual(epp.get_ip('127.0.0.3'), ipaddress.IPv4Address(u'127.0.0.3'))
+            self.assertEqual(epp.provider_for('127.0.0.2').cache.backend.load().ip_address,
+                             ipaddress.IPv4Address(u'127.0.0.2'))
+            self.assertIsNone(backend.load())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_empty(self):
+        """Tests that an empty batch makes no lookups"""
+        self.assertEqual(self.provider().get_ips([]), echoip.providers.BatchResult({}, {}))
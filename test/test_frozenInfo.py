@@ -0,0 +1,68 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import pickle
+import time
+import unittest
+
+from ipaddress import ip_address
+
+import echoip.providers
+import echoip.sources
+
+
+class TestFrozenInfo(unittest.TestCase):
+    def test_mapping(self):
+        """Tests that the info reads like a dict and compares equal to one"""
+        info = echoip.sources.FrozenInfo({'country': 'US', 'org': 'Example'})
+        self.assertEqual(info['country'], 'US')
+        self.assertEqual(info.get('city', 'none'), 'none')
+        self.assertIn('org', info)
+        self.assertEqual(len(info), 2)
+        self.assertEqual(info, {'country': 'US', 'org': 'Example'})
+        self.assertEqual({'country': 'US', 'org': 'Example'}, info)
+        self.assertNotEqual(info, {'country': 'US'})
+        self.assertEqual(dict(info), {'country': 'US', 'org': 'Example'})
+        self.assertEqual(pickle.loads(pickle.dumps(info)), info)
+
+    def test_immutable(self):
+        """Tests that the info cannot be changed or given attributes"""
+        info = echoip.sources.FrozenInfo({'country': 'US'})
+        with self.assertRaises(TypeError):
+            info['country'] = 'CA'
+        with self.assertRaises(AttributeError):
+            info.update({'country': 'CA'})
+        with self.assertRaises(AttributeError):
+            info.extra = True
+        with self.assertRaises(TypeError):
+            hash(info)
+
+    def test_of(self):
+        """Tests that results freeze dict info and share info that is already frozen"""
+        info = echoip.sources.FrozenInfo({'country': 'US'})
+        self.assertIs(echoip.sources.FrozenInfo.of(info), info)
+        self.assertIs(echoip.sources.FrozenInfo.of({}), echoip.sources.EMPTY_INFO)
+        self.assertIs(echoip.sources.FrozenInfo.of(None), echoip.sources.EMPTY_INFO)
+        result = echoip.sources.FetchResult(ip_address(u'127.0.0.1'), {'country': 'US'}, time.time(), 0, 'a')
+        self.assertIsInstance(result.info, echoip.sources.FrozenInfo)
+
+    def test_merge(self):
+        """Tests that the earliest info wins and a lone non-empty info is shared, not copied"""
+        first = echoip.sources.FrozenInfo({'country': 'US', 'org': 'First'})
+        second = echoip.sources.FrozenInfo({'org': 'Second', 'city': 'Keb'})
+        merged = echoip.sources.FrozenInfo.merge([first, second])
+        self.assertEqual(merged, {'country': 'US', 'org': 'First', 'city': 'Keb'})
+        self.assertEqual(first, {'country': 'US', 'org': 'First'})
+        self.assertIs(echoip.sources.FrozenInfo.merge([echoip.sources.EMPTY_INFO, first]), first)
+        self.assertIs(echoip.sources.FrozenInfo.merge([]), echoip.sources.EMPTY_INFO)
+
+    def test_consensus_leaves_sources_untouched(self):
+        """Tests that merging the info of agreeing sources does not change the info of any source"""
+        first = {'country': 'US'}
+        second = {'city': 'Keb', 'country': 'CA'}
+        consensus = echoip.providers._Consensus(2)
+        consensus.add(echoip.sources.FetchResult(ip_address(u'127.0.0.1'), first, time.time(), 0, 'a'))
+        agreement = consensus.add(echoip.sources.FetchResult(ip_address(u'127.0.0.1'), second, time.time(), 0, 'b'))
+        self.assertEqual(agreement.info, {'country': 'US', 'city': 'Keb'})
+        self.assertEqual(first, {'country': 'US'})
+        self.assertEqual(second, {'city': 'Keb', 'country': 'CA'})
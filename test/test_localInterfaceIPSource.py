@@ -0,0 +1,68 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import os
+import tempfile
+import unittest
+
+import ipaddress
+import mock
+
+import echoip.providers
+import echoip.sources
+
+from .fakes import DelayedIPSource
+
+
+class TestLocalInterfaceIPSource(unittest.TestCase):
+    def setUp(self):
+        self.source = echoip.sources.LocalInterfaceIPSource()
+        self.routes = {4: ipaddress.ip_address(u'10.0.0.7'), 6: None}
+        self.source._route_address = self.routes.get
+        self.if_inet6 = tempfile.NamedTemporaryFile('w', delete=False)
+        self.if_inet6.write('00000000000000000000000000000001 01 80 10 80       lo\n'
+                            '2a001450400100000000000000000001 02 40 00 00     eth1\n'
+                            '2a001450400100000000000000000002 02 40 00 40     eth1\n')
+        self.if_inet6.close()
+
+    def tearDown(self):
+        os.remove(self.if_inet6.name)
+
+    def test_global_address(self):
+        """Tests that a global address held on an interface is returned with the interface"""
+        self.routes[6] = ipaddress.ip_address(u'2a00:1450:4001::1')
+        with mock.patch.object(echoip.sources, '_IF_INET6_PATH', self.if_inet6.name):
+            result = self.source.fetch()
+        self.assertEqual(result.ip_address, ipaddress.IPv6Address(u'2a00:1450:4001::1'))
+        self.assertEqual(result.info, {'interface': 'eth1'})
+        self.assertEqual(self.source.ip_address, result.ip_address)
+        self.assertEqual(result.source_id, 'local:ipv4,ipv6')
+
+    def test_no_global_address(self):
+        """Tests that private and missing addresses fail so providers fall back"""
+        with self.assertRaises(echoip.sources.NoGlobalAddressError):
+            self.source.fetch()
+
+    def test_interface_addresses(self):
+        """Tests that unusable addresses are left out of the interface addresses"""
+        with mock.patch.object(echoip.sources, '_IF_INET6_PATH', self.if_inet6.name):
+            addresses = self.source._interface_addresses()
+        self.assertEqual(addresses[ipaddress.IPv6Address(u'::1')], 'lo')
+        self.assertNotIn(ipaddress.IPv6Address(u'2a00:1450:4001::2'), addresses)
+
+    def test_route_address(self):
+        """Tests that the route lookup returns an address or None without sending anything"""
+        address = echoip.sources.LocalInterfaceIPSource()._route_address(4)
+        self.assertTrue(address is None or address.version == 4)
+
+    def test_provider_tiers(self):
+        """Tests that providers answer from the local tier first and fall back to the network"""
+        network = DelayedIPSource(u'127.0.0.2')
+        ipp = echoip.providers.IPProvider([network, self.source])
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(network.fetch_count, 1)
+
+        self.routes[4] = ipaddress.ip_address(u'93.184.216.34')
+        ipp.invalidate_cache()
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'93.184.216.34'))
+        self.assertEqual(network.fetch_count, 1)
@@ -0,0 +1,96 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import unittest
+
+import echoip.metrics
+import echoip.providers
+
+from .fakes import DelayedIPSource
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = echoip.metrics.MetricsRegistry()
+
+    def test_render(self):
+        """Tests that counters and histograms render in the OpenMetrics text format"""
+        counter = self.registry.counter('lookups', 'Lookups "made".', ('source',))
+        counter.labels('http://a/"b"').inc()
+        counter.labels('http://a/"b"').inc(2)
+        histogram = self.registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# TYPE lookups counter',
+            '# HELP lookups Lookups "made".',
+            'lookups_total{source="http://a/\\"b\\""} 3',
+            '# TYPE latency_seconds histogram',
+            '# HELP latency_seconds Latency.',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_count 3',
+            'latency_seconds_sum 5.55',
+            '# EOF', '']))
+
+    def test_registration(self):
+        """Tests that metrics are shared by name and conflicting registrations fail"""
+        counter = self.registry.counter('lookups', 'Lookups.', ('source',))
+        self.assertIs(self.registry.counter('lookups', 'Lookups.', ('source',)), counter)
+        self.assertIs(self.registry.get('lookups'), counter)
+        with self.assertRaises(ValueError):
+            self.registry.histogram('lookups', 'Lookups.', ('source',))
+        with self.assertRaises(ValueError):
+            counter.labels('a', 'b')
+        with self.assertRaises(ValueError):
+            counter.labels('a').inc(-1)
+
+
+class TestProviderMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = echoip.metrics.MetricsRegistry()
+        self.metrics = echoip.metrics.ProviderMetrics(self.registry)
+
+    def value(self, name, *labels):
+        return self.registry.get(name).labels(*labels).value
+
+    def test_fetches_and_cache(self):
+        """Tests that provider fetches, errors and cache lookups are recorded"""
+        failing = DelayedIPSource(u'127.0.0.2', error=ValueError('bad'))
+        working = DelayedIPSource(u'127.0.0.1', 0.01)
+        ipp = echoip.providers.IPProvider([failing, working], circuit_breaker=None, metrics=self.metrics)
+        ipp._ordered_sources = lambda *args: [failing, working]
+        ipp.get_ip()
+        ipp.get_ip()
+        self.assertEqual(self.value('echoip_source_requests', working.source_id, 'success'), 1)
+        self.assertEqual(self.value('echoip_source_requests', failing.source_id, 'failure'), 1)
+        self.assertEqual(self.value('echoip_source_errors', failing.source_id, 'ValueError'), 1)
+        self.assertEqual(self.registry.get('echoip_source_latency_seconds').labels(working.source_id).count, 1)
+        self.assertEqual(self.value('echoip_cache_lookups', 'miss'), 1)
+        self.assertEqual(self.value('echoip_cache_lookups', 'hit'), 1)
+        self.assertIn('echoip_cache_lookups_total{result="hit"} 1', self.registry.render())
+
+    def test_deadline_timeouts(self):
+        """Tests that a fetch cut short by the deadline is recorded in the metrics but not the source stats"""
+        slow = DelayedIPSource(u'127.0.0.1', 1)
+        ipp = echoip.providers.IPProvider([slow], deadline=0.05, metrics=self.metrics)
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            ipp.get_ip()
+        self.assertEqual(self.value('echoip_source_requests', slow.source_id, 'failure'), 1)
+        self.assertEqual(self.value('echoip_source_errors', slow.source_id, 'Timeout'), 1)
+        self.assertEqual(self.registry.get('echoip_source_latency_seconds').labels(slow.source_id).count, 1)
+        self.assertEqual(ipp.source_stats[slow].failures, 0)
+
+    def test_consensus(self):
+        """Tests that agreement rounds are recorded by outcome"""
+        ipp = echoip.providers.MultisourceIPProvider(
+            [DelayedIPSource(u'127.0.0.1'), DelayedIPSource(u'127.0.0.1', 0.01)], metrics=self.metrics)
+        ipp.get_ip()
+        ipp = echoip.providers.MultisourceIPProvider(
+            [DelayedIPSource(u'127.0.0.1'), DelayedIPSource(u'127.0.0.2')], metrics=self.metrics)
+        with self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError):
+            ipp.get_ip()
+        self.assertEqual(self.value('echoip_consensus_rounds', 'agreement'), 1)
+        self.assertEqual(self.value('echoip_consensus_rounds', 'failure'), 1)
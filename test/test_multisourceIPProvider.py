@@ -8,8 +8,11 @@ import requests_mock
 from ipaddress import IPv4Address
 
 import echoip.sources
+import echoip.policies
 import echoip.providers
 
+from .fakes import DelayedIPSource
+
 
 class TestMultisourceIPProvider(unittest.TestCase):
     @requests_mock.Mocker()
@@ -188,3 +191,57 @@ class TestMultisourceIPProvider(unittest.TestCase):
                 time.sleep(0.5)
             self.assertFalse(ipp.is_cache_valid())
             self.assertEquals(ipp.get_ip(), IPv4Address(u'127.0.0.2'))
+
+    def test_quorum_requires_min_source_agreement(self):
+        """Tests that the number of agreeing sources must reach min_source_agreement"""
+        ipp = echoip.providers.MultisourceIPProvider(
+            [DelayedIPSource(u'127.0.0.1'), DelayedIPSource(u'127.0.0.1', 0.01), DelayedIPSource(u'127.0.0.2')],
+            min_source_agreement=3)
+        self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError, ipp.get_ip)
+
+    def test_concurrent_get_ip(self):
+        """Tests that concurrent mode returns once a quorum agrees without waiting on stragglers"""
+        slow = DelayedIPSource(u'127.0.0.1', 2)
+        ipp = echoip.providers.MultisourceIPProvider(
+            [DelayedIPSource(u'127.0.0.1', 0.05, {'a': 1}), DelayedIPSource(u'127.0.0.1', 0.1, {'b': 2}),
+             DelayedIPSource(u'127.0.0.2', 0.01), slow],
+            min_source_agreement=2, concurrent=True)
+        timestamp = time.time()
+        self.assertEqual(ipp.get_ip(), IPv4Address(u'127.0.0.1'))
+        self.assertLess(time.time() - timestamp, 1)
+        self.assertEqual(ipp.get_info(), {'a': 1, 'b': 2})
+
+    def test_concurrent_bounded_workers(self):
+        """Tests that sources that never started are cancelled once a quorum is reached"""
+        srcs = [DelayedIPSource(u'127.0.0.1', 0.05) for _ in range(6)]
+        ipp = echoip.providers.MultisourceIPProvider(srcs, min_source_agreement=2,
+                                                     concurrent=True, max_workers=2)
+        self.assertEqual(ipp.get_ip(), IPv4Address(u'127.0.0.1'))
+        time.sleep(0.2)
+        self.assertLessEqual(sum(src.fetch_count for src in srcs), 4)
+
+    def test_concurrent_non_agreement(self):
+        """Tests that concurrent mode fails when the sources never agree"""
+        ipp = echoip.providers.MultisourceIPProvider(
+            [DelayedIPSource(u'127.0.0.1'), DelayedIPSource(u'127.0.0.2')], concurrent=True)
+        self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError, ipp.get_ip)
+
+    def test_concurrent_all_breakers_open(self):
+        """Tests that a concurrent lookup with every breaker open fails for lack of agreement"""
+        srcs = [DelayedIPSource(u'127.0.0.1', error=ValueError('bad data')),
+                DelayedIPSource(u'127.0.0.1', 0.01, error=ValueError('bad data'))]
+        ipp = echoip.providers.MultisourceIPProvider(
+            srcs, concurrent=True, circuit_breaker=lambda: echoip.policies.CircuitBreaker(failure_threshold=1))
+        for _ in range(2):
+            self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError, ipp.get_ip)
+        self.assertEqual([src.fetch_count for src in srcs], [1, 1])
+
+    def test_deadline(self):
+        """Tests that the deadline bounds the multisource lookup in both modes"""
+        for concurrent in (False, True):
+            ipp = echoip.providers.MultisourceIPProvider(
+                [DelayedIPSource(u'127.0.0.1', 0.01), DelayedIPSource(u'127.0.0.1', 1)],
+                concurrent=concurrent, deadline=0.2)
+            timestamp = time.time()
+            self.assertRaises(echoip.providers.InsufficientSourcesForAgreementError, ipp.get_ip)
+            self.assertLess(time.time() - timestamp, 0.5)
@@ -0,0 +1,243 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import time
+import unittest
+
+import ipaddress
+import requests_mock
+
+import echoip.policies
+import echoip.providers
+import echoip.sources
+
+from .fakes import DelayedIPSource
+
+
+class TestSourceStats(unittest.TestCase):
+    def test_ewma(self):
+        """Tests that latency and success rate are exponentially weighted moving averages"""
+        stats = echoip.policies.SourceStats(alpha=0.5, failure_penalty=0)
+        self.assertEqual(stats.expected_cost(), 0)
+        stats.record_success(1.0)
+        self.assertEqual(stats.latency, 1.0)
+        stats.record_success(2.0)
+        self.assertEqual(stats.latency, 1.5)
+        stats.record_failure(ValueError('bad data'), 1.5)
+        self.assertEqual(stats.success_rate, 0.5)
+        self.assertEqual(stats.expected_cost(), 3.0)
+        self.assertEqual(list(stats.recent_errors), ['ValueError'])
+        self.assertEqual((stats.successes, stats.failures, stats.samples), (2, 1, 3))
+
+    def test_failure_penalty(self):
+        """Tests that a source failing instantly is not considered cheap"""
+        stats = echoip.policies.SourceStats(failure_penalty=1.0)
+        stats.record_failure(IOError('refused'), 0.001)
+        self.assertEqual(stats.latency, 1.0)
+
+
+class TestWeightedScheduler(unittest.TestCase):
+    def test_cheapest_first(self):
+        """Tests that sources are ordered by expected cost with unobserved sources first"""
+        fast, slow, flaky, new = [echoip.policies.SourceStats() for _ in range(4)]
+        fast.record_success(0.1)
+        slow.record_success(1.0)
+        flaky.record_success(0.1)
+        for _ in range(5):
+            flaky.record_failure(IOError('down'))
+        stats = {'fast': fast, 'slow': slow, 'flaky': flaky, 'new': new}
+        scheduler = echoip.policies.WeightedScheduler(exploration=0)
+        self.assertEqual(scheduler.order(stats), ['new', 'fast', 'slow', 'flaky'])
+
+    def test_exploration(self):
+        """Tests that exploration sometimes tries another source first"""
+        fast, slow = echoip.policies.SourceStats(), echoip.policies.SourceStats()
+        fast.record_success(0.1)
+        slow.record_success(1.0)
+        scheduler = echoip.policies.WeightedScheduler(exploration=1)
+        self.assertEqual(scheduler.order({'fast': fast, 'slow': slow}), ['slow', 'fast'])
+
+    def test_provider_prefers_fast_sources(self):
+        """Tests that once observed the fast source serves the lookups"""
+        fast = DelayedIPSource(u'127.0.0.1', 0.001)
+        slow = DelayedIPSource(u'127.0.0.2', 0.05)
+        failing = DelayedIPSource(u'127.0.0.3', error=ValueError('bad data'))
+        ipp = echoip.providers.IPProvider([fast, slow, failing],
+                                          scheduler=echoip.policies.WeightedScheduler(exploration=0))
+        for _ in range(5):
+            ipp.invalidate_cache()
+            ipp.get_ip()
+        ipp.invalidate_cache()
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertLessEqual(failing.fetch_count, 1)
+        self.assertLessEqual(slow.fetch_count, 1)
+        self.assertGreaterEqual(fast.fetch_count, 5)
+        self.assertEqual(ipp.source_stats[fast].successes, fast.fetch_count)
+
+    def test_provider_records_errors(self):
+        """Tests that the provider records failures and their types per source"""
+        failing = DelayedIPSource(u'127.0.0.3', error=ValueError('bad data'))
+        working = DelayedIPSource(u'127.0.0.1')
+        ipp = echoip.providers.IPProvider([failing, working])
+        ipp._ordered_sources = lambda *args: [failing, working]
+        ipp.get_ip()
+        self.assertEqual(ipp.source_stats[failing].failures, 1)
+        self.assertEqual(list(ipp.source_stats[failing].recent_errors), ['ValueError'])
+
+    @requests_mock.Mocker()
+    def test_provider_demotes_bad_key(self, m):
+        """Tests that a JSON source without its IP key is recorded as failing and tried last"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='{"query": "127.0.0.2"}')
+        bad_key = echoip.sources.JSONIPSource('https://fake-ip-url.com/', 'missing')
+        working = DelayedIPSource(u'127.0.0.1', 0.001)
+        ipp = echoip.providers.IPProvider([bad_key, working], circuit_breaker=None,
+                                          scheduler=echoip.policies.WeightedScheduler(exploration=0))
+        ipp._ordered_sources = lambda *args: [bad_key, working]
+        self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        del ipp._ordered_sources
+        for _ in range(5):
+            ipp.invalidate_cache()
+            self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(list(ipp.source_stats[bad_key].recent_errors), ['InvalidJSONSourceIPKey'])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_consecutive_failures(self):
+        """Tests that consecutive failures open the breaker and a success resets the count"""
+        breaker = echoip.policies.CircuitBreaker(failure_threshold=2, cooldown=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.available)
+        self.assertFalse(breaker.allow_request())
+
+    def test_error_rate(self):
+        """Tests that the error rate over the window opens the breaker"""
+        breaker = echoip.policies.CircuitBreaker(failure_threshold=100, error_rate=0.5, window=4, min_requests=4)
+        for _ in range(2):
+            breaker.record_success()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.OPEN)
+
+    def test_half_open_probe(self):
+        """Tests that after the cooldown a single probe is let through"""
+        breaker = echoip.policies.CircuitBreaker(failure_threshold=1, cooldown=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow_request())
+
+    def test_release(self):
+        """Tests that a released probe lets the next probe through without closing the breaker"""
+        breaker = echoip.policies.CircuitBreaker(failure_threshold=1, cooldown=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.release()
+        self.assertEqual(breaker.state, echoip.policies.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+
+    def test_provider_skips_open_sources(self):
+        """Tests that the provider skips a source with an open breaker and probes it after the cooldown"""
+        failing = DelayedIPSource(u'127.0.0.3', error=ValueError('bad data'))
+        working = DelayedIPSource(u'127.0.0.1')
+        ipp = echoip.providers.IPProvider(
+            [failing, working],
+            circuit_breaker=lambda: echoip.policies.CircuitBreaker(failure_threshold=1, cooldown=0.1))
+        ipp._ordered_sources = lambda *args: [src for src in (failing, working)
+                                              if ipp._sources[src]['breaker'].available]
+        ipp.get_ip()
+        self.assertEqual(ipp.breaker_states[failing], echoip.policies.CircuitBreaker.OPEN)
+        self.assertEqual(ipp.breaker_states[working], echoip.policies.CircuitBreaker.CLOSED)
+        for _ in range(3):
+            ipp.invalidate_cache()
+            self.assertEqual(ipp.get_ip(), ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(failing.fetch_count, 1)
+
+        time.sleep(0.11)
+        ipp.invalidate_cache()
+        ipp.get_ip()
+        self.assertEqual(failing.fetch_count, 2)
+
+    def test_provider_without_breakers(self):
+        """Tests that breakers can be disabled"""
+        failing = DelayedIPSource(u'127.0.0.3', error=ValueError('bad data'))
+        ipp = echoip.providers.IPProvider([failing], circuit_breaker=None)
+        for _ in range(10):
+            self.assertRaises(echoip.providers.NullResponseFromSourcesError, ipp.get_ip)
+        self.assertEqual(failing.fetch_count, 10)
+        self.assertEqual(ipp.breaker_states, {})
+
+
+class TestCapabilityIndex(unittest.TestCase):
+    def test_declared_and_learned(self):
+        """Tests that declared and learned keys decide which sources provide the required keys"""
+        index = echoip.policies.CapabilityIndex()
+        self.assertIsNone(index.provides('json', ['city']))
+        index.declare('plain', ())
+        self.assertFalse(index.provides('plain', ['city']))
+        self.assertTrue(index.provides('plain', None))
+        index.declare('json', ['city', 'country'])
+        index.learn('json', {'org': 'AS64496'})
+        self.assertTrue(index.provides('json', ['city', ('loc', 'org')]))
+        self.assertFalse(index.provides('json', ['loc']))
+        self.assertEqual(index.known_keys('json'), frozenset(['city', 'country', 'org']))
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def test_backoff(self):
+        """Tests that failed refreshes back off exponentially up to the maximum"""
+        policy = echoip.policies.StaleWhileRevalidate(hard_ttl=60, backoff=0.05, max_backoff=0.1)
+        self.assertTrue(policy.serves(59))
+        self.assertFalse(policy.serves(60))
+        self.assertTrue(policy.should_refresh())
+        policy.record_failure()
+        self.assertFalse(policy.should_refresh())
+        time.sleep(0.06)
+        self.assertTrue(policy.should_refresh())
+        policy.record_failure()
+        time.sleep(0.06)
+        self.assertFalse(policy.should_refresh())
+        policy.record_success()
+        self.assertTrue(policy.should_refresh())
+        self.assertEqual(policy.failures, 0)
+
+
+class TestAdaptivePolling(unittest.TestCase):
+    def test_interval(self):
+        """Tests that the interval backs off while stable and tightens after a change or first failure"""
+        polling = echoip.policies.AdaptivePolling(min_interval=10, max_interval=30, backoff=2, jitter=0)
+        self.assertEqual(polling.interval, 10)
+        polling.record_unchanged()
+        self.assertEqual(polling.interval, 20)
+        polling.record_unchanged()
+        self.assertEqual(polling.next_delay(), 30)
+        polling.record_change()
+        self.assertEqual(polling.interval, 10)
+        polling.record_unchanged()
+        polling.record_failure()
+        self.assertEqual(polling.interval, 10)
+        polling.record_failure()
+        self.assertEqual(polling.interval, 20)
+        with self.assertRaises(ValueError):
+            echoip.policies.AdaptivePolling(min_interval=10, max_interval=5)
+
+    def test_jitter(self):
+        """Tests that delays are spread around the interval by the jitter"""
+        polling = echoip.policies.AdaptivePolling(min_interval=10, jitter=0.2)
+        delays = [polling.next_delay() for _ in range(100)]
+        self.assertTrue(all(8 <= delay <= 12 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
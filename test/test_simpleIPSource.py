@@ -1,6 +1,7 @@
 __docformat__ = 'restructuredtext en'
 __author__ = 'Eli Flesher <eli@eflee.us>'
 
+import time
 import unittest
 
 import requests
@@ -10,6 +11,8 @@ import mock
 
 import echoip.sources
 
+from .fakes import EndlessBody
+
 
 class TestTextBasedIPSource(unittest.TestCase):
     def setUp(self):
@@ -26,7 +29,7 @@ class TestTextBasedIPSource(unittest.TestCase):
     def test_info_success(self, m):
         """Tests that a proper response from the URL yields no additional info (for this class)"""
         m.register_uri('GET', 'https://fake-ip-url.com/', text='127.0.0.1\n')
-        self.assertIsInstance(self.source.info, dict, "Additional info should be a dict")
+        self.assertIsInstance(self.source.info, echoip.sources.FrozenInfo, "Additional info should be a FrozenInfo")
         self.assertEquals({}, self.source.info)
 
     @requests_mock.Mocker()
@@ -81,3 +84,66 @@ class TestTextBasedIPSource(unittest.TestCase):
         self.assertIsNone(self.source._info)
         self.assertIsNotNone(self.source.info)
 
+    @requests_mock.Mocker()
+    def test_fetch_returns_snapshot(self, m):
+        """Tests that fetch returns an immutable FetchResult describing the fetch"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='127.0.0.1\n')
+        result = self.source.fetch()
+        self.assertIsInstance(result, echoip.sources.FetchResult)
+        self.assertEqual(ipaddress.IPv4Address(u'127.0.0.1'), result.ip_address)
+        self.assertEqual({}, result.info)
+        self.assertEqual('https://fake-ip-url.com/', result.source_id)
+        self.assertGreaterEqual(result.latency, 0)
+        with self.assertRaises(AttributeError):
+            result.ip_address = None
+
+    @requests_mock.Mocker()
+    def test_properties_read_snapshot(self, m):
+        """Tests that the ip and info properties do not fetch again once a snapshot exists"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='127.0.0.1\n')
+        self.source.fetch()
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='127.0.0.2\n')
+        self.assertEqual(ipaddress.IPv4Address(u'127.0.0.1'), self.source.ip_address)
+        self.assertEqual({}, self.source.info)
+        self.assertEqual(m.call_count, 1)
+
+    @mock.patch('requests.get')
+    def test_timeouts(self, m):
+        """Tests that every request carries the connect and read timeouts, lowered by a fetch timeout"""
+        m.return_value.iter_content.return_value = [b'127.0.0.1\n']
+        m.return_value.encoding = None
+        self.source.fetch()
+        self.assertEqual(m.call_args[1]['timeout'], echoip.sources.DEFAULT_TIMEOUT)
+        self.source.fetch(timeout=1)
+        self.assertEqual(m.call_args[1]['timeout'], (1, 1))
+        echoip.sources.SimpleIPSource('https://fake-ip-url.com/', timeout=0.5).fetch(timeout=1)
+        self.assertEqual(m.call_args[1]['timeout'], (0.5, 0.5))
+
+    @requests_mock.Mocker()
+    def test_reads_first_line(self, m):
+        """Tests that the body is read up to the end of its first non-blank line"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='\n  127.0.0.1\nnot an address\n')
+        self.assertEqual(ipaddress.IPv4Address(u'127.0.0.1'), self.source.fetch().ip_address)
+
+    @requests_mock.Mocker()
+    def test_max_bytes(self, m):
+        """Tests that a body without an end stops being read at the byte limit"""
+        body = EndlessBody(b'1')
+        m.register_uri('GET', 'https://fake-ip-url.com/', body=body)
+        source = echoip.sources.SimpleIPSource('https://fake-ip-url.com/', max_bytes=4096)
+        with self.assertRaises(echoip.sources.ResponseTooLargeError):
+            source.fetch()
+        self.assertLessEqual(body.bytes_read, 4096 + 1024)
+
+    @requests_mock.Mocker()
+    def test_slow_body(self, m):
+        """Tests that a body trickling in is cut off once the fetch timeout has passed"""
+        body = EndlessBody(b'1', delay=0.02)
+        m.register_uri('GET', 'https://fake-ip-url.com/', body=body)
+        source = echoip.sources.SimpleIPSource('https://fake-ip-url.com/', max_bytes=64 * 1024)
+        start = time.time()
+        with self.assertRaises(requests.Timeout):
+            source.fetch(timeout=0.1)
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(body.closed)
+
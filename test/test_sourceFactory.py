@@ -58,4 +58,20 @@ class TestSourceFactory(unittest.TestCase):
     def test_get_sources(self):
         """Tests that all sources are returned by get_sources"""
         fac = echoip.sources.IPSourceFactory()
-        self.assertEquals(len([x for x in fac.get_sources()]), fac.num_sources)
\ No newline at end of file
+        self.assertEquals(len([x for x in fac.get_sources()]), fac.num_sources)
+
+    def test_info_keys(self):
+        """Tests that generated sources carry the info keys declared for them"""
+        fac = echoip.sources.IPSourceFactory(use_builtins=False)
+        fac.add_source(echoip.sources.SimpleIPSource, 'https://fake-ip-url.com/')
+        fac.add_source(echoip.sources.JSONIPSource, 'https://fake-ip-json-url.com/', 'query',
+                       info_keys=['countryCode'])
+        fac.add_source(echoip.sources.JSONIPSource, 'https://other-ip-json-url.com/', 'ip')
+        info_keys = dict((source.source_id, source.info_keys) for source in fac.get_sources())
+        self.assertEqual(info_keys, {'https://fake-ip-url.com/': frozenset(),
+                                     'https://fake-ip-json-url.com/': frozenset(['countryCode']),
+                                     'https://other-ip-json-url.com/': None})
+        builtins = dict((source.source_id, source.info_keys)
+                        for source in echoip.sources.IPSourceFactory().get_sources())
+        self.assertIn('city', builtins['http://ip-api.com/json'])
+        self.assertIn('city', builtins['http://ipinfo.io/json'])
@@ -0,0 +1,113 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import contextlib
+import unittest
+
+import requests_mock
+
+import echoip.providers
+import echoip.sources
+import echoip.tracing
+
+from .fakes import DelayedIPSource
+
+
+class RecordingHooks(echoip.tracing.StageHooks):
+    """Records every stage that starts and ends"""
+    def __init__(self):
+        self.started = []
+        self.ended = []
+
+    def on_start(self, stage, context):
+        self.started.append(stage)
+        return len(self.started)
+
+    def on_end(self, stage, context, state, duration, error=None):
+        self.ended.append((stage, dict(context), state, duration, error))
+
+
+class FakeTracer(object):
+    """Records the spans started and the exceptions they exited with"""
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = {'name': name, 'attributes': attributes, 'error': None}
+        self.spans.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = e
+            raise
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.hooks = RecordingHooks()
+        echoip.tracing.set_hooks(self.hooks)
+
+    def tearDown(self):
+        echoip.tracing.set_hooks(None)
+
+    def test_disabled(self):
+        """Tests that stages share a no-op context manager while tracing is disabled"""
+        echoip.tracing.set_hooks(None)
+        self.assertIsNone(echoip.tracing.get_hooks())
+        self.assertIs(echoip.tracing.stage(echoip.tracing.REQUEST), echoip.tracing.stage(echoip.tracing.CONSENSUS))
+
+    @requests_mock.Mocker()
+    def test_source_stages(self, m):
+        """Tests that a JSON source reports its request, decoding and parsing stages"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='{"countryCode": "US", "query": "127.0.0.1"}')
+        source = echoip.sources.JSONIPSource('https://fake-ip-url.com/', 'query')
+        source.fetch()
+        self.assertEqual([stage for stage, _, _, _, _ in self.hooks.ended],
+                         [echoip.tracing.REQUEST, echoip.tracing.JSON_DECODE, echoip.tracing.IP_PARSE])
+        stage, context, state, duration, error = self.hooks.ended[0]
+        self.assertEqual(context, {'source_id': source.source_id})
+        self.assertEqual(state, 1)
+        self.assertGreaterEqual(duration, 0)
+        self.assertIsNone(error)
+
+    @requests_mock.Mocker()
+    def test_stage_error(self, m):
+        """Tests that the exception ending a stage is handed to the hooks"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='not json')
+        source = echoip.sources.JSONIPSource('https://fake-ip-url.com/', 'query')
+        with self.assertRaises(ValueError):
+            source.fetch()
+        stage, _, _, _, error = self.hooks.ended[-1]
+        self.assertEqual(stage, echoip.tracing.JSON_DECODE)
+        self.assertIsInstance(error, ValueError)
+
+    def test_provider_stages(self):
+        """Tests that multisource agreement and the required key check are reported"""
+        ipp = echoip.providers.MultisourceIPProvider(
+            [DelayedIPSource(u'127.0.0.1', info={'a': 1}), DelayedIPSource(u'127.0.0.1', 0.01, info={'a': 1})])
+        ipp.get_info(required_info_keys=['a'])
+        stages = [stage for stage, _, _, _, _ in self.hooks.ended]
+        self.assertIn(echoip.tracing.CONSENSUS, stages)
+        self.assertIn(echoip.tracing.VERIFY_KEYS, stages)
+        consensus = [(context, duration) for stage, context, _, duration, _ in self.hooks.ended
+                     if stage == echoip.tracing.CONSENSUS]
+        self.assertEqual([context for context, _ in consensus], [{'min_source_agreement': 2}])
+        # The agreement round spans the fetches
+        self.assertGreaterEqual(consensus[0][1], 0.01)
+
+    def test_opentelemetry(self):
+        """Tests that stages become spans that record the exception ending them"""
+        tracer = FakeTracer()
+        echoip.tracing.set_hooks(echoip.tracing.OpenTelemetryHooks(tracer))
+        with echoip.tracing.stage(echoip.tracing.REQUEST, source_id='a'):
+            with echoip.tracing.stage(echoip.tracing.IP_PARSE, source_id='a'):
+                pass
+        with self.assertRaises(KeyError):
+            with echoip.tracing.stage(echoip.tracing.JSON_DECODE, source_id='b'):
+                raise KeyError('query')
+        self.assertEqual([span['name'] for span in tracer.spans],
+                         [echoip.tracing.REQUEST, echoip.tracing.IP_PARSE, echoip.tracing.JSON_DECODE])
+        self.assertEqual(tracer.spans[0]['attributes'], {'source_id': 'a'})
+        self.assertIsNone(tracer.spans[0]['error'])
+        self.assertIsInstance(tracer.spans[2]['error'], KeyError)
@@ -0,0 +1,89 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import unittest
+
+import requests_mock
+import ipaddress
+
+import echoip.sources
+import echoip.transport
+
+
+class TestHTTPTransport(unittest.TestCase):
+    def setUp(self):
+        self.transport = echoip.transport.HTTPTransport(pool_maxsize=4, max_retries=2)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_session_per_host(self):
+        """Tests that one session is pooled per host and reused across URLs on that host"""
+        session = self.transport.session_for('https://fake-ip-url.com/')
+        self.assertIs(session, self.transport.session_for('https://FAKE-ip-url.com/other'))
+        self.assertIsNot(session, self.transport.session_for('https://fake-ip-json-url.com/'))
+        self.assertIsNot(session, self.transport.session_for('http://fake-ip-url.com/'))
+        self.assertEqual(self.transport.num_sessions, 3)
+
+    def test_adapter_configuration(self):
+        """Tests that the pool size and retries are applied to the mounted adapters"""
+        adapter = self.transport.session_for('https://fake-ip-url.com/').get_adapter('https://fake-ip-url.com/')
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_no_keep_alive(self):
+        """Tests that disabling keep-alive closes the connection after each request"""
+        transport = echoip.transport.HTTPTransport(keep_alive=False)
+        self.assertEqual(transport.session_for('https://fake-ip-url.com/').headers['Connection'], 'close')
+
+    def test_close(self):
+        """Tests that close drops the pooled sessions"""
+        self.transport.session_for('https://fake-ip-url.com/')
+        self.transport.close()
+        self.assertEqual(self.transport.num_sessions, 0)
+
+    @requests_mock.Mocker()
+    def test_source_uses_transport(self, m):
+        """Tests that a source configured with a transport fetches through it"""
+        m.register_uri('GET', 'https://fake-ip-url.com/', text='127.0.0.1\n')
+        source = echoip.sources.SimpleIPSource('https://fake-ip-url.com/', transport=self.transport)
+        self.assertEqual(source.fetch().ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+        self.assertEqual(self.transport.num_sessions, 1)
+        self.assertEqual(m.last_request.headers['User-Agent'], echoip.sources.USER_AGENT)
+
+    def test_factory_injects_transport(self):
+        """Tests that the factory shares its transport with every generated source"""
+        fac = echoip.sources.IPSourceFactory(transport=self.transport)
+        for source in fac.get_sources():
+            self.assertIs(source.transport, self.transport)
+
+    def test_factory_keeps_source_transport(self):
+        """Tests that a source configured with its own transport keeps it"""
+        own_transport = echoip.transport.HTTPTransport()
+        fac = echoip.sources.IPSourceFactory(use_builtins=False, transport=self.transport)
+        fac.add_source(echoip.sources.SimpleIPSource, 'https://fake-ip-url.com/', own_transport)
+        self.assertIs(next(fac.get_sources()).transport, own_transport)
+
+
+class TestEgress(unittest.TestCase):
+    def test_parse(self):
+        """Tests that egress paths are recognised as proxies, local addresses or interfaces"""
+        self.assertEqual(echoip.transport.Egress.parse('socks5://10.0.0.1:1080').proxy, 'socks5://10.0.0.1:1080')
+        self.assertEqual(echoip.transport.Egress.parse('192.0.2.7').source_address, '192.0.2.7')
+        self.assertEqual(echoip.transport.Egress.parse('2001:db8::7').source_address, '2001:db8::7')
+        self.assertEqual(echoip.transport.Egress.parse('eth1').interface, 'eth1')
+        egress = echoip.transport.Egress.parse('eth1')
+        self.assertIs(echoip.transport.Egress.parse(egress), egress)
+
+    def test_source_address(self):
+        """Tests that a transport bound to a local address mounts a bound adapter"""
+        transport = echoip.transport.HTTPTransport(egress='127.0.0.2')
+        adapter = transport.session_for('http://fake-ip-url.com/').get_adapter('http://fake-ip-url.com/')
+        self.assertEqual(adapter.poolmanager.connection_pool_kw['source_address'], ('127.0.0.2', 0))
+
+    def test_proxy(self):
+        """Tests that a transport through a proxy ignores the proxies of the environment"""
+        transport = echoip.transport.HTTPTransport(egress='http://127.0.0.1:3128')
+        session = transport.session_for('https://fake-ip-url.com/')
+        self.assertEqual(session.proxies['https'], 'http://127.0.0.1:3128')
+        self.assertFalse(session.trust_env)
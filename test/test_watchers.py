@@ -0,0 +1,93 @@
+__docformat__ = 'restructuredtext en'
+__author__ = 'Eli Flesher <eli@eflee.us>'
+
+import threading
+import time
+import unittest
+
+import ipaddress
+
+import echoip.policies
+import echoip.providers
+import echoip.sources
+import echoip.watchers
+
+from .fakes import DelayedIPSource
+
+
+class TestIPWatcher(unittest.TestCase):
+    def setUp(self):
+        self.source = DelayedIPSource(u'127.0.0.1', info={'city': 'Keb'})
+        self.provider = echoip.providers.IPProvider([self.source])
+        self.polling = echoip.policies.AdaptivePolling(min_interval=0.01, max_interval=0.05, jitter=0)
+        self.watcher = echoip.watchers.IPWatcher(self.provider, self.polling)
+        self.changes = []
+        self.watcher.add_callback(self.changes.append)
+
+    def test_check(self):
+        """Tests that callbacks get the old and new IP and info when the IP changes"""
+        self.assertIsNone(self.watcher.check())
+        self.assertIsNone(self.watcher.check())
+        self.assertAlmostEqual(self.polling.interval, 0.0225)
+        self.source.ip_address = ipaddress.ip_address(u'127.0.0.2')
+        self.source.info = {'city': 'Ulm'}
+        change = self.watcher.check()
+        self.assertEqual(change, echoip.watchers.IPChange(ipaddress.IPv4Address(u'127.0.0.1'),
+                                                          ipaddress.IPv4Address(u'127.0.0.2'),
+                                                          {'city': 'Keb'}, {'city': 'Ulm'}))
+        self.assertEqual(self.changes, [change])
+        self.assertEqual(self.polling.interval, 0.01)
+        self.assertEqual(self.provider.get_ip(), ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(self.source.fetch_count, 3)
+
+    def test_failures(self):
+        """Tests that failed polls and failing callbacks are kept without losing the change"""
+        def fail(change):
+            raise RuntimeError('callback failed')
+        self.watcher.add_callback(fail)
+        self.watcher.remove_callback(self.changes.append)
+        self.watcher.add_callback(self.changes.append)
+        self.watcher.check()
+        self.source.error = ValueError('no IP')
+        with self.assertRaises(echoip.providers.NullResponseFromSourcesError):
+            self.watcher.check()
+        self.source.error = None
+        self.source.ip_address = ipaddress.ip_address(u'127.0.0.2')
+        self.watcher.check()
+        self.assertIsInstance(self.watcher.last_error, RuntimeError)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_background_thread(self):
+        """Tests that the watcher thread polls until stopped and reports changes"""
+        changed = threading.Event()
+        self.watcher.add_callback(lambda change: changed.set())
+        with self.watcher:
+            self.assertTrue(self.watcher.running)
+            while self.source.fetch_count < 2:
+                changed.wait(0.01)
+            self.source.ip_address = ipaddress.ip_address(u'127.0.0.2')
+            self.assertTrue(changed.wait(1))
+        self.assertFalse(self.watcher.running)
+        self.assertEqual(self.watcher.ip_address, ipaddress.IPv4Address(u'127.0.0.2'))
+        self.assertEqual(self.changes[0].old_ip, ipaddress.IPv4Address(u'127.0.0.1'))
+
+    def test_unexpected_errors(self):
+        """Tests that the watcher thread keeps polling when the provider raises other than a failed lookup"""
+        self.source.error = RuntimeError('unexpected')
+        with self.watcher:
+            self.assertTrue(wait_for(lambda: self.source.fetch_count >= 3))
+            self.assertTrue(self.watcher.running)
+            self.assertIsInstance(self.watcher.last_error, RuntimeError)
+            self.source.error = None
+            self.assertTrue(wait_for(lambda: self.watcher.ip_address is not None))
+        self.assertEqual(self.watcher.ip_address, ipaddress.IPv4Address(u'127.0.0.1'))
+
+
+def wait_for(condition, timeout=2):
+    """Waits until the condition holds, returning False if it does not within the timeout"""
+    give_up = time.time() + timeout
+    while not condition():
+        if time.time() > give_up:
+            return False
+        time.sleep(0.01)
+    return True